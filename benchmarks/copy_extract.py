@@ -0,0 +1,115 @@
+"""
+DB-free micro-benchmark of the two ETL_EXTRACT_MODEs on the client side, running AccountInventoryBatchedQuery to the end
+over synthetic accounts. 'orm' slices the query and hydrates ORM entities, with an in-memory SQLite table standing in for
+the Postgres cursor; 'copy' parses the CSV that COPY ... TO STDOUT would send for the same rows (see CopyStream), written
+into the pipe by a fake cursor, so the server's share of either mode is not measured.
+
+    python benchmarks/copy_extract.py --accounts 200000 --batch-size 10000
+"""
+import argparse
+import csv
+import io
+import os
+import random
+import sys
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from blockchain_queries import AccountInventoryBatchedQuery
+from blockchain_tables import AccountInventory
+from copy_extract import NULL_MARKER
+
+COLUMNS = [column.name for column in AccountInventory.__table__.columns]
+
+
+def synthetic_accounts(num_accounts: int, seed: int = 0):
+    rng = random.Random(seed)
+    accounts = []
+    for i in range(num_accounts):
+        first_block = rng.randrange(1, 1200000)
+        accounts.append({
+            'address': f'{i:08d}' + ''.join(rng.choices('abcdefghijkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ123456789', k=43)),
+            'dc_balance': rng.randrange(10 ** 8), 'dc_nonce': rng.randrange(100), 'security_balance': rng.randrange(10 ** 10),
+            'balance': rng.randrange(10 ** 12), 'nonce': rng.randrange(1000), 'first_block': first_block,
+            # some accounts have not changed since they were created
+            'last_block': None if rng.random() < 0.2 else first_block + rng.randrange(10 ** 5), 'staked_balance': rng.randrange(10 ** 12)
+        })
+    return accounts
+
+
+def copy_output(accounts) -> bytes:
+    """What COPY (SELECT ...) TO STDOUT WITH (FORMAT csv, NULL '\\N') sends for accounts, in address order."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    for account in sorted(accounts, key=lambda account: account['address']):
+        writer.writerow([NULL_MARKER if account[column] is None else account[column] for column in COLUMNS])
+    return buffer.getvalue().encode()
+
+
+class FakeCursor(object):
+    def __init__(self, output: bytes):
+        self.output = output
+
+    def copy_expert(self, sql, file):
+        file.write(self.output)
+
+    def close(self):
+        pass
+
+
+def run(session: Session, batch_size: int, mode: str) -> list:
+    os.environ['ETL_EXTRACT_MODE'] = mode
+    batched_query = AccountInventoryBatchedQuery(session, batch_size)
+    documents = []
+    while not batched_query.query_complete:
+        documents.extend(batched_query.get_next_batch())
+    return documents
+
+
+def timed(func, repeat: int) -> float:
+    """The best of repeat runs."""
+    best = float('inf')
+    for _ in range(repeat):
+        now = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - now)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--accounts', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    accounts = synthetic_accounts(args.accounts)
+
+    engine = create_engine('sqlite://')
+    AccountInventory.__table__.create(engine)
+    orm_session = Session(bind=engine)
+    orm_session.execute(AccountInventory.__table__.insert(), accounts)
+    orm_session.commit()
+
+    copy_session = Session(bind=engine)
+    cursor = FakeCursor(copy_output(accounts))
+
+    class Connection(object):
+        connection = type('DBAPIConnection', (), {'cursor': lambda self: cursor})()
+
+    copy_session.connection = lambda: Connection()
+
+    # both modes produce the same documents
+    documents = run(orm_session, args.batch_size, 'orm')
+    assert len(documents) == args.accounts and documents == run(copy_session, args.batch_size, 'copy')
+    orm = timed(lambda: run(orm_session, args.batch_size, 'orm'), args.repeat)
+    copy = timed(lambda: run(copy_session, args.batch_size, 'copy'), args.repeat)
+    print(f'{args.accounts} accounts in batches of {args.batch_size}')
+    for name, seconds in (('orm (sliced cursor)', orm), ('copy (csv stream)', copy)):
+        print(f'  {name:<20} {seconds:7.3f} s  {args.accounts / seconds / 1e6:6.2f} M rows/s  x{orm / seconds:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+DB-free micro-benchmark of the per-hotspot h3 -> GeoJSON and city_id -> city_key transform, comparing the per-row
+conversion the inventory queries used to do with the batched, memoized one in geo.py. Rows are synthetic: hexes are
+drawn from a pool of real res-12 cells and a share of hotspots has no asserted location.
+
+    python benchmarks/geo_transform.py --hotspots 500000 --distinct-hexes 400000 --cities 20000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from hashlib import md5
+
+import h3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import geo
+
+
+def synthetic_rows(num_hotspots: int, num_hexes: int, num_cities: int, null_fraction: float, seed: int = 0):
+    rng = random.Random(seed)
+    hexes = [h3.geo_to_h3(rng.uniform(-60, 70), rng.uniform(-180, 180), 12) for _ in range(num_hexes)]
+    cities = [f'city{i}unitedstates' for i in range(num_cities)]
+    return [(None, None) if rng.random() < null_fraction else (rng.choice(hexes), rng.choice(cities)) for _ in range(num_hotspots)]
+
+
+def per_row(rows):
+    """The transform as the inventory queries did it before geo.py."""
+    documents = []
+    for location_hex, city_id in rows:
+        try:
+            geo_location = {'coordinates': h3.h3_to_geo(location_hex)[::-1], 'type': 'Point'}
+        except TypeError:
+            geo_location = {'coordinates': None, 'type': 'Point'}
+        documents.append((geo_location, md5(city_id.encode('utf-8')).hexdigest() if city_id else None))
+    return documents
+
+
+def batched(rows):
+    geo_locations = geo.h3_to_geo_locations(location_hex for location_hex, _ in rows)
+    return [(geo_location, geo.city_key(city_id)) for geo_location, (_, city_id) in zip(geo_locations, rows)]
+
+
+def clear_caches():
+    geo.h3_to_lon_lat.cache_clear()
+    geo._city_key.cache_clear()
+
+
+def timed(func, rows, repeat: int, setup=lambda: None) -> float:
+    """The best of repeat runs."""
+    best = float('inf')
+    for _ in range(repeat):
+        setup()
+        now = time.perf_counter()
+        func(rows)
+        best = min(best, time.perf_counter() - now)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--hotspots', type=int, default=500000)
+    parser.add_argument('--distinct-hexes', type=int, default=400000)
+    parser.add_argument('--cities', type=int, default=20000)
+    parser.add_argument('--null-fraction', type=float, default=0.1)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    rows = synthetic_rows(args.hotspots, args.distinct_hexes, args.cities, args.null_fraction)
+    assert [(p['coordinates'] and list(p['coordinates']), k) for p, k in per_row(rows[:1000])] == \
+           [(p['coordinates'] and list(p['coordinates']), k) for p, k in batched(rows[:1000])]
+    baseline = timed(per_row, rows, args.repeat)
+    # the first inventory sync of a process starts with empty caches, later ones find every unchanged hotspot cached
+    cold = timed(batched, rows, args.repeat, setup=clear_caches)
+    warm = timed(batched, rows, args.repeat)
+    print(f'{args.hotspots} hotspots, {args.distinct_hexes} distinct hexes, {args.cities} cities, {args.null_fraction:.0%} without location')
+    for name, seconds in (('per row', baseline), ('batched, cold cache', cold), ('batched, warm cache', warm)):
+        print(f'  {name:<20} {seconds:7.3f} s  {args.hotspots / seconds / 1e6:6.2f} M rows/s  x{baseline / seconds:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+DB-free measurement of the memory held per witness observation during extraction: the merged edge dict built before
+WitnessObservation (every receipt field copied onto the edge), the WitnessObservation record, and the edge document it
+produces for import. Receipts are synthetic, with the fields and field sizes of real poc_receipts_v1 witnesses, and are
+decoded from JSON text as they stream in, as the Postgres driver does; whatever an extraction keeps of them counts.
+
+A batched witness import holds about one batch of these at a time (ETL_IMPORT_BATCH_SIZE receipts' witnesses), so the
+per-observation size times the batch size bounds the extraction's memory, whatever the length of the witness window.
+
+    python benchmarks/witness_memory.py --observations 200000
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import tracemalloc
+from hashlib import md5
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from blockchain_queries import witness_observations
+
+
+def random_text(rng: random.Random, length: int) -> str:
+    return base64.b64encode(rng.randbytes(length)).decode()[:length]
+
+
+def synthetic_receipts(num_observations: int, num_hotspots: int = 20000, witnesses_per_receipt: int = 8, seed: int = 0) -> list:
+    """(time, fields as JSON text) rows, newest first like the extraction queries."""
+    rng = random.Random(seed)
+    hotspots = [random_text(rng, 51) for _ in range(num_hotspots)]
+    owners = [random_text(rng, 51) for _ in range(num_hotspots // 3)]
+    locations = [f'8c{random_text(rng, 13).lower()}' for _ in range(num_hotspots)]
+    rows = []
+    for i in range(num_observations // witnesses_per_receipt):
+        witnesses = [{
+            'gateway': hotspots[w], 'owner': rng.choice(owners), 'timestamp': 1650000000000000000 + i,
+            'signal': rng.randint(-130, -60), 'snr': round(rng.uniform(-20, 15), 1), 'frequency': 904.1 + rng.randint(0, 7) * 0.2,
+            'channel': rng.randint(0, 7), 'datarate': 'SF9BW125', 'location': locations[w], 'packet_hash': random_text(rng, 43),
+            'is_valid': rng.random() < 0.8, 'invalid_reason': None, 'reward_unit': round(rng.uniform(0, 1), 4)
+        } for w in rng.sample(range(num_hotspots), witnesses_per_receipt)]
+        rows.append((1650000000 - i, json.dumps({'path': [{'challengee': rng.choice(hotspots), 'witnesses': witnesses}]})))
+    return rows
+
+
+def merged_dicts(rows) -> list:
+    """The edges as extracted before WitnessObservation."""
+    edges = []
+    for time, text in rows:
+        fields = json.loads(text)
+        challengee = fields['path'][0]['challengee']
+        for witness in fields['path'][0]['witnesses']:
+            edge_hash = md5((challengee + witness['gateway']).encode()).hexdigest()
+            edge = {'_key': edge_hash, '_from': 'hotspots/' + challengee, '_to': 'hotspots/' + witness['gateway'], 'time': time}
+            edges.append({**edge, **witness})
+    return edges
+
+
+def observations(rows) -> list:
+    return [observation for time, text in rows for observation in witness_observations(time, json.loads(text))]
+
+
+def documents(rows) -> list:
+    return [observation.to_document() for observation in observations(rows)]
+
+
+def retained_bytes(func, rows) -> int:
+    """The memory still allocated once func(rows) has returned, i.e. what holding its result costs."""
+    tracemalloc.start()
+    result = func(rows)
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return retained
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--observations', type=int, default=200000)
+    args = parser.parse_args()
+    rows = synthetic_receipts(args.observations)
+    num_observations = sum(len(json.loads(text)['path'][0]['witnesses']) for _, text in rows)
+    print(f'{num_observations} witness observations (Python memory retained by the result)')
+    baseline = None
+    for name, func in (('merged dicts', merged_dicts), ('observations', observations), ('documents', documents)):
+        size = retained_bytes(func, rows)
+        baseline = baseline or size
+        print(f'  {name:<14} {size / 2 ** 20:8.1f} MiB  {size / num_observations:6.0f} B/observation  x{size / baseline:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,11 @@
-import multiprocessing
-
-import pyArango.theExceptions
-from pyArango.theExceptions import *
-from pyArango.connection import *
-from pyArango.graph import *
-from pyArango.collection import *
+from pyArango.theExceptions import CreationError, DeletionError, DocumentNotFoundError, UpdateError
+from pyArango.connection import Connection
+from pyArango.database import Database
+from pyArango.graph import Graph
+from pyArango.collection import Collection, Edges
+# the schema classes must be defined before collections are created by class name
 from arango_schema import *
 from typing import *
-import networkx as nx
 from blockchain_queries import *
 from multiprocessing import Process, cpu_count, Manager
 import logging
@@ -16,9 +14,60 @@ from sqlalchemy import create_engine
 import os
 from math import isnan
 from statistics import mean
+import time
+import metrics
+from profiling import profile_stage
+from batching import batch_sizer, estimate_payload_bytes
+from bulk_writer import ResilientBulkWriter
+from fingerprints import FingerprintStore, open_fingerprint_store, reset_fingerprints
+from datetime import datetime, timezone
+import json
+
+
+def durability_mode(stage: str) -> str:
+    """
+    How writes of a stage are made durable: 'sync' waits for an fsync on every write (the default), 'barrier' writes without
+    waiting and flushes the write-ahead log once at the end of the stage (see flush_wal). Set globally with ETL_DURABILITY or
+    per stage with ETL_DURABILITY_<STAGE>, e.g. ETL_DURABILITY_WITNESSES=barrier.
+    """
+    mode = (os.getenv(f'ETL_DURABILITY_{stage.upper()}') or os.getenv('ETL_DURABILITY') or 'sync').lower()
+    if mode not in ('sync', 'barrier'):
+        raise ValueError(f'Unexpected durability mode for {stage}: {mode}')
+    return mode
+
 
+def wait_for_sync(stage: str) -> bool:
+    """The waitForSync flag for writes made by stage."""
+    return durability_mode(stage) == 'sync'
 
-logging.basicConfig(filename='../logs/etl.log', encoding='utf-8', level=logging.INFO)
+
+def barrier_durability_enabled() -> bool:
+    """True if any stage uses 'barrier' durability, in which case collections must not force a sync on every write."""
+    return any(key.startswith('ETL_DURABILITY') and value.lower() == 'barrier' for key, value in os.environ.items())
+
+
+def set_wait_for_sync_property(database: Database, name: str, value: bool):
+    """
+    Sets a collection's waitForSync property. A collection with waitForSync=true syncs every write whatever the request asks for.
+    :param database: The PyArango Database object.
+    :param name: The collection name.
+    :param value: The new property value.
+    """
+    r = database.connection.session.put(f'{database.getURL()}/collection/{name}/properties', data=json.dumps({'waitForSync': value}))
+    if r.status_code != 200:
+        raise UpdateError(f'Could not set waitForSync on {name}', r.json())
+
+
+def flush_wal(database: Database):
+    """
+    Durability barrier: blocks until everything written so far has been synced to disk.
+    :param database: The PyArango Database object.
+    """
+    now = time.time()
+    r = database.connection.session.put(f'{database.connection.getEndpointURL()}/_admin/wal/flush', params={'waitForSync': 'true'})
+    if r.status_code != 200:
+        raise UpdateError('Could not flush the write-ahead log', r.json())
+    logging.info(f'Write-ahead log flushed ({round(time.time() - now, 2)} s).')
 
 
 def init_database(conn: Connection, name: str) -> Database:
@@ -42,8 +91,13 @@ def init_collection(database: Database, name: str, class_name: str, geo_index: b
     :param geo_index: bool if the collection should include a geo index (e.g. hotspot coords).
     :return: The PyArango Collection object.
     """
+    sync = not barrier_durability_enabled()
     if database.hasCollection(name) is False:
-        database.createCollection(className=class_name, name=name, waitForSync=True)
+        database.createCollection(className=class_name, name=name, waitForSync=sync)
+        # a fresh collection holds none of the documents we may have fingerprinted before
+        reset_fingerprints(name)
+    else:
+        set_wait_for_sync_property(database, name, sync)
     if geo_index:
         ensureGeoJsonIndex(database[name], fields=['geo_location'], name='geo_location', geoJson=True)
     return database[name]
@@ -57,8 +111,11 @@ def init_edges(database: Database, name: str, class_name: str) -> Edges:
     :param class_name: The collection class name (see arango_schema.py).
     :return: The PyArango Edges object.
     """
+    sync = not barrier_durability_enabled()
     if database.hasCollection(name) is False:
-        database.createCollection(className=class_name, name=name, waitForSync=True)
+        database.createCollection(className=class_name, name=name, waitForSync=sync)
+    else:
+        set_wait_for_sync_property(database, name, sync)
     return database[name]
 
 
@@ -74,6 +131,119 @@ def init_graph(database: Database, class_name: str) -> Graph:
     return database.graphs[class_name]
 
 
+def add_edge_definition(database: Database, graph_name: str, edge_collection: str, from_collections: List[str], to_collections: List[str]):
+    """
+    Registers an edge collection in a named graph, creating the graph if it doesn't already exist. pyArango only supports
+    graphs declared as classes, so this talks to the gharial API directly.
+    :param database: The PyArango Database object.
+    :param graph_name: The named graph.
+    :param edge_collection: The edge collection to add.
+    :param from_collections: The vertex collections edges start from.
+    :param to_collections: The vertex collections edges point to.
+    """
+    session = database.connection.session
+    definition = {'collection': edge_collection, 'from': from_collections, 'to': to_collections}
+    graph_url = f'{database.getURL()}/gharial/{graph_name}'
+    if session.get(graph_url).status_code == 404:
+        r = session.post(f'{database.getURL()}/gharial', data=json.dumps({'name': graph_name, 'edgeDefinitions': [definition]}))
+    else:
+        r = session.post(f'{graph_url}/edge', data=json.dumps(definition))
+    # 409: another process registered it first
+    if r.status_code not in (200, 201, 202, 409):
+        raise CreationError(f'Could not add {edge_collection} to graph {graph_name}', r.json())
+
+
+def remove_edge_definition(database: Database, graph_name: str, edge_collection: str):
+    """
+    Removes an edge collection from a named graph and drops the collection.
+    :param database: The PyArango Database object.
+    :param graph_name: The named graph.
+    :param edge_collection: The edge collection to drop.
+    """
+    r = database.connection.session.delete(f'{database.getURL()}/gharial/{graph_name}/edge/{edge_collection}', params={'dropCollections': 'true'})
+    if r.status_code not in (200, 201, 202, 404):
+        raise DeletionError(f'Could not drop {edge_collection} from graph {graph_name}', r.json())
+
+
+# named graph that the monthly payment partitions are registered in
+PAYMENTS_GRAPH = 'payments_graph'
+
+
+def partition_name(base_name: str, timestamp: int) -> str:
+    """The monthly partition of base_name holding documents with this timestamp, e.g. payments_202111."""
+    return f"{base_name}_{datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y%m')}"
+
+
+def partitions_for_range(base_name: str, min_time: int, max_time: int) -> List[str]:
+    """
+    The monthly partitions of base_name that can hold documents in min_time..max_time, i.e. the only ones a query over that
+    range needs to touch. Partitions that were never created are included; check hasCollection before reading them.
+    """
+    start = datetime.fromtimestamp(min_time, tz=timezone.utc)
+    end = datetime.fromtimestamp(max_time, tz=timezone.utc)
+    names = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        names.append(f'{base_name}_{year}{month:02d}')
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return names
+
+
+def init_partitions(database: Database, base_name: str, class_name: str, graph_name: str, min_time: int, max_time: int) -> List[str]:
+    """
+    Creates the monthly edge partitions covering min_time..max_time (with a time index) and registers them in graph_name.
+    Call this before handing a range to parallel workers, so that they never race to create the same collection.
+    :return: The partition names.
+    """
+    names = partitions_for_range(base_name, min_time, max_time)
+    for name in names:
+        if database.hasCollection(name) is False:
+            init_edges(database, name=name, class_name=class_name)
+            database[name].ensurePersistentIndex(['time'])
+            add_edge_definition(database, graph_name, name, ['accounts'], ['accounts'])
+    return names
+
+
+def list_partitions(database: Database, base_name: str) -> List[str]:
+    """The existing monthly partitions of base_name, oldest first."""
+    database.reloadCollections()
+    return sorted(name for name in database.collections if name.startswith(f'{base_name}_') and name[len(base_name) + 1:].isdigit())
+
+
+def drop_partitions_before(database: Database, base_name: str, graph_name: str, cutoff_time: int) -> List[str]:
+    """
+    Drops every monthly partition of base_name that ends before cutoff_time, instead of deleting old documents one by one.
+    :return: The dropped partition names.
+    """
+    oldest_kept = partition_name(base_name, cutoff_time)
+    dropped = [name for name in list_partitions(database, base_name) if name < oldest_kept]
+    for name in dropped:
+        remove_edge_definition(database, graph_name, name)
+        logging.info(f'Dropped partition {name}.')
+    if dropped:
+        # the partitions went through gharial, behind the back of pyArango's collection cache (which hasCollection reads)
+        database.reloadCollections()
+    return dropped
+
+
+def import_payment_partitions(database: Database, payments: List[dict]) -> dict:
+    """
+    Routes a batch of payment edges to their monthly partitions (see init_partitions) and imports each group.
+    :param database: The PyArango Database object.
+    :param payments: The payment edges.
+    :return: The importBulk responses summed over partitions.
+    """
+    groups = {}
+    for payment in payments:
+        groups.setdefault(partition_name('payments', payment['time']), []).append(payment)
+    total = {'created': 0, 'updated': 0, 'ignored': 0, 'errors': 0, 'empty': 0}
+    for name, group in groups.items():
+        response = database[name].importBulk(group, onDuplicate='ignore', complete=True, waitForSync=wait_for_sync('payments'))
+        for outcome in total:
+            total[outcome] += response.get(outcome, 0)
+    return total
+
+
 def update_daily_balances(database: Database, balances_data: List[dict]):
     """
     Deprecated in favor of more optimized methods.
@@ -95,24 +265,298 @@ def remove_witnesses_before_time(database: Database, cutoff_time: int):
     """
     aql = f"""for witness in witnesses
     filter witness.time < {cutoff_time}
-    remove witness in witnesses OPTIONS {{ waitForSync: true }}"""
+    remove witness in witnesses OPTIONS {{ waitForSync: {str(wait_for_sync('witnesses')).lower()} }}"""
     database.AQLQuery(aql)
 
 
+def merge_witness_links(database: Database, links: List[dict]) -> dict:
+    """
+    Merge a batch of witness link documents (see aggregate_witness_links) into the witnesses collection. Per-day statistics
+    are added to the stored buckets, the latest-observation fields only move forward in time, and the link is flagged so that
+    refresh_witness_link_stats recomputes its rolling summary. A batch written twice is counted twice, so it is not retried
+    after an ambiguous error (see ADDITIVE_WRITERS), and the sync rebuilds the days of a merge that failed part-way.
+    :param database: The PyArango Database object.
+    :param links: The link documents.
+    :return: An importBulk-style response with created/updated counts.
+    """
+    aql = """
+    FOR link IN @links
+        UPSERT {_key: link._key}
+        INSERT MERGE(link, {stats_dirty: true})
+        UPDATE MERGE(
+            OLD.time > link.time ? {} : UNSET(link, '_key', '_from', '_to', 'days'),
+            {stats_dirty: true,
+             days: MERGE(OLD.days || {}, MERGE(
+                FOR day IN ATTRIBUTES(link.days)
+                    LET o = (OLD.days || {})[day]
+                    LET n = link.days[day]
+                    RETURN {[day]: o == null ? n : {
+                        count: o.count + n.count, valid: o.valid + n.valid, invalid: o.invalid + n.invalid,
+                        snr_n: o.snr_n + n.snr_n, snr_sum: o.snr_sum + n.snr_sum, snr_min: MIN([o.snr_min, n.snr_min]), snr_max: MAX([o.snr_max, n.snr_max]),
+                        signal_n: o.signal_n + n.signal_n, signal_sum: o.signal_sum + n.signal_sum, signal_min: MIN([o.signal_min, n.signal_min]), signal_max: MAX([o.signal_max, n.signal_max]),
+                        first_seen: MIN([o.first_seen, n.first_seen]), last_seen: MAX([o.last_seen, n.last_seen])}}))})
+        IN witnesses OPTIONS {mergeObjects: false, exclusive: true, waitForSync: @sync}
+        COLLECT AGGREGATE created = SUM(OLD == null ? 1 : 0), updated = SUM(OLD == null ? 0 : 1)
+        RETURN {created: created, updated: updated}
+    """
+    response = database.AQLQuery(aql, bindVars={'links': links, 'sync': wait_for_sync('witnesses')}, rawResults=True)[0]
+    # COLLECT AGGREGATE over an empty batch yields nulls
+    return {'created': response['created'] or 0, 'updated': response['updated'] or 0}
+
+
+def reset_witness_link_stats(database: Database, from_day: Optional[int] = None):
+    """
+    Forget the per-day statistics of every witness link, e.g. before rebuilding them from the whole window after a restart.
+    :param database: The PyArango Database object.
+    :param from_day: Only forget the UTC days from this one on, e.g. before re-reading the days a failed merge added to.
+    """
+    aql = """FOR e IN witnesses
+    FILTER @from_day == null OR LENGTH(ATTRIBUTES(e.days || {})[* FILTER TO_NUMBER(CURRENT) >= @from_day]) > 0
+    LET days = @from_day == null ? {} : MERGE(FOR day IN ATTRIBUTES(e.days) FILTER TO_NUMBER(day) < @from_day RETURN {[day]: e.days[day]})
+    UPDATE e WITH {days: days, stats_dirty: true} IN witnesses OPTIONS {mergeObjects: false, waitForSync: @sync}"""
+    database.AQLQuery(aql, bindVars={'from_day': from_day, 'sync': wait_for_sync('witnesses')})
+
+
+def refresh_witness_link_stats(database: Database, cutoff_time: int) -> int:
+    """
+    Drop per-day buckets older than the window, remove links with no observations left, and recompute the rolling summary
+    (observation/valid/invalid counts, mean/min/max snr and signal, first/last seen) for links that were merged into or lost a day.
+    Recomputed links get updated_at (server time), and the city graphs of removed links are marked stale (see refresh_city_graphs).
+    :param database: The PyArango Database object.
+    :param cutoff_time: The start of the window. The UTC day containing it is kept.
+    :return: The number of links refreshed.
+    """
+    cutoff_day = cutoff_time // (3600 * 24)
+    bind_vars = {'cutoff_day': cutoff_day, 'cutoff_day_start': cutoff_day * 3600 * 24, 'sync': wait_for_sync('witnesses')}
+    remove_aql = """FOR e IN witnesses
+    FILTER e.stats_dirty == true OR e.first_seen < @cutoff_day_start
+    FILTER LENGTH(ATTRIBUTES(e.days || {})[* FILTER TO_NUMBER(CURRENT) >= @cutoff_day]) == 0
+    REMOVE e IN witnesses OPTIONS {waitForSync: @sync}
+    RETURN DISTINCT DOCUMENT(OLD._from).location_details.city_key"""
+    # removed links leave no updated_at behind, so flag their cities' graphs instead
+    mark_city_graphs_stale(database, database.fetch_list(remove_aql, bind_vars=bind_vars, dont_raise_error_if_empty=True))
+    refresh_aql = """FOR e IN witnesses
+    FILTER e.stats_dirty == true OR e.first_seen < @cutoff_day_start
+    LET kept = MERGE(FOR day IN ATTRIBUTES(e.days) FILTER TO_NUMBER(day) >= @cutoff_day RETURN {[day]: e.days[day]})
+    LET d = VALUES(kept)
+    LET snr_n = SUM(d[*].snr_n)
+    LET signal_n = SUM(d[*].signal_n)
+    UPDATE e WITH {
+        days: kept,
+        stats_dirty: false,
+        observations: SUM(d[*].count),
+        valid_count: SUM(d[*].valid),
+        invalid_count: SUM(d[*].invalid),
+        snr_mean: snr_n > 0 ? SUM(d[*].snr_sum) / snr_n : null,
+        snr_min: MIN(d[*].snr_min),
+        snr_max: MAX(d[*].snr_max),
+        signal_mean: signal_n > 0 ? SUM(d[*].signal_sum) / signal_n : null,
+        signal_min: MIN(d[*].signal_min),
+        signal_max: MAX(d[*].signal_max),
+        first_seen: MIN(d[*].first_seen),
+        last_seen: MAX(d[*].last_seen),
+        updated_at: DATE_NOW() / 1000
+    } IN witnesses OPTIONS {mergeObjects: false, waitForSync: @sync}
+    COLLECT WITH COUNT INTO n
+    RETURN n"""
+    return database.AQLQuery(refresh_aql, bindVars=bind_vars, rawResults=True)[0]
+
+
+# derived fields of a collection, by the writer (stage) that owns them: field -> keepNull. A writer may only patch its own
+# fields, so writers of different fields can run at the same time without overwriting each other's values.
+PATCH_FIELDS = {
+    'hotspots': {
+        'rewards': {'rewards_1d': True, 'rewards_5d': True, 'rewards_30d': True},
+        'city_metrics': {'betweenness_centrality': True, 'betweenness_centrality_n': True, 'pagerank': True, 'pagerank_n': True}
+    }
+}
+
+
+def register_patch_fields(collection_name: str, owner: str, fields: Dict[str, bool]):
+    """
+    Declare (more) derived fields of a collection that owner writes with patch_documents.
+    :param collection_name: The collection.
+    :param owner: The writer, e.g. the stage name.
+    :param fields: field -> keepNull: True stores None as null, False removes the attribute instead.
+    """
+    for other, owned in PATCH_FIELDS.get(collection_name, {}).items():
+        shared = set(owned).intersection(fields) if other != owner else set()
+        if shared:
+            raise ValueError(f'{collection_name} fields {sorted(shared)} are already owned by {other}')
+    PATCH_FIELDS.setdefault(collection_name, {}).setdefault(owner, {}).update(fields)
+
+
+def patch_documents(database: Database, collection_name: str, owner: str, patches: List[dict]) -> dict:
+    """
+    Set a subset of fields on existing documents, leaving every other attribute alone. Each patch is a dict with _key and
+    some of owner's fields (see PATCH_FIELDS); the batch is applied with one bind-array UPDATE per keepNull setting in use.
+    Patches for documents that do not exist are skipped rather than creating partial documents.
+    :param database: The PyArango Database object.
+    :param collection_name: The collection.
+    :param owner: The writer, which must own every field patched.
+    :param patches: The patches.
+    :return: An importBulk-style response with the number of documents updated.
+    """
+    owned = PATCH_FIELDS.get(collection_name, {}).get(owner, {})
+    groups = {True: [], False: []}
+    for patch in patches:
+        fields = {True: {}, False: {}}
+        for field, value in patch.items():
+            if field == '_key':
+                continue
+            if field not in owned:
+                raise ValueError(f'{owner} does not own {collection_name}.{field}')
+            fields[owned[field]][field] = value
+        for keep_null, subset in fields.items():
+            if subset:
+                groups[keep_null].append({'_key': patch['_key'], 'fields': subset})
+    aql = """
+    FOR patch IN @patches
+        FILTER DOCUMENT(@@collection, patch._key) != null
+        UPDATE patch._key WITH patch.fields IN @@collection OPTIONS {keepNull: @keep_null, mergeObjects: false, waitForSync: @sync}
+        RETURN NEW._key"""
+    updated = set()
+    for keep_null, group in groups.items():
+        if group:
+            bind_vars = {'patches': group, '@collection': collection_name, 'keep_null': keep_null, 'sync': wait_for_sync(owner)}
+            # a document patched by both queries counts once; query errors (e.g. write conflicts) surface as AQLQueryError
+            updated.update(database.AQLQuery(aql, bindVars=bind_vars, rawResults=True, batchSize=len(group)))
+    return {'created': 0, 'updated': len(updated)}
+
+
 def update_rewards(database: Database, rewards_data: List[dict]):
     """
-    Deprecated in favor of more optimized options.
-    :param database:
-    :param rewards_data:
+    Deprecated in favor of the reward buckets (see rollup_rewards). Sets rewards_5d of hotspots.
+    :param database: The PyArango Database object.
+    :param rewards_data: {_key, rewards_5d} documents (as from GatewayRewardsBatchedQuery), or the older {address, rewards}.
     """
-    for doc in rewards_data:
-        aql = f"""for hotspot in hotspots
-        update {{_key: '{doc['address']}', rewards_5d: {doc['rewards']}}} in hotspots"""
-        try:
-            database.AQLQuery(aql)
-        except pyArango.theExceptions.AQLQueryError:
-            # this catches '1Wh4bh' gateway
-            continue
+    patches = [{'_key': doc['_key'], 'rewards_5d': doc['rewards_5d']} if '_key' in doc else {'_key': doc['address'], 'rewards_5d': doc['rewards']}
+               for doc in rewards_data]
+    patch_documents(database, 'hotspots', 'rewards', patches)
+
+
+# bucket size in seconds and the offset of the first bucket boundary after the epoch (weeks start on Monday 1970-01-05 UTC)
+TOKEN_FLOW_BUCKETS = {
+    'day': (3600 * 24, 0),
+    'week': (3600 * 24 * 7, 3600 * 24 * 4)
+}
+
+
+def add_reward_buckets(database: Database, buckets: List[dict]) -> dict:
+    """
+    Add a batch of per-gateway, per-day reward sums (see RewardDaysBatchedQuery) to the reward_buckets collection. A bucket
+    keeps the amount of every (min_block, max_block] range it was built from in 'blocks', and a new sum replaces the ones
+    whose range overlaps its own: writing the same range twice (a retried batch, or a stage re-run from the same watermark
+    after a failure) counts it once, while the disjoint ranges of later cycles and of backfill units add up.
+    :param database: The PyArango Database object.
+    :param buckets: The bucket documents, with the min_block and max_block of the range they sum.
+    :return: An importBulk-style response with created/updated counts.
+    """
+    aql = """
+    FOR bucket IN @buckets
+        LET range = [bucket.min_block, bucket.max_block, bucket.amount]
+        UPSERT {_key: bucket._key}
+        INSERT {_key: bucket._key, gateway: bucket.gateway, day: bucket.day, amount: bucket.amount, blocks: [range]}
+        UPDATE {
+            blocks: APPEND((OLD.blocks || [])[* FILTER CURRENT[1] <= bucket.min_block OR CURRENT[0] >= bucket.max_block], [range]),
+            amount: SUM((OLD.blocks || [])[* FILTER CURRENT[1] <= bucket.min_block OR CURRENT[0] >= bucket.max_block][*][2]) + bucket.amount}
+        IN reward_buckets OPTIONS {exclusive: true, waitForSync: @sync}
+        COLLECT AGGREGATE created = SUM(OLD == null ? 1 : 0), updated = SUM(OLD == null ? 0 : 1)
+        RETURN {created: created, updated: updated}
+    """
+    response = database.AQLQuery(aql, bindVars={'buckets': buckets, 'sync': wait_for_sync('rewards')}, rawResults=True)[0]
+    # COLLECT AGGREGATE over an empty batch yields nulls
+    return {'created': response['created'] or 0, 'updated': response['updated'] or 0}
+
+
+def rollup_rewards(database: Database, current_day: int, horizons: List[int], gateways: Optional[List[str]] = None, batch_size: int = 1000) -> int:
+    """
+    Drop reward buckets older than the longest horizon, then set rewards_<N>d on hotspots to the sum of their buckets over
+    the last N UTC days (today included) for every horizon N, in a single pass over the remaining buckets. Every other
+    hotspot with a non-zero (or missing) reward horizon is set to 0, e.g. when its last bucket expired or when the buckets
+    were rebuilt without it. The horizons are written as the 'rewards' fields of hotspots (see patch_documents).
+    :param database: The PyArango Database object.
+    :param current_day: The current UTC day number (time // 86400).
+    :param horizons: The horizons in days, e.g. [1, 5, 30].
+    :param gateways: Only roll up these gateways and skip the expiry and zeroing, e.g. after a micro-batch within the same day.
+    :param batch_size: The cursor and write batch size.
+    :return: The number of hotspots updated.
+    """
+    min_day = current_day - max(horizons) + 1
+    if gateways is None:
+        expire_aql = """
+        FOR bucket IN reward_buckets
+            FILTER bucket.day < @min_day
+            REMOVE bucket IN reward_buckets OPTIONS {waitForSync: @sync}"""
+        database.AQLQuery(expire_aql, bindVars={'min_day': min_day, 'sync': wait_for_sync('rewards')})
+    sums = ', '.join(f'rewards_{h}d = SUM(bucket.day >= {current_day - h + 1} ? bucket.amount : 0)' for h in horizons)
+    fields = ', '.join(f'rewards_{h}d: rewards_{h}d' for h in horizons)
+    nonzero = ' OR '.join(f'hotspot.rewards_{h}d != 0' for h in horizons)
+    zeros = ', '.join(f'rewards_{h}d: 0' for h in horizons)
+    rollup_aql = f"""
+    LET current = (
+        FOR bucket IN reward_buckets
+            FILTER @gateways == null OR (bucket.gateway IN @gateways AND bucket.day >= @min_day)
+            COLLECT gateway = bucket.gateway AGGREGATE {sums}
+            RETURN {{_key: gateway, {fields}}})
+    LET rewarded = ZIP(current[*]._key, current[*]._key)
+    LET stale = (
+        FOR hotspot IN hotspots
+            FILTER @gateways == null AND ({nonzero}) AND NOT HAS(rewarded, hotspot._key)
+            RETURN {{_key: hotspot._key, {zeros}}})
+    FOR doc IN APPEND(current, stale)
+        RETURN doc"""
+    writer = ResilientBulkWriter('hotspots', lambda batch: patch_documents(database, 'hotspots', 'rewards', batch))
+    num_updated, batch = 0, []
+    for doc in database.AQLQuery(rollup_aql, bindVars={'gateways': gateways, 'min_day': min_day}, rawResults=True, batchSize=batch_size):
+        batch.append(doc)
+        if len(batch) == batch_size:
+            num_updated += writer.write(batch)['updated']
+            batch = []
+    return num_updated + writer.write(batch)['updated']
+
+
+def token_flow_bucket_start(timestamp: int, bucket: str) -> int:
+    """
+    Returns the start of the token-flow bucket containing timestamp.
+    :param timestamp: The unix timestamp.
+    :param bucket: 'day' or 'week' (see TOKEN_FLOW_BUCKETS).
+    :return: The unix timestamp of the start of the bucket.
+    """
+    size, offset = TOKEN_FLOW_BUCKETS[bucket]
+    return timestamp - (timestamp - offset) % size
+
+
+def update_token_flows(database: Database, min_time: int, max_time: int, bucket: str, payment_collections: List[str] = ('payments',)) -> int:
+    """
+    Recompute the aggregated token-flow edges (one per payer, payee and bucket) for every bucket overlapping min_time..max_time.
+    Whole buckets are re-aggregated from the payment edges, so running this twice over the same range is harmless.
+    :param database: The PyArango Database object.
+    :param min_time: The start of the range of newly imported payments.
+    :param max_time: The end of the range of newly imported payments.
+    :param bucket: 'day' or 'week' (see TOKEN_FLOW_BUCKETS).
+    :param payment_collections: The payment edge collections to aggregate.
+    :return: The number of token-flow edges written.
+    """
+    size, offset = TOKEN_FLOW_BUCKETS[bucket]
+    start = token_flow_bucket_start(min_time, bucket)
+    end = token_flow_bucket_start(max_time, bucket) + size
+    payments = ', '.join(f'(FOR p IN {name} FILTER p.time >= @start AND p.time < @end RETURN p)' for name in payment_collections)
+    aql = f"""
+    FOR p IN FLATTEN([{payments}])
+        COLLECT from = p._from, to = p._to, bucket_start = p.time - ((p.time - @offset) % @size)
+        AGGREGATE count = LENGTH(1), total_amount = SUM(p.amount), min_time = MIN(p.time), max_time = MAX(p.time)
+        LET flow = {{_key: MD5(CONCAT(from, to, bucket_start)), _from: from, _to: to, bucket: @bucket, bucket_start: bucket_start,
+                    count: count, total_amount: total_amount, min_time: min_time, max_time: max_time}}
+        UPSERT {{_key: flow._key}}
+        INSERT flow
+        REPLACE flow
+        IN token_flows OPTIONS {{waitForSync: @sync}}
+        COLLECT WITH COUNT INTO n
+        RETURN n
+    """
+    bind_vars = {'start': start, 'end': end, 'offset': offset, 'size': size, 'bucket': bucket, 'sync': wait_for_sync('token_flows')}
+    return database.AQLQuery(aql, bindVars=bind_vars, rawResults=True)[0]
 
 
 def get_cities_list(database: Database) -> List[str]:
@@ -123,16 +567,116 @@ def get_cities_list(database: Database) -> List[str]:
     """
     aql = """for city in cities
     return {city_key: city._key}"""
-    return [city['city_key'] for city in database.fetch_list(aql)]
+    return [city['city_key'] for city in database.fetch_list(aql, dont_raise_error_if_empty=True)]
+
+
+def mark_city_graphs_stale(database: Database, city_keys: List[Optional[str]]):
+    """
+    Flag city graph documents for a rebuild on the next refresh_city_graphs.
+    :param database: The PyArango Database object.
+    :param city_keys: The cities collection keys. None (hotspots without a city) and cities without a graph are skipped.
+    """
+    city_keys = [key for key in city_keys if key is not None]
+    if not city_keys or not database.hasCollection('city_graphs'):
+        return
+    aql = """FOR key IN @keys
+    UPDATE {_key: key, stale: true} IN city_graphs OPTIONS {ignoreErrors: true, waitForSync: @sync}"""
+    database.AQLQuery(aql, bindVars={'keys': city_keys, 'sync': wait_for_sync('city_graphs')})
+
+
+def get_changed_cities(database: Database, since: float) -> List[str]:
+    """
+    The cities whose witness graph may have changed since a refresh: those with a link (from one of their hotspots) that was
+    updated after since, and those whose graph was marked stale.
+    :param database: The PyArango Database object.
+    :param since: The server time (seconds) of the last refresh.
+    """
+    aql = """
+    LET changed = (
+        FOR e IN witnesses
+            FILTER e.updated_at > @since
+            RETURN DISTINCT DOCUMENT(e._from).location_details.city_key)
+    LET stale = (
+        FOR graph IN city_graphs
+            FILTER graph.stale == true
+            RETURN graph._key)
+    FOR key IN UNION_DISTINCT(changed, stale)
+        FILTER key != null
+        RETURN key"""
+    return database.fetch_list(aql, bind_vars={'since': since}, dont_raise_error_if_empty=True)
+
+
+def get_server_time(database: Database) -> float:
+    """The Arango server's clock, in seconds, to compare with updated_at stamps written by AQL."""
+    return database.fetch_list('RETURN DATE_NOW() / 1000')[0]
+
+
+def build_city_graphs(database: Database, city_keys: List[str]) -> List[dict]:
+    """
+    The compact witness graph of each city: nodes lists the hotspot keys, edges the valid witness links from the city's
+    hotspots as [from index, to index, distance_m] triples into nodes. Witnesses outside the city are nodes too.
+    :param database: The PyArango Database object.
+    :param city_keys: The cities collection keys.
+    :return: city_graphs documents, one per city (empty for cities without links).
+    """
+    aql = """
+    FOR key IN @keys
+        FOR hotspot IN hotspots
+            FILTER hotspot.location_details.city_key == key
+            FOR e IN witnesses
+                FILTER e._from == hotspot._id AND e.is_valid
+                RETURN [key, hotspot._key, PARSE_IDENTIFIER(e._to).key, e.distance_m]"""
+    now = time.time()
+    links = database.fetch_list(aql, bind_vars={'keys': city_keys}, dont_raise_error_if_empty=True)
+    metrics.record_fetch('city_graphs', len(links), time.time() - now)
+    graphs = {key: ({}, []) for key in city_keys}
+    for key, from_key, to_key, distance_m in links:
+        index, edges = graphs[key]
+        i = index.setdefault(from_key, len(index))
+        j = index.setdefault(to_key, len(index))
+        edges.append([i, j, distance_m])
+    return [{'_key': key, 'nodes': list(index), 'edges': edges, 'num_nodes': len(index), 'num_edges': len(edges), 'stale': False}
+            for key, (index, edges) in graphs.items()]
+
 
+def refresh_city_graphs(database: Database, since: Optional[float], batch_size: int) -> Tuple[int, float]:
+    """
+    Rebuild the city_graphs documents of the cities whose witness links changed since the last refresh (all cities if
+    since is None), so that reading a city's graph is a single document lookup.
+    :param database: The PyArango Database object.
+    :param since: The server time returned by the last refresh, or None.
+    :param batch_size: Roughly the number of links fetched per query; cities are processed in groups accordingly.
+    :return: (the number of city graphs written, the server time to pass as since next time).
+    """
+    # links updated while we read are stamped after this, so the next refresh picks them up again
+    refresh_time = get_server_time(database)
+    city_keys = get_cities_list(database) if since is None else get_changed_cities(database, since)
+    city_graphs = database['city_graphs']
+    writer = ResilientBulkWriter('city_graphs', lambda batch: city_graphs.importBulk(batch, onDuplicate='replace', complete=True, waitForSync=wait_for_sync('city_graphs')))
+    # a city has tens of links on average, so group cities to keep the number of queries down
+    cities_per_query = max(1, batch_size // 50)
+    num_written = 0
+    for i in range(0, len(city_keys), cities_per_query):
+        graphs = build_city_graphs(database, city_keys[i:i + cities_per_query])
+        now = time.time()
+        response = writer.write(graphs)
+        metrics.record_import('city_graphs', response, time.time() - now)
+        num_written += response['created'] + response['updated']
+    return num_written, refresh_time
 
-def city_witness_graph_metrics_bulk(return_dict: dict, city_list: List[str], min_city_size: int):
+
+def city_witness_graph_metrics_bulk(return_dict: dict, city_list: List[str], min_city_size: int, metrics_dict=None, proc_num: int = 0):
     """
     Multiprocessing target for extracting city graph metrics for each city in city_list.
     :param return_dict: The multiprocessing Manager()'s dict destination for outputs.
     :param city_list: The list of city keys in the cities collection.
     :param min_city_size: Only consider cities with more than this many hotspots.
+    :param metrics_dict: Optional Manager dict that receives this worker's metrics snapshot for merging in the parent.
+    :param proc_num: The worker index, used as the metrics_dict key.
     """
+    # only the city metrics workers need networkx, so keep it out of the import of this module
+    import networkx as nx
+    metrics.REGISTRY.reset()
     nan_to_num = lambda x: 0 if isnan(x) else x
     # if running in parallel, need independent connections
     connection = Connection(
@@ -141,44 +685,39 @@ def city_witness_graph_metrics_bulk(return_dict: dict, city_list: List[str], min
         password=os.getenv('ARANGO_PASSWORD')
     )
     database = connection['helium']
-    hotspots = database['hotspots']
-    for city in city_list:
-        # only consider valid witness paths
-        aql = f"""
-        for hotspot in hotspots
-        filter hotspot.location_details.city_key == '{city}'
-        for v, e, p in 1..1 outbound hotspot witnesses
-            filter e.is_valid
-            let distance_m = GEO_DISTANCE(p.vertices[0].geo_location, p.vertices[1].geo_location)
-            RETURN {{_from: last(split(e._from, '/')), _to: last(split(e._to, '/')), distance_m: distance_m}}
-        """
-        try:
-            result = database.fetch_list(aql)
-        except pyArango.theExceptions.AQLFetchError:
-            continue
-        if len(result) < min_city_size:
-            continue
-        g = nx.DiGraph()
-        edges = [(edge.values()) for edge in result]
-        g.add_weighted_edges_from(edges)
-        bc = nx.betweenness_centrality(g)
-        bc_mean = mean(bc.values())
-        pg = nx.pagerank(g)
-        pg_mean = mean(pg.values())
-        # (hubs, authorities) = nx.algorithms.hits(g) # not sure how useful this is
-        features = [{
-            '_key': key,
-            'betweenness_centrality': nan_to_num(bc[key]),
-            'betweenness_centrality_n': nan_to_num(bc[key] / bc_mean),
-            'pagerank': nan_to_num(pg[key]),
-            'pagerank_n': nan_to_num(pg[key] / pg_mean)}
-            for key in pg.keys()]
-        try:
-            hotspots.importBulk(features, onDuplicate='update')
-            return_dict[city] = len(features)
-        except pyArango.theExceptions.CreationError:
-            logging.info(f'Arango did not like this JSON: {features}')
-            continue
+    writer = ResilientBulkWriter('hotspots', lambda batch: patch_documents(database, 'hotspots', 'city_metrics', batch))
+    with profile_stage(f'city_metrics_worker{proc_num}'):
+        for city in city_list:
+            # the materialized graph holds the valid witness links of the city (see refresh_city_graphs)
+            now = time.time()
+            try:
+                graph = database['city_graphs'].fetchDocument(city, rawResults=True)
+            except DocumentNotFoundError:
+                continue
+            metrics.record_fetch('city_graphs', graph['num_edges'], time.time() - now)
+            if graph['num_edges'] < min_city_size:
+                continue
+            nodes = graph['nodes']
+            g = nx.DiGraph()
+            g.add_weighted_edges_from((nodes[i], nodes[j], distance_m) for i, j, distance_m in graph['edges'])
+            bc = nx.betweenness_centrality(g)
+            bc_mean = mean(bc.values())
+            pg = nx.pagerank(g)
+            pg_mean = mean(pg.values())
+            # (hubs, authorities) = nx.algorithms.hits(g) # not sure how useful this is
+            features = [{
+                '_key': key,
+                'betweenness_centrality': nan_to_num(bc[key]),
+                'betweenness_centrality_n': nan_to_num(bc[key] / bc_mean),
+                'pagerank': nan_to_num(pg[key]),
+                'pagerank_n': nan_to_num(pg[key] / pg_mean)}
+                for key in pg.keys()]
+            now = time.time()
+            response = writer.write(features)
+            metrics.record_import('hotspots', response, time.time() - now)
+            return_dict[city] = response['created'] + response['updated']
+    if metrics_dict is not None:
+        metrics_dict[proc_num] = metrics.REGISTRY.snapshot()
 
 
 def parallel_city_graph_processing(database: Database, min_city_size: int) -> Tuple[int, int]:
@@ -190,6 +729,7 @@ def parallel_city_graph_processing(database: Database, min_city_size: int) -> Tu
     """
     manager = Manager()
     return_dict = manager.dict()
+    metrics_dict = manager.dict()
     cities_list = get_cities_list(database)
     logging.info(f'Generating graphs/metrics for {len(cities_list)} unique cities...')
     city_chunks = []
@@ -200,35 +740,80 @@ def parallel_city_graph_processing(database: Database, min_city_size: int) -> Tu
     processes = []
     # naive domain decomposition...split up the cities list into equal segments
     for i in range(cpu_count()):
-        p = Process(target=city_witness_graph_metrics_bulk, args=(return_dict, city_chunks[i], min_city_size))
+        p = Process(target=city_witness_graph_metrics_bulk, args=(return_dict, city_chunks[i], min_city_size, metrics_dict, i))
         processes.append(p)
         p.start()
+    metrics.QUEUE_DEPTH.set(len(processes), collection='city_graphs')
     for p in processes:
         p.join()
+        metrics.QUEUE_DEPTH.dec(collection='city_graphs')
+    for snapshot in metrics_dict.values():
+        metrics.REGISTRY.merge(snapshot)
     return len(return_dict.keys()), sum(return_dict.values())
 
 
-def import_batched(batched_query: BatchedQuery, collection: Collection, on_duplicate: str = 'update') -> int:
+def import_batched(batched_query: BatchedQuery, collection: Collection, on_duplicate: str = 'update', fingerprints: Optional[FingerprintStore] = None, sizer_key: str = None, writer: Callable = None) -> int:
     """
     Import data to arango in batches.
     :param batched_query: The BatchedQuery object (see blockchain_queries.py)
     :param collection:
     :param on_duplicate:
+    :param fingerprints: Optional FingerprintStore. Documents whose content is unchanged since the last import are skipped.
+    :param sizer_key: The adaptive batch sizer to use, if different queries write to the same collection. Defaults to the collection name.
+    :param writer: Optional writer(database, batch) -> response used instead of importBulk. Defaults to BULK_WRITERS[collection.name].
     :return:
     """
-    num_docs_imported = 0
+    num_docs_imported, num_docs_unchanged = 0, 0
+    sizer = batch_sizer(sizer_key or collection.name, batched_query.batch_size)
+    write = writer or BULK_WRITERS.get(collection.name)
+    if write is not None:
+        resilient_writer = ResilientBulkWriter(collection.name, lambda batch: write(collection.database, batch), idempotent=write not in ADDITIVE_WRITERS)
+    else:
+        resilient_writer = ResilientBulkWriter(collection.name, lambda batch: collection.importBulk(batch, onDuplicate=on_duplicate, complete=True, waitForSync=wait_for_sync(sizer_key or collection.name)))
     while True:
+        if sizer is not None:
+            batched_query.set_batch_size(sizer.size)
+        requested_rows = batched_query.batch_size
+        now = time.time()
         batch = batched_query.get_next_batch()
-        if len(batch) > 0:
-            response = collection.importBulk(batch, onDuplicate=on_duplicate, waitForSync=True)
-            logging.info(f'Batch import response: {response}')
-            num_docs_imported += response['updated'] + response['created']
-        else:
+        fetch_seconds = time.time() - now
+        metrics.record_fetch(collection.name, len(batch), fetch_seconds)
+        if len(batch) == 0:
             break
+        pending = {}
+        if fingerprints is not None:
+            num_fetched = len(batch)
+            batch, pending = fingerprints.filter_changed(batch)
+            metrics.DOCUMENTS.inc(num_fetched - len(batch), collection=collection.name, outcome='unchanged')
+            num_docs_unchanged += num_fetched - len(batch)
+            if len(batch) == 0:
+                continue
+        now = time.time()
+        response = resilient_writer.write(batch)
+        import_seconds = time.time() - now
+        metrics.record_import(collection.name, response, import_seconds)
+        logging.debug(f'Batch import response: {response}')
+        num_docs_imported += response['updated'] + response['created']
+        if sizer is not None:
+            sizer.observe(requested_rows, fetch_seconds, import_seconds, estimate_payload_bytes(batch))
+        # rejected documents are dead-lettered without telling which they were, so only remember batches that went in cleanly
+        if pending and response.get('errors', 0) == 0:
+            fingerprints.commit(pending)
+    if fingerprints is not None:
+        logging.info(f'{collection.name}: {num_docs_imported} documents written, {num_docs_unchanged} unchanged documents skipped.')
     return num_docs_imported
 
 
-def import_batched_mp(return_dict, proc_num: int, batched_query: BatchedQuery, collection_name: str, on_duplicate: str = 'update'):
+# collections whose batches need more than importBulk, keyed by collection name
+BULK_WRITERS = {
+    'witnesses': merge_witness_links,
+    'reward_buckets': add_reward_buckets
+}
+# writers that add to what is stored, so that a batch written twice is counted twice: not retried after an ambiguous error
+ADDITIVE_WRITERS = {merge_witness_links}
+
+
+def import_batched_mp(return_dict, proc_num: int, batched_query: BatchedQuery, collection_name: str, on_duplicate: str = 'update', metrics_dict=None, writer: Callable = None):
     """
     Parallel target for importing data from batched queries.
     :param return_dict:
@@ -236,8 +821,14 @@ def import_batched_mp(return_dict, proc_num: int, batched_query: BatchedQuery, c
     :param batched_query:
     :param collection_name:
     :param on_duplicate:
+    :param metrics_dict: Optional Manager dict that receives this worker's metrics snapshot for merging in the parent.
+    :param writer: Optional writer(database, batch) -> response used instead of importBulk. Defaults to BULK_WRITERS[collection_name].
+        Either way writes go through a ResilientBulkWriter, so the writer must be all-or-nothing per call.
     :return:
     """
+    write = writer or BULK_WRITERS.get(collection_name)
+    # forked workers inherit the parent's counters, so start from zero and report only this worker's share
+    metrics.REGISTRY.reset()
     # if running in parallel, need independent connections
     connection = Connection(
         arangoURL=os.getenv('ARANGO_URL'),
@@ -246,16 +837,38 @@ def import_batched_mp(return_dict, proc_num: int, batched_query: BatchedQuery, c
     )
     database = connection['helium']
     collection = database[collection_name]
+    if write is not None:
+        resilient_writer = ResilientBulkWriter(collection_name, lambda batch: write(database, batch), idempotent=write not in ADDITIVE_WRITERS)
+    else:
+        resilient_writer = ResilientBulkWriter(collection_name, lambda batch: collection.importBulk(batch, onDuplicate=on_duplicate, complete=True, waitForSync=wait_for_sync(collection_name)))
     num_docs_imported = 0
-    while True:
-        batch = batched_query.get_next_batch()
-        if len(batch) > 0:
-            response = collection.importBulk(batch, onDuplicate=on_duplicate, waitForSync=True)
-            logging.info(f'Batch import response: {response}')
-            num_docs_imported += response['updated'] + response['created']
-        else:
-            break
+    # starts from the size the parent had learned for this collection when the worker was forked
+    sizer = batch_sizer(collection_name, batched_query.batch_size)
+    with profile_stage(f'{collection_name}_worker{proc_num}'):
+        while True:
+            if sizer is not None:
+                batched_query.set_batch_size(sizer.size)
+            requested_rows = batched_query.batch_size
+            now = time.time()
+            batch = batched_query.get_next_batch()
+            fetch_seconds = time.time() - now
+            metrics.record_fetch(collection.name, len(batch), fetch_seconds)
+            if len(batch) > 0:
+                now = time.time()
+                response = resilient_writer.write(batch)
+                import_seconds = time.time() - now
+                metrics.record_import(collection.name, response, import_seconds)
+                logging.debug(f'Batch import response: {response}')
+                num_docs_imported += response['updated'] + response['created']
+                if sizer is not None:
+                    sizer.observe(requested_rows, fetch_seconds, import_seconds, estimate_payload_bytes(batch))
+            else:
+                break
+    peak_rss = metrics.record_peak_rss(f'{collection_name}_worker{proc_num}')
+    logging.info(f'{collection_name} worker {proc_num} imported {num_docs_imported} documents (peak RSS {round(peak_rss / 2 ** 20)} MiB).')
     return_dict[proc_num] = num_docs_imported
+    if metrics_dict is not None:
+        metrics_dict[proc_num] = metrics.REGISTRY.snapshot()
 
 
 def update_batched(batched_query: BatchedQuery, database: Database) -> int:
@@ -294,24 +907,64 @@ def update_balances_batched(batched_query: BatchedQuery, database: Database) ->
     return num_docs_imported
 
 
+def open_collection_fingerprints(collection: Collection) -> Optional[FingerprintStore]:
+    """
+    The fingerprint store of a collection (None if disabled, see open_fingerprint_store), bound to it: fingerprints that
+    no longer describe its documents are cleared (see FingerprintStore.bind). The caller closes the store.
+    :param collection: The PyArango Collection object.
+    """
+    fingerprints = open_fingerprint_store(collection.name)
+    if fingerprints is not None:
+        try:
+            fingerprints.bind(f'{collection.database.name}/{getattr(collection, "globallyUniqueId", collection.id)}', collection.count())
+        except BaseException:
+            fingerprints.close()
+            raise
+    return fingerprints
+
+
+def import_fingerprinted(batched_query: BatchedQuery, collection: Collection) -> int:
+    fingerprints = open_collection_fingerprints(collection)
+    try:
+        return import_batched(batched_query, collection, on_duplicate='update', fingerprints=fingerprints)
+    finally:
+        if fingerprints is not None:
+            fingerprints.close()
+
+
 def import_accounts_batched(session: Session, batch_size: int, accounts: Collection) -> int:
     batched_query = AccountInventoryBatchedQuery(session, batch_size=batch_size)
-    return import_batched(batched_query, accounts, on_duplicate='update')
+    return import_fingerprinted(batched_query, accounts)
 
 
 def import_hotspots_batched(session: Session, batch_size: int, hotspots: Collection) -> int:
     batched_query = GatewayInventoryBatchedQuery(session, batch_size=batch_size)
-    return import_batched(batched_query, hotspots, on_duplicate='update')
+    return import_fingerprinted(batched_query, hotspots)
 
 
 def import_rewards_batched(session: Session, batch_size: int, hotspots: Collection, min_time: int, max_time: int) -> int:
     batched_query = GatewayRewardsBatchedQuery(session, batch_size, min_time, max_time)
-    return import_batched(batched_query, hotspots, on_duplicate='update')
+    return import_batched(batched_query, hotspots, sizer_key='rewards', writer=lambda database, batch: patch_documents(database, hotspots.name, 'rewards', batch))
+
+
+def import_reward_buckets_batched(session: Session, batch_size: int, reward_buckets: Collection, min_block: int, max_block: int, gateways: Optional[set] = None) -> int:
+    """
+    Add the rewards of the blocks in (min_block, max_block] to the reward buckets.
+    :param gateways: Optional set that receives the gateways whose buckets changed.
+    """
+    batched_query = RewardDaysBatchedQuery(session, batch_size, min_block, max_block)
+
+    def writer(database: Database, buckets: List[dict]) -> dict:
+        if gateways is not None:
+            gateways.update(bucket['gateway'] for bucket in buckets)
+        return add_reward_buckets(database, buckets)
 
+    return import_batched(batched_query, reward_buckets, writer=writer)
 
-def import_payments_batched(session: Session, batch_size: int, payments: Collection, min_time: int, max_time: int) -> int:
-    batched_query = RecentPaymentsBatchedQuery(session, batch_size, min_time, max_time)
-    return import_batched(batched_query, payments, on_duplicate='ignore')
+
+def import_payments_batched(session: Session, batch_size: int, payments: Collection, min_time: int, max_time: int, block_range: Optional[Tuple[int, int]] = None, partitioned: bool = False) -> int:
+    batched_query = payments_batched_query(session, batch_size, min_time, max_time, block_range=block_range)
+    return import_batched(batched_query, payments, on_duplicate='ignore', writer=import_payment_partitions if partitioned else None)
 
 
 def import_cities_batched(session: Session, batch_size: int, cities: Collection) -> int:
@@ -319,38 +972,166 @@ def import_cities_batched(session: Session, batch_size: int, cities: Collection)
     return import_batched(batched_query, cities, on_duplicate='ignore')
 
 
-def parallel_import_time_chunks(sessionmaker: sessionmaker, batch_size: int, collection_name: str, min_time: int, max_time: int, on_duplicate: str = 'ignore') -> int:
+def time_chunks(min_time: int, max_time: int, num_chunks: int) -> List[Tuple[int, int]]:
+    """
+    Split the (integer) times min_time < t < max_time into num_chunks contiguous ranges of nearly equal length, half-open
+    [start, end) with the last ending at max_time, so that every time falls in exactly one chunk.
+    :return: The chunks as (start - 1, end), the exclusive bounds taken by the time-range queries.
+    """
+    start, end = min_time + 1, max_time
+    bounds = [start + (end - start) * i // num_chunks for i in range(num_chunks + 1)]
+    return [(lower - 1, upper) for lower, upper in zip(bounds, bounds[1:])]
+
+
+def parallel_import_time_chunks(sessionmaker: sessionmaker, batch_size: int, collection_name: str, min_time: int, max_time: int, on_duplicate: str = 'ignore', writer: Callable = None) -> int:
     manager = Manager()
     return_dict = manager.dict()
+    metrics_dict = manager.dict()
     processes, sessions = [], []
     # naive domain decomposition...split up the time into equal segments
-    p_min_time, p_max_time = min_time, min_time + int((max_time - min_time) / cpu_count())
-    for i in range(cpu_count()):
+    sizer = batch_sizer(collection_name, batch_size)
+    if sizer is not None:
+        batch_size = sizer.size
+    for i, (p_min_time, p_max_time) in enumerate(time_chunks(min_time, max_time, cpu_count())):
         session = sessionmaker()
         if collection_name == 'payments':
-            batched_query = RecentPaymentsBatchedQuery(session, batch_size, p_min_time, p_max_time)
+            batched_query = payments_batched_query(session, batch_size, p_min_time, p_max_time)
         elif collection_name == 'witnesses':
-            batched_query = RecentWitnessesBatchedQuery(session, batch_size, p_min_time, p_max_time)
+            batched_query = witnesses_batched_query(session, batch_size, p_min_time, p_max_time)
         elif collection_name == 'balances':
             batched_query = DailyBalancesBatchedQuery(session.bind, batch_size, p_min_time, p_max_time)
         else:
             raise ValueError(f'Unexpected collection_name: {collection_name}')
         # ignore duplicates - going to assume that things will not change much over 5 days
-        p = Process(target=import_batched_mp, args=(return_dict, i, batched_query, collection_name, on_duplicate,))
+        p = Process(target=import_batched_mp, args=(return_dict, i, batched_query, collection_name, on_duplicate, metrics_dict, writer,))
         processes.append(p)
         sessions.append(session)
-        p_min_time = p_max_time
-        p_max_time += int((max_time - min_time) / cpu_count())
         p.start()
+    metrics.QUEUE_DEPTH.set(len(processes), collection=collection_name)
     for p in processes:
         p.join()
+        metrics.QUEUE_DEPTH.dec(collection=collection_name)
     for s in sessions:
         s.close()
+    for snapshot in metrics_dict.values():
+        metrics.REGISTRY.merge(snapshot)
+    # carry the size the workers converged on into the next cycle
+    sizer = batch_sizer(collection_name, batch_size)
+    if sizer is not None:
+        sizer.size = int(metrics.BATCH_SIZE.snapshot().get((collection_name,), sizer.size))
+    return sum(return_dict.values())
+
+
+# inventory collection -> (BatchedQuery class, column its key ranges split on, onDuplicate, fingerprinted)
+INVENTORY_QUERIES = {
+    'accounts': (AccountInventoryBatchedQuery, AccountInventory.address, 'update', True),
+    'hotspots': (GatewayInventoryBatchedQuery, GatewayInventory.address, 'update', True),
+    'cities': (CitiesBatchedQuery, Locations.location, 'ignore', False)
+}
+
+
+def import_key_range_mp(return_dict, proc_num: int, snapshot_id: str, collection_name: str, key_range: KeyRange, batch_size: int, metrics_dict=None):
+    """
+    Parallel target for importing one key range of an inventory table, reading from the snapshot shared by all workers.
+    :param return_dict: The multiprocessing Manager()'s dict destination for document counts.
+    :param proc_num: The worker index.
+    :param snapshot_id: The Postgres snapshot exported by the parent (see exported_snapshot).
+    :param collection_name: One of INVENTORY_QUERIES.
+    :param key_range: The (lower, upper) key range this worker scans.
+    :param batch_size: The initial batch size.
+    :param metrics_dict: Optional Manager dict that receives this worker's metrics snapshot for merging in the parent.
+    """
+    metrics.REGISTRY.reset()
+    query_class, _, on_duplicate, fingerprinted = INVENTORY_QUERIES[collection_name]
+    # if running in parallel, need independent connections
+    engine = create_engine(os.getenv('POSTGRES_URL'))
+    session = snapshot_session(engine, snapshot_id)
+    connection = Connection(
+        arangoURL=os.getenv('ARANGO_URL'),
+        username=os.getenv('ARANGO_USERNAME'),
+        password=os.getenv('ARANGO_PASSWORD')
+    )
+    collection = connection['helium'][collection_name]
+    fingerprints = open_fingerprint_store(collection_name) if fingerprinted else None
+    try:
+        with profile_stage(f'{collection_name}_worker{proc_num}'):
+            batched_query = query_class(session, batch_size, key_range=key_range)
+            return_dict[proc_num] = import_batched(batched_query, collection, on_duplicate=on_duplicate, fingerprints=fingerprints)
+    finally:
+        session.close()
+        engine.dispose()
+        if fingerprints is not None:
+            fingerprints.close()
+    metrics.record_peak_rss(f'{collection_name}_worker{proc_num}')
+    if metrics_dict is not None:
+        metrics_dict[proc_num] = metrics.REGISTRY.snapshot()
+
+
+def import_inventory_mp(sessionmaker: sessionmaker, batch_size: int, collection_name: str, num_workers: int) -> int:
+    """
+    Import an inventory table with num_workers processes, each scanning one contiguous key range. All workers read the
+    same exported REPEATABLE READ snapshot, so the result is the same as a serial scan.
+    :param sessionmaker: The SQLAlchemy sessionmaker.
+    :param batch_size: The initial batch size.
+    :param collection_name: One of INVENTORY_QUERIES.
+    :param num_workers: The number of worker processes (and key ranges).
+    :return: The number of documents written.
+    """
+    _, column, _, fingerprinted = INVENTORY_QUERIES[collection_name]
+    if fingerprinted:
+        # once, before the workers add to the store
+        connection = Connection(
+            arangoURL=os.getenv('ARANGO_URL'),
+            username=os.getenv('ARANGO_USERNAME'),
+            password=os.getenv('ARANGO_PASSWORD')
+        )
+        fingerprints = open_collection_fingerprints(connection['helium'][collection_name])
+        if fingerprints is not None:
+            fingerprints.close()
+        connection.disconnectSession()
+    manager = Manager()
+    return_dict = manager.dict()
+    metrics_dict = manager.dict()
+    sizer = batch_sizer(collection_name, batch_size)
+    if sizer is not None:
+        batch_size = sizer.size
+    session = sessionmaker()
+    try:
+        with exported_snapshot(session.bind) as snapshot_id:
+            key_ranges = get_key_ranges(session, column, num_workers)
+            processes = []
+            for i, key_range in enumerate(key_ranges):
+                p = Process(target=import_key_range_mp, args=(return_dict, i, snapshot_id, collection_name, key_range, batch_size, metrics_dict))
+                processes.append(p)
+                p.start()
+            metrics.QUEUE_DEPTH.set(len(processes), collection=collection_name)
+            # the snapshot must stay exported until every worker has imported it, so wait inside the transaction
+            for p in processes:
+                p.join()
+                metrics.QUEUE_DEPTH.dec(collection=collection_name)
+    finally:
+        session.close()
+    failed = [i for i, p in enumerate(processes) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'{collection_name} workers {failed} failed')
+    for snapshot in metrics_dict.values():
+        metrics.REGISTRY.merge(snapshot)
+    # carry the size the workers converged on into the next cycle
+    if sizer is not None:
+        sizer.size = int(metrics.BATCH_SIZE.snapshot().get((collection_name,), sizer.size))
     return sum(return_dict.values())
 
 
-def import_witnesses_batched(session: Session, batch_size: int, witnesses: Collection, min_time: int, max_time: int) -> int:
-    batched_query = RecentWitnessesBatchedQuery(session, batch_size, min_time, max_time)
+def witnesses_batched_query(session: Session, batch_size: int, min_time: int, max_time: int, block_range: Optional[Tuple[int, int]] = None) -> BatchedQuery:
+    """The witness link query selected by ETL_WITNESS_EXTRACT."""
+    # 'sql' unnests and aggregates the receipts in Postgres, 'python' decodes whole receipts here
+    if os.getenv('ETL_WITNESS_EXTRACT', 'sql').lower() == 'sql':
+        return WitnessLinksBatchedQuery(session, batch_size, min_time, max_time, block_range=block_range)
+    return RecentWitnessesBatchedQuery(session, batch_size, min_time, max_time, block_range=block_range)
+
+
+def import_witnesses_batched(session: Session, batch_size: int, witnesses: Collection, min_time: int, max_time: int, block_range: Optional[Tuple[int, int]] = None) -> int:
+    batched_query = witnesses_batched_query(session, batch_size, min_time, max_time, block_range)
     return import_batched(batched_query, witnesses, on_duplicate='ignore')
 
 
@@ -358,8 +1139,9 @@ def import_witnesses_mp(sessionmaker: sessionmaker, batch_size: int, min_time: i
     return parallel_import_time_chunks(sessionmaker, batch_size, 'witnesses', min_time, max_time)
 
 
-def import_payments_mp(sessionmaker: sessionmaker, batch_size: int, min_time: int, max_time: int) -> int:
-    return parallel_import_time_chunks(sessionmaker, batch_size, 'payments', min_time, max_time)
+def import_payments_mp(sessionmaker: sessionmaker, batch_size: int, min_time: int, max_time: int, partitioned: bool = False) -> int:
+    writer = import_payment_partitions if partitioned else None
+    return parallel_import_time_chunks(sessionmaker, batch_size, 'payments', min_time, max_time, writer=writer)
 
 
 def import_daily_balances_batched(sessionmaker: sessionmaker, batch_size: int, min_time: int, max_time: int) -> int:
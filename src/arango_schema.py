@@ -53,11 +53,20 @@ class HotspotCollection(COL.Collection):
         'mode': COL.Field(validators=[VAL.Enumeration(GatewayMode)]),
         'payer': COL.Field(validators=[VAL.String()]),
         'geo_location': COL.Field(),
+        'rewards_1d': COL.Field(validators=[VAL.Int()]),
         'rewards_5d': COL.Field(validators=[VAL.Int()]),
+        'rewards_30d': COL.Field(validators=[VAL.Int()]),
         'betweenness_centrality': COL.Field(validators=[VAL.Numeric()]),
         'pagerank': COL.Field(validators=[VAL.Numeric()]),
         'hub_score': COL.Field(validators=[VAL.Numeric()]),
-        'authority_score': COL.Field(validators=[VAL.Numeric()])
+        'authority_score': COL.Field(validators=[VAL.Numeric()]),
+        'in_degree': COL.Field(validators=[VAL.Int()]),
+        'out_degree': COL.Field(validators=[VAL.Int()]),
+        'reciprocal_ratio': COL.Field(validators=[VAL.Numeric()]),
+        'valid_ratio': COL.Field(validators=[VAL.Numeric()]),
+        'distance_p10': COL.Field(validators=[VAL.Numeric()]),
+        'distance_p50': COL.Field(validators=[VAL.Numeric()]),
+        'distance_p90': COL.Field(validators=[VAL.Numeric()])
     }
 
 
@@ -115,6 +124,48 @@ class CitiesCollection(COL.Collection):
     }
 
 
+class CityGraphsCollection(COL.Collection):
+
+    _validation = _validation_base
+
+    _fields = {
+        '_key': COL.Field(validators=[VAL.NotNull(), VAL.String()]),
+        'nodes': COL.Field(),
+        'edges': COL.Field(),
+        'num_nodes': COL.Field(validators=[VAL.Int()]),
+        'num_edges': COL.Field(validators=[VAL.Int()]),
+        'stale': COL.Field()
+    }
+
+
+class RewardBucketsCollection(COL.Collection):
+
+    _validation = _validation_base
+
+    _fields = {
+        '_key': COL.Field(validators=[VAL.NotNull(), VAL.String()]),
+        'gateway': COL.Field(validators=[VAL.NotNull(), VAL.String()]),
+        'day': COL.Field(validators=[VAL.NotNull(), VAL.Int()]),
+        'amount': COL.Field(validators=[VAL.NotNull(), VAL.Int()])
+    }
+
+
+class WorkUnitsCollection(COL.Collection):
+
+    _validation = _validation_base
+
+    _fields = {
+        '_key': COL.Field(validators=[VAL.NotNull(), VAL.String()]),
+        'job': COL.Field(validators=[VAL.NotNull(), VAL.String()]),
+        'from_block': COL.Field(validators=[VAL.NotNull(), VAL.Int()]),
+        'to_block': COL.Field(validators=[VAL.NotNull(), VAL.Int()]),
+        'state': COL.Field(validators=[VAL.NotNull(), VAL.String()]),
+        'owner': COL.Field(),
+        'lease_expires': COL.Field(),
+        'attempts': COL.Field()
+    }
+
+
 class WitnessEdges(COL.Edges):
 
     _validation = _validation_base
@@ -130,4 +181,37 @@ class WitnessEdges(COL.Edges):
         'datarate': COL.Field(validators=[VAL.String()]),
         'location': COL.Field(validators=[VAL.String()]),
         'timestamp': COL.Field(validators=[VAL.NotNull(), VAL.Int()]),
+        'is_valid': COL.Field(),
+        'distance_m': COL.Field(validators=[VAL.Numeric()]),
+        'bearing': COL.Field(validators=[VAL.Numeric()]),
+        'days': COL.Field(),
+        'stats_dirty': COL.Field(),
+        'observations': COL.Field(validators=[VAL.Int()]),
+        'valid_count': COL.Field(validators=[VAL.Int()]),
+        'invalid_count': COL.Field(validators=[VAL.Int()]),
+        'snr_mean': COL.Field(validators=[VAL.Numeric()]),
+        'snr_min': COL.Field(validators=[VAL.Numeric()]),
+        'snr_max': COL.Field(validators=[VAL.Numeric()]),
+        'signal_mean': COL.Field(validators=[VAL.Numeric()]),
+        'signal_min': COL.Field(validators=[VAL.Int()]),
+        'signal_max': COL.Field(validators=[VAL.Int()]),
+        'first_seen': COL.Field(validators=[VAL.Int()]),
+        'last_seen': COL.Field(validators=[VAL.Int()]),
+    }
+
+
+class TokenFlowEdges(COL.Edges):
+
+    _validation = _validation_base
+
+    _fields = {
+        '_key': COL.Field(validators=[VAL.NotNull(), VAL.String()]),
+        '_from': COL.Field(validators=[VAL.NotNull(), VAL.String()]),
+        '_to': COL.Field(validators=[VAL.NotNull(), VAL.String()]),
+        'bucket': COL.Field(validators=[VAL.NotNull(), VAL.String()]),
+        'bucket_start': COL.Field(validators=[VAL.NotNull(), VAL.Int()]),
+        'count': COL.Field(validators=[VAL.NotNull(), VAL.Int()]),
+        'total_amount': COL.Field(validators=[VAL.NotNull(), VAL.Numeric()]),
+        'min_time': COL.Field(validators=[VAL.NotNull(), VAL.Int()]),
+        'max_time': COL.Field(validators=[VAL.NotNull(), VAL.Int()])
     }
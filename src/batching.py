@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+import metrics
+
+# documents serialized to estimate the payload size of a batch
+_PAYLOAD_SAMPLE_SIZE = 20
+
+
+def estimate_payload_bytes(batch: List[dict]) -> int:
+    """Approximate JSON size of a batch, extrapolated from a sample so that large batches are not serialized twice."""
+    if not batch:
+        return 0
+    sample = batch[:_PAYLOAD_SAMPLE_SIZE]
+    return int(len(json.dumps(sample, default=str)) * len(batch) / len(sample))
+
+
+class AdaptiveBatchSizer(object):
+    """
+    Tunes the batch size of one collection so that a batch (Postgres fetch + Arango import) takes about target_seconds and
+    its payload stays under max_bytes. Costs are tracked per requested source row with an exponential moving average, and
+    each step at most halves or doubles the size.
+    """
+    def __init__(self, collection: str, initial_size: int, min_size: int, max_size: int, target_seconds: float, max_bytes: int, smoothing: float = 0.3):
+        self.collection = collection
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.smoothing = smoothing
+        self.seconds_per_row = None
+        self.bytes_per_row = None
+        self.size = self._clamp(initial_size)
+        metrics.BATCH_SIZE.set(self.size, collection=collection)
+
+    def _clamp(self, size: float) -> int:
+        return int(min(max(size, self.min_size), self.max_size))
+
+    def _average(self, previous: Optional[float], value: float) -> float:
+        return value if previous is None else self.smoothing * value + (1 - self.smoothing) * previous
+
+    def observe(self, requested_rows: int, fetch_seconds: float, import_seconds: float, payload_bytes: int) -> int:
+        """
+        Record one batch and return the size to request next.
+        :param requested_rows: The batch size that was requested for this batch.
+        :param fetch_seconds: Time spent fetching and transforming the batch.
+        :param import_seconds: Time spent importing the batch.
+        :param payload_bytes: The (estimated) JSON size of the batch.
+        """
+        if requested_rows <= 0:
+            return self.size
+        self.seconds_per_row = self._average(self.seconds_per_row, (fetch_seconds + import_seconds) / requested_rows)
+        self.bytes_per_row = self._average(self.bytes_per_row, payload_bytes / requested_rows)
+        desired = self.target_seconds / max(self.seconds_per_row, 1e-9)
+        if self.bytes_per_row > 0:
+            desired = min(desired, self.max_bytes / self.bytes_per_row)
+        previous = self.size
+        self.size = self._clamp(min(max(desired, previous / 2), previous * 2))
+        metrics.BATCH_SIZE.set(self.size, collection=self.collection)
+        if abs(self.size - previous) > 0.1 * previous:
+            logging.info(f'{self.collection}: batch size {previous} -> {self.size} '
+                         f'(fetch {round(fetch_seconds, 2)} s, import {round(import_seconds, 2)} s, ~{payload_bytes} bytes for {requested_rows} rows)')
+        return self.size
+
+
+# one sizer per collection and process, so that what was learned carries over to the next sync cycle
+_sizers: Dict[str, AdaptiveBatchSizer] = {}
+
+
+def batch_sizer(collection: str, initial_size: int) -> Optional[AdaptiveBatchSizer]:
+    """
+    Returns the adaptive sizer for collection, or None if ETL_ADAPTIVE_BATCH_SIZE is disabled (static batch sizes).
+    Bounds and targets come from ETL_BATCH_MIN_SIZE, ETL_BATCH_MAX_SIZE, ETL_BATCH_TARGET_SEC and ETL_BATCH_MAX_BYTES.
+    """
+    if os.getenv('ETL_ADAPTIVE_BATCH_SIZE', 'true').lower() not in ('1', 'true', 'yes'):
+        return None
+    if collection not in _sizers:
+        _sizers[collection] = AdaptiveBatchSizer(
+            collection,
+            initial_size,
+            min_size=int(os.getenv('ETL_BATCH_MIN_SIZE', '100')),
+            max_size=int(os.getenv('ETL_BATCH_MAX_SIZE', '20000')),
+            target_seconds=float(os.getenv('ETL_BATCH_TARGET_SEC', '2')),
+            max_bytes=int(os.getenv('ETL_BATCH_MAX_BYTES', str(16 * 2 ** 20)))
+        )
+    return _sizers[collection]
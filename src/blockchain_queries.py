@@ -1,17 +1,17 @@
 from blockchain_tables import *
 import json
 from sqlalchemy.orm import Session, Query
-from sqlalchemy import and_
-from sqlalchemy.sql import func
-from typing import List, Dict, Union
+from sqlalchemy import and_, cast, BigInteger
+from sqlalchemy.sql import func, text
+from typing import List, Dict, Iterator, Optional, Tuple, Union
+from contextlib import contextmanager
+import sys
 from datetime import datetime, timedelta
-import h3
 from hashlib import md5
+from geo import HOTSPOT_COORDINATES, city_key, h3_to_geo_locations
+from copy_extract import CopyStream, extract_mode
 from sqlalchemy.engine import Engine
-import logging
-
-
-logging.basicConfig(filename='../logs/etl.log', encoding='utf-8', level=logging.INFO)
+import os
 
 
 def get_result_batch(query: Query, slice_start: int, slice_end: int):
@@ -23,6 +23,20 @@ def get_block_by_timestamp(session: Session, timestamp: int) -> int:
     return result.one()[0]
 
 
+def get_blocks_after(session: Session, height: int, limit: int) -> List[Tuple[int, int]]:
+    """The (height, time) of up to limit blocks after height, in order."""
+    result = session.query(Blocks.height, Blocks.time).filter(Blocks.height > height).order_by(Blocks.height).limit(limit)
+    return [tuple(row) for row in result.all()]
+
+
+def get_block_range(session: Session, min_time: int, max_time: int) -> Tuple[int, int]:
+    """The (min_block, max_block] range (see filter_block_range) of the blocks with min_time < time < max_time."""
+    result = session.query(func.min(Blocks.height), func.max(Blocks.height)).filter(and_(Blocks.time > min_time, Blocks.time < max_time)).one()
+    if result[0] is None:
+        return 0, 0
+    return result[0] - 1, result[1]
+
+
 def get_current_height(session: Session) -> int:
     result = session.query(Blocks.height).order_by(Blocks.height.desc()).limit(1)
     return result.one()[0]
@@ -50,6 +64,71 @@ def get_accounts(session: Session) -> List[Dict]:
     return accounts
 
 
+# half-open [lower, upper) range of primary key values; None leaves that end unbounded
+KeyRange = Tuple[Optional[str], Optional[str]]
+
+
+def filter_key_range(query: Query, column, key_range: Optional[KeyRange]) -> Query:
+    """Restrict query to rows whose column value falls in key_range (no-op for None)."""
+    if key_range is None:
+        return query
+    lower, upper = key_range
+    if lower is not None:
+        query = query.filter(column >= lower)
+    if upper is not None:
+        query = query.filter(column < upper)
+    return query
+
+
+def get_key_ranges(session: Session, column, num_ranges: int) -> List[KeyRange]:
+    """
+    Split the values of a (primary key) column into num_ranges contiguous ranges of about equal row counts, using ntile.
+    The first and last ranges are unbounded, so together the ranges cover every row no matter what is inserted later.
+    :param session: The SQLAlchemy session.
+    :param column: The ORM column to split on, e.g. AccountInventory.address.
+    :param num_ranges: The number of ranges wanted (fewer are returned for small tables).
+    :return: The list of (lower, upper) ranges, in key order.
+    """
+    tiles = session.query(column.label('key'), func.ntile(num_ranges).over(order_by=column).label('tile')).subquery()
+    starts = [row[0] for row in session.query(func.min(tiles.c.key)).group_by(tiles.c.tile).order_by(func.min(tiles.c.key))]
+    bounds = [None] + starts[1:] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+@contextmanager
+def exported_snapshot(engine: Engine) -> Iterator[str]:
+    """
+    Opens a REPEATABLE READ transaction and exports its snapshot, so that other connections can read exactly the same data
+    with snapshot_session(). The snapshot can only be imported while this context is open.
+    :param engine: The SQLAlchemy engine.
+    :return: The snapshot id.
+    """
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='REPEATABLE READ')
+        with connection.begin():
+            yield connection.execute(text('SELECT pg_export_snapshot()')).scalar()
+
+
+def snapshot_session(engine: Engine, snapshot_id: str) -> Session:
+    """
+    A session whose transaction reads from a snapshot exported with exported_snapshot().
+    :param engine: The SQLAlchemy engine.
+    :param snapshot_id: The exported snapshot id.
+    """
+    session = Session(bind=engine)
+    session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+    # must be the first statement of the transaction
+    session.execute(text('SET TRANSACTION SNAPSHOT :snapshot_id'), {'snapshot_id': snapshot_id})
+    return session
+
+
+def filter_block_range(query: Query, column, block_range: Optional[Tuple[int, int]]) -> Query:
+    """Restrict query to rows whose block column falls in the half-open range (min_block, max_block] (no-op for None)."""
+    if block_range is None:
+        return query
+    return query.filter(and_(column > block_range[0], column <= block_range[1]))
+
+
 class BatchedQuery(object):
     """
     Base class for batched queries for scalability. It is critical that you ensure that query results are deterministic, e.g. order_by [PK].
@@ -60,24 +139,46 @@ class BatchedQuery(object):
         self.slice_start = 0
         self.slice_end = batch_size
         self.query_complete = False
+        # ETL_EXTRACT_MODE=copy streams the query with COPY instead of slicing it (subclasses opt in through fetch_rows)
+        self.extract_mode = extract_mode()
+        self.copy_stream = None
 
     def _update_slice(self):
         self.slice_start = self.slice_end
         self.slice_end += self.batch_size
 
+    def set_batch_size(self, batch_size: int):
+        """Change the size of the next batch (and the ones after it)."""
+        self.batch_size = batch_size
+        self.slice_end = self.slice_start + batch_size
+
+    def fetch_rows(self) -> list:
+        """The rows of the next batch: the next slice of the query, or the next batch_size rows of its COPY stream."""
+        if self.extract_mode == 'copy':
+            if self.copy_stream is None:
+                self.copy_stream = CopyStream(self.query)
+            return self.copy_stream.read(self.batch_size)
+        return self.query.slice(self.slice_start, self.slice_end).all()
+
     def get_next_batch(self) -> Union[List[Dict], List]:
         pass
 
 
+def entity_dict(entity) -> dict:
+    """Columns of a mapped row, which the COPY extract mode already returns as a dict."""
+    return entity if isinstance(entity, dict) else entity.as_dict()
+
+
 class AccountInventoryBatchedQuery(BatchedQuery):
-    def __init__(self, session: Session, batch_size: int):
-        query = session.query(AccountInventory).order_by(AccountInventory.address) # order_by necessary for deterministic result
+    def __init__(self, session: Session, batch_size: int, key_range: Optional[KeyRange] = None):
+        query = filter_key_range(session.query(AccountInventory), AccountInventory.address, key_range)
+        query = query.order_by(AccountInventory.address) # order_by necessary for deterministic result
         super().__init__(batch_size, query)
 
     def get_next_batch(self) -> Union[List[Dict], List]:
         accounts = []
-        for row in self.query.slice(self.slice_start, self.slice_end):
-            account = row.as_dict()
+        for row in self.fetch_rows():
+            account = entity_dict(row)
             account['_key'] = account['address']
             accounts.append(account)
         if len(accounts) == 0:
@@ -88,9 +189,10 @@ class AccountInventoryBatchedQuery(BatchedQuery):
 
 
 class CitiesBatchedQuery(BatchedQuery):
-    def __init__(self, session: Session, batch_size: int):
+    def __init__(self, session: Session, batch_size: int, key_range: Optional[KeyRange] = None):
+        query = session.query(Locations.city_id, Locations.long_city, Locations.long_state, Locations.long_country)
         # order_by necessary for deterministic result
-        query = session.query(Locations.city_id, Locations.long_city, Locations.long_state, Locations.long_country).distinct().order_by(Locations.location)
+        query = filter_key_range(query, Locations.location, key_range).distinct().order_by(Locations.location)
         super().__init__(batch_size, query)
 
     def get_next_batch(self) -> Union[List[Dict], List]:
@@ -98,7 +200,7 @@ class CitiesBatchedQuery(BatchedQuery):
         for row in self.query.slice(self.slice_start, self.slice_end):
             (city_id, long_city, long_state, long_country) = row
             city = {
-                '_key': md5(city_id.encode('utf-8')).hexdigest(),
+                '_key': city_key(city_id),
                 'city_id': city_id,
                 'long_city': long_city,
                 'long_state': long_state,
@@ -121,47 +223,45 @@ def get_hotspots(session: Session, include_key: bool = True, h3_to_geo: bool = T
         gateway['status'] = status
         if include_key:
             gateway['_key'] = gateway['address']
-        if h3_to_geo:
-            try:
-                gateway['geo_location'] = {'coordinates': h3.h3_to_geo(gateway['location_hex'])[::-1], 'type': 'Point'}
-            except TypeError:
-                gateway['geo_location'] = {'coordinates': None, 'type': 'Point'}
         # initialize extra fields as null
         gateway['rewards_5d'], gateway['betweenness_centrality'], gateway['pagerank'], gateway['hub_score'], gateway['authority_score'] = None, None, None, None, None
         gateways.append(gateway)
+    if h3_to_geo:
+        for gateway, geo_location in zip(gateways, h3_to_geo_locations(g['location_hex'] for g in gateways)):
+            gateway['geo_location'] = geo_location
     return gateways
 
 
+def get_hotspot_locations(session: Session) -> List[Tuple[str, Optional[str]]]:
+    """(address, location_hex) of every hotspot, e.g. to load HOTSPOT_COORDINATES."""
+    return session.query(GatewayInventory.address, GatewayInventory.location_hex).all()
+
+
 class GatewayInventoryBatchedQuery(BatchedQuery):
-    def __init__(self, session: Session, batch_size: int):
+    def __init__(self, session: Session, batch_size: int, key_range: Optional[KeyRange] = None):
         q1 = session.query(GatewayInventory, GatewayStatus.online, Locations.city_id, Locations.long_city, Locations.long_state, Locations.long_country)
         q2 = q1.outerjoin(GatewayStatus, GatewayInventory.address == GatewayStatus.address)
-        query = q2.outerjoin(Locations, GatewayInventory.location == Locations.location).order_by(GatewayInventory.address)
+        q3 = q2.outerjoin(Locations, GatewayInventory.location == Locations.location)
+        query = filter_key_range(q3, GatewayInventory.address, key_range).order_by(GatewayInventory.address)
         super().__init__(batch_size, query)
 
     def get_next_batch(self) -> Union[List[Dict], List]:
         gateways = []
-        for row in self.query.slice(self.slice_start, self.slice_end):
+        for row in self.fetch_rows():
             (gateway_inventory, status, city_id, long_city, long_state, long_country) = row
-            gateway = gateway_inventory.as_dict()
+            gateway = entity_dict(gateway_inventory)
             gateway['status'] = status
             gateway['_key'] = gateway['address']
-            try:
-                gateway['geo_location'] = {'coordinates': h3.h3_to_geo(gateway['location_hex'])[::-1], 'type': 'Point'}
-            except TypeError:
-                gateway['geo_location'] = {'coordinates': None, 'type': 'Point'}
             gateway['location_details'] = {'city_id': city_id,
                                            'long_city': long_city,
                                            'long_state': long_state,
-                                           'long_country': long_country}
-            if city_id:
-                gateway['location_details']['city_key'] = md5(city_id.encode('utf-8')).hexdigest() # get rid of illegal characters in some city id's
-            else:
-                gateway['location_details']['city_key'] = None
-            # initialize extra fields as null
-            gateway['rewards_5d'], gateway['betweenness_centrality'], gateway['pagerank'], gateway['hub_score'], gateway[
-                'authority_score'] = None, None, None, None, None
+                                           'long_country': long_country,
+                                           'city_key': city_key(city_id)}
+            # derived fields (rewards, graph metrics) are left to their writers, see PATCH_FIELDS
             gateways.append(gateway)
+        # convert the whole column at once so repeated hexes are only resolved once
+        for gateway, geo_location in zip(gateways, h3_to_geo_locations(g['location_hex'] for g in gateways)):
+            gateway['geo_location'] = geo_location
         if len(gateways) == 0:
             self.query_complete = True
         else:
@@ -202,11 +302,16 @@ class GatewayRewardsBatchedQuery(BatchedQuery):
         super().__init__(batch_size, query)
 
     def get_next_batch(self) -> Union[List[Dict], List]:
-        # windowed range queries faster than slices
-        self.query = self.session.query(Rewards.gateway, func.sum(Rewards.amount)).where(and_(Rewards.time > self.min_time, Rewards.time < self.max_time, Rewards.gateway > self.last_address)).group_by(
-            Rewards.gateway).order_by(Rewards.gateway)
+        if self.extract_mode == 'copy':
+            # a single COPY of the whole aggregate, read in batches
+            result = self.fetch_rows()
+        else:
+            # windowed range queries faster than slices
+            self.query = self.session.query(Rewards.gateway, func.sum(Rewards.amount)).where(and_(Rewards.time > self.min_time, Rewards.time < self.max_time, Rewards.gateway > self.last_address)).group_by(
+                Rewards.gateway).order_by(Rewards.gateway)
+            result = self.query.all()
         rewards = []
-        for reward in self.query.all():
+        for reward in result:
             rewards.append({'_key': reward[0], 'rewards_5d': reward[1]})
         if len(rewards) == 0:
             self.query_complete = True
@@ -216,6 +321,41 @@ class GatewayRewardsBatchedQuery(BatchedQuery):
         return rewards
 
 
+class RewardDaysBatchedQuery(BatchedQuery):
+    """
+    Per-gateway, per-UTC-day reward sums for the blocks in (min_block, max_block], streamed through a server-side cursor
+    (or COPY, see ETL_EXTRACT_MODE) so that the aggregate is computed once rather than once per batch. Each bucket carries
+    the block range it sums (see add_reward_buckets).
+    """
+    def __init__(self, session: Session, batch_size: int, min_block: int, max_block: int):
+        self.min_block = min_block
+        self.max_block = max_block
+        day = (Rewards.time / 86400).label('day')
+        query = session.query(Rewards.gateway, day, cast(func.sum(Rewards.amount), BigInteger)).filter(
+            and_(Rewards.block > min_block, Rewards.block <= max_block)).group_by(Rewards.gateway, day).order_by(Rewards.gateway, day)
+        self.session = session
+        self.result = None
+        super().__init__(batch_size, query)
+
+    def get_next_batch(self) -> Union[List[Dict], List]:
+        if self.extract_mode == 'copy':
+            rows = self.fetch_rows()
+        else:
+            if self.result is None:
+                self.result = self.session.execute(self.query.statement, execution_options={'stream_results': True})
+            rows = self.result.fetchmany(self.batch_size)
+        buckets = []
+        for (gateway, day, amount) in rows:
+            buckets.append({'_key': f'{gateway}-{day}', 'gateway': gateway, 'day': day, 'amount': amount, 'min_block': self.min_block, 'max_block': self.max_block})
+        if len(buckets) == 0:
+            self.query_complete = True
+            if self.result is not None:
+                self.result.close()
+        else:
+            self._update_slice()
+        return buckets
+
+
 def get_recent_payments(session: Session, min_time: int, max_time: int, transaction_type: TransactionType = TransactionType.payment_v1) -> List[Dict]:
     result = session.query(Transactions.fields, Transactions.time).filter(and_(Transactions.time > min_time, Transactions.time < max_time, Transactions.type == transaction_type))
     payments = []
@@ -230,93 +370,306 @@ def get_recent_payments(session: Session, min_time: int, max_time: int, transact
     return payments
 
 
+PAYMENT_TYPES = ('payment_v1', 'payment_v2')
+
+
+def payment_edges(fields: dict, time: int) -> List[dict]:
+    """
+    The payments edges of a payment_v1 or payment_v2 transaction, one per payee. Edges are keyed by a hash of the
+    transaction fields (so that re-imports do not double-count); the n-th payee of a payment_v2 after the first gets
+    the suffix -n, so the first keeps the key it had when only one payee was recorded.
+    :param fields: The transaction's fields.
+    :param time: The transaction's (block) time.
+    """
+    payment_hash = md5(json.dumps(fields).encode()).hexdigest()
+    if 'payments' not in fields:
+        # payment_v1 structure
+        return [{'_key': payment_hash, '_from': 'accounts/' + fields['payer'], '_to': 'accounts/' + fields['payee'], 'amount': fields['amount'], 'time': time}]
+    return [{'_key': payment_hash if i == 0 else f'{payment_hash}-{i}',
+             '_from': 'accounts/' + fields['payer'],
+             '_to': 'accounts/' + payment['payee'],
+             'amount': payment['amount'],
+             'time': time}
+            for i, payment in enumerate(fields['payments'])]
+
+
+def payments_batched_query(session: Session, batch_size: int, min_time: int, max_time: int, block_range: Optional[Tuple[int, int]] = None) -> 'BatchedQuery':
+    """
+    The payments extraction selected by ETL_PAYMENT_EXTRACT: 'scan' (transactions by time and type, the default) or
+    'actors' (transaction_actors payer rows by block, see ActorPaymentsBatchedQuery). Both produce the same edges.
+    """
+    mode = os.getenv('ETL_PAYMENT_EXTRACT', 'scan').lower()
+    if mode == 'actors':
+        return ActorPaymentsBatchedQuery(session, batch_size, block_range or get_block_range(session, min_time, max_time))
+    if mode != 'scan':
+        raise ValueError(f'Unexpected ETL_PAYMENT_EXTRACT: {mode}')
+    return RecentPaymentsBatchedQuery(session, batch_size, min_time, max_time, block_range=block_range)
+
+
 class RecentPaymentsBatchedQuery(BatchedQuery):
-    def __init__(self, session: Session, batch_size: int, min_time: int, max_time: int):
-        q1 = session.query(Transactions.fields, Transactions.time).filter(and_(Transactions.time > min_time, Transactions.time < max_time, Transactions.type.in_(('payment_v1', 'payment_v2'))))
-        query = q1.order_by(Transactions.time, Transactions.hash)
+    def __init__(self, session: Session, batch_size: int, min_time: int, max_time: int, block_range: Optional[Tuple[int, int]] = None):
+        q1 = session.query(Transactions.fields, Transactions.time).filter(and_(Transactions.time > min_time, Transactions.time < max_time, Transactions.type.in_(PAYMENT_TYPES)))
+        query = filter_block_range(q1, Transactions.block, block_range).order_by(Transactions.time, Transactions.hash)
         super().__init__(batch_size, query)
 
     def get_next_batch(self) -> Union[List[Dict], List]:
         payments = []
-        for row in self.query.slice(self.slice_start, self.slice_end):
-            # need a unique key so that this payment is not double-counted
-            payment_hash = md5(json.dumps(row[0]).encode()).hexdigest()
-            try:
-                # payment_v1 structure
-                payments.append({'_key': payment_hash,
-                                 '_from': 'accounts/' + row[0]['payer'],
-                                 '_to': 'accounts/' + row[0]['payee'],
-                                 'amount': row[0]['amount'],
-                                 'time': row[1]})
-            except KeyError:
-                # payment_v2 slightly different
-                payments.append({'_key': payment_hash,
-                                 '_from': 'accounts/' + row[0]['payer'],
-                                 '_to': 'accounts/' + row[0]['payments'][0]['payee'],
-                                 'amount': row[0]['payments'][0]['amount'],
-                                 'time': row[1]})
-        if len(payments) == 0:
+        num_rows = 0
+        for row in self.fetch_rows():
+            payments.extend(payment_edges(row[0], row[1]))
+            num_rows += 1
+        if num_rows == 0:
             self.query_complete = True
         else:
             self._update_slice()
         return payments
 
 
+class ActorPaymentsBatchedQuery(RecentPaymentsBatchedQuery):
+    """
+    Payments found through the payer rows of transaction_actors in a block range, which uses the actors' block index
+    instead of scanning transactions by time and filtering on type. Produces the same edges as RecentPaymentsBatchedQuery.
+    """
+    def __init__(self, session: Session, batch_size: int, block_range: Tuple[int, int]):
+        q1 = session.query(Transactions.fields, Transactions.time).join(TransactionActors, TransactionActors.transaction_hash == Transactions.hash)
+        q2 = q1.filter(and_(TransactionActors.actor_role == TransactionActorRole.payer, Transactions.type.in_(PAYMENT_TYPES)))
+        # both block columns are bounded so that either side of the join can be driven by its block index
+        q3 = filter_block_range(filter_block_range(q2, TransactionActors.block, block_range), Transactions.block, block_range)
+        query = q3.order_by(TransactionActors.block, TransactionActors.transaction_hash)
+        BatchedQuery.__init__(self, batch_size, query)
+
+
+class WitnessObservation(object):
+    """
+    Compact record of one challengee -> witness observation from a poc_receipts_v1 transaction. Only the fields we store
+    are kept, hotspot addresses are interned, and the Arango edge dict is only built by to_document() at import time.
+    """
+    __slots__ = ('challengee', 'witness', 'time', 'timestamp', 'snr', 'signal', 'frequency', 'datarate', 'location', 'is_valid')
+
+    def __init__(self, challengee: str, time: int, witness: dict):
+        self.challengee = sys.intern(challengee)
+        self.witness = sys.intern(witness['gateway'])
+        self.time = time
+        self.timestamp = witness.get('timestamp')
+        self.snr = witness.get('snr')
+        self.signal = witness.get('signal')
+        self.frequency = witness.get('frequency')
+        self.datarate = sys.intern(witness['datarate']) if witness.get('datarate') else None
+        self.location = sys.intern(witness['location']) if witness.get('location') else None
+        self.is_valid = witness.get('is_valid')
+
+    @classmethod
+    def from_columns(cls, challengee: str, witness: str, time: int, timestamp: int, snr: float, signal: int, frequency: float, datarate: str, location: str, is_valid: bool) -> 'WitnessObservation':
+        """Build an observation from already projected columns (see WitnessLinksBatchedQuery)."""
+        observation = cls.__new__(cls)
+        observation.challengee = sys.intern(challengee)
+        observation.witness = sys.intern(witness)
+        observation.time = time
+        observation.timestamp = timestamp
+        observation.snr = snr
+        observation.signal = signal
+        observation.frequency = frequency
+        observation.datarate = sys.intern(datarate) if datarate else None
+        observation.location = sys.intern(location) if location else None
+        observation.is_valid = is_valid
+        return observation
+
+    @property
+    def pair(self) -> Tuple[str, str]:
+        return self.challengee, self.witness
+
+    def to_document(self) -> dict:
+        # give each path of challengee -> witness a unique hash so that we can simply replace in arango
+        return {
+            '_key': md5((self.challengee + self.witness).encode()).hexdigest(),
+            '_from': 'hotspots/' + self.challengee,
+            '_to': 'hotspots/' + self.witness,
+            'time': self.time,
+            'timestamp': self.timestamp,
+            'snr': self.snr,
+            'signal': self.signal,
+            'frequency': self.frequency,
+            'datarate': self.datarate,
+            'location': self.location,
+            'is_valid': self.is_valid
+        }
+
+
+def witness_observations(time: int, fields: dict) -> List[WitnessObservation]:
+    """Unpacks the witnesses of a poc_receipts_v1 transaction's fields into compact observations."""
+    challengee = fields['path'][0]['challengee']
+    return [WitnessObservation(challengee, time, witness) for witness in fields['path'][0]['witnesses']]
+
+
+def new_witness_day_stats() -> dict:
+    return {'count': 0, 'valid': 0, 'invalid': 0,
+            'snr_n': 0, 'snr_sum': 0.0, 'snr_min': None, 'snr_max': None,
+            'signal_n': 0, 'signal_sum': 0, 'signal_min': None, 'signal_max': None,
+            'first_seen': None, 'last_seen': None}
+
+
+def add_witness_observation(stats: dict, observation: WitnessObservation):
+    """Accumulate one observation into a per-link, per-day statistics bucket (see new_witness_day_stats)."""
+    stats['count'] += 1
+    if observation.is_valid:
+        stats['valid'] += 1
+    else:
+        stats['invalid'] += 1
+    for field in ('snr', 'signal'):
+        value = getattr(observation, field)
+        if value is not None:
+            stats[f'{field}_n'] += 1
+            stats[f'{field}_sum'] += value
+            stats[f'{field}_min'] = value if stats[f'{field}_min'] is None else min(stats[f'{field}_min'], value)
+            stats[f'{field}_max'] = value if stats[f'{field}_max'] is None else max(stats[f'{field}_max'], value)
+    stats['first_seen'] = observation.time if stats['first_seen'] is None else min(stats['first_seen'], observation.time)
+    stats['last_seen'] = observation.time if stats['last_seen'] is None else max(stats['last_seen'], observation.time)
+
+
+def aggregate_witness_links(observations: List[WitnessObservation]) -> List[dict]:
+    """
+    Collapse observations into one edge document per challengee -> witness link. Each edge carries the fields of its latest
+    observation plus 'days', a map of UTC day number (time // 86400) -> statistics bucket, which is merged into the stored
+    edge so that rolling link statistics can be maintained incrementally.
+    """
+    links = {}
+    for observation in observations:
+        link = links.get(observation.pair)
+        if link is None:
+            link = links[observation.pair] = [observation, {}]
+        elif observation.time > link[0].time:
+            link[0] = observation
+        day = str(observation.time // 86400)
+        if day not in link[1]:
+            link[1][day] = new_witness_day_stats()
+        add_witness_observation(link[1][day], observation)
+    documents = []
+    for latest, days in links.values():
+        document = latest.to_document()
+        document['days'] = days
+        documents.append(document)
+    HOTSPOT_COORDINATES.annotate_links(documents)
+    return documents
+
+
 def get_recent_witnesses(session: Session, min_time: int, max_time: int):
     query = session.query(Transactions.time, Transactions.fields)
     # work backwards in time so that we only end up with the most recent version of a given witness path
     result = query.filter(and_(Transactions.time > min_time, Transactions.time < max_time, Transactions.type == 'poc_receipts_v1')).order_by(Transactions.time.desc())
-    unique_edges = []
-    witnesses = []
-    for row in result.all():
+    latest = {}
+    for row in result.yield_per(1000):
         (time, fields) = row
-        challengee = fields['path'][0]['challengee']
-        for witness in fields['path'][0]['witnesses']:
-            # give each path of challengee -> witness a unique hash so that we can simply replace in arango
-            edge_hash = md5((challengee+witness['gateway']).encode()).hexdigest()
-            if edge_hash not in unique_edges:
-                # get all the relevant details and package in arango conventions for edges
-                edge = {
-                    '_key': edge_hash,
-                    '_from': 'hotspots/' + challengee,
-                    '_to': 'hotspots/' + witness['gateway'],
-                    'time': time
-                }
-                # flip the order so that we can replace old versions of a witness path with new ones
-                witnesses.insert(0, {**edge, **witness}) # Python 3.5+ syntax
-                unique_edges.append(edge_hash)
-    return witnesses
+        for observation in witness_observations(time, fields):
+            if observation.pair not in latest:
+                latest[observation.pair] = observation
+    # oldest first so that we can replace old versions of a witness path with new ones
+    return [observation.to_document() for observation in reversed(list(latest.values()))]
 
 
 class RecentWitnessesBatchedQuery(BatchedQuery):
-    def __init__(self, session: Session, batch_size: int, min_time: int, max_time: int):
+    def __init__(self, session: Session, batch_size: int, min_time: int, max_time: int, block_range: Optional[Tuple[int, int]] = None):
         query1 = session.query(Transactions.time, Transactions.fields)
+        query2 = filter_block_range(query1.filter(and_(Transactions.time > min_time, Transactions.time < max_time, Transactions.type == 'poc_receipts_v1')), Transactions.block, block_range)
         # work backwards in time so that we only end up with the most recent version of a given witness path
-        query = query1.filter(and_(Transactions.time > min_time, Transactions.time < max_time, Transactions.type == 'poc_receipts_v1')).order_by(
-            Transactions.time.desc(), Transactions.hash)
+        query = query2.order_by(Transactions.time.desc(), Transactions.hash)
         super().__init__(batch_size, query)
 
-    def get_next_batch(self) -> Union[List[Dict], List]:
-        witnesses = []
+    def get_next_observations(self) -> List[WitnessObservation]:
+        observations = []
+        num_rows = 0
         for row in self.query.slice(self.slice_start, self.slice_end):
             (time, fields) = row
-            challengee = fields['path'][0]['challengee']
-            for witness in fields['path'][0]['witnesses']:
-                # give each path of challengee -> witness a unique hash so that we can simply replace in arango
-                edge_hash = md5((challengee + witness['gateway']).encode()).hexdigest()
-                # get all the relevant details and package in arango conventions for edges
-                edge = {
-                    '_key': edge_hash,
-                    '_from': 'hotspots/' + challengee,
-                    '_to': 'hotspots/' + witness['gateway'],
-                    'time': time
-                }
-                witnesses.append({**edge, **witness})
-        if len(witnesses) == 0:
+            observations.extend(witness_observations(time, fields))
+            num_rows += 1
+        # a slice of receipts can legitimately contain no witnesses, so completion is judged on rows rather than edges
+        if num_rows == 0:
+            self.query_complete = True
+        else:
+            self._update_slice()
+        return observations
+
+    def get_next_batch(self) -> Union[List[Dict], List]:
+        while not self.query_complete:
+            observations = self.get_next_observations()
+            if len(observations) > 0:
+                return aggregate_witness_links(observations)
+        return []
+
+
+# One row per (challengee, witness, UTC day) of the poc_receipts_v1 transactions in (min_time, max_time) and
+# (min_block, max_block]: the witnesses are unnested and projected in Postgres, the day's statistics (see
+# new_witness_day_stats) are computed with window aggregates, and DISTINCT ON keeps the columns of the latest observation.
+# Rows come ordered by challengee, witness and day.
+WITNESS_LINK_DAYS_SQL = """
+SELECT DISTINCT ON (challengee, witness, day)
+    challengee, witness, day, time, ts, snr, signal, frequency, datarate, location, is_valid,
+    count(*) OVER w AS count,
+    count(*) FILTER (WHERE is_valid) OVER w AS valid,
+    count(*) FILTER (WHERE is_valid IS NOT TRUE) OVER w AS invalid,
+    count(snr) OVER w AS snr_n, coalesce(sum(snr) OVER w, 0) AS snr_sum, min(snr) OVER w AS snr_min, max(snr) OVER w AS snr_max,
+    count(signal) OVER w AS signal_n, coalesce(sum(signal) OVER w, 0)::bigint AS signal_sum, min(signal) OVER w AS signal_min, max(signal) OVER w AS signal_max,
+    min(time) OVER w AS first_seen, max(time) OVER w AS last_seen
+FROM (
+    SELECT t.time,
+        t.time / 86400 AS day,
+        t.fields #>> '{path,0,challengee}' AS challengee,
+        w ->> 'gateway' AS witness,
+        (w ->> 'timestamp')::bigint AS ts,
+        (w ->> 'snr')::double precision AS snr,
+        (w ->> 'signal')::bigint AS signal,
+        (w ->> 'frequency')::double precision AS frequency,
+        w ->> 'datarate' AS datarate,
+        w ->> 'location' AS location,
+        (w ->> 'is_valid')::boolean AS is_valid
+    FROM transactions t
+    CROSS JOIN LATERAL jsonb_array_elements(t.fields #> '{path,0,witnesses}') AS w
+    WHERE t.type = 'poc_receipts_v1' AND t.time > :min_time AND t.time < :max_time AND t.block > :min_block AND t.block <= :max_block
+) observations
+WINDOW w AS (PARTITION BY challengee, witness, day)
+ORDER BY challengee, witness, day, time DESC
+"""
+
+_WITNESS_DAY_STATS = tuple(new_witness_day_stats().keys())
+
+
+class WitnessLinksBatchedQuery(BatchedQuery):
+    """
+    Produces the same link documents as RecentWitnessesBatchedQuery (see aggregate_witness_links), but from the narrow
+    per-link, per-day rows of WITNESS_LINK_DAYS_SQL, streamed through a server-side cursor, rather than whole receipts.
+    A link whose days straddle two batches is written twice, which merge_witness_links folds together.
+    """
+    def __init__(self, session: Session, batch_size: int, min_time: int, max_time: int, block_range: Optional[Tuple[int, int]] = None):
+        self.session = session
+        self.min_time = min_time
+        self.max_time = max_time
+        # the time window alone decides, unless a (min_block, max_block] range narrows it
+        self.block_range = block_range or (-1, 2 ** 62)
+        self.result = None
+        super().__init__(batch_size, WITNESS_LINK_DAYS_SQL)
+
+    def get_next_batch(self) -> Union[List[Dict], List]:
+        if self.result is None:
+            # opened lazily so that the cursor belongs to the (forked) process that reads it
+            params = {'min_time': self.min_time, 'max_time': self.max_time, 'min_block': self.block_range[0], 'max_block': self.block_range[1]}
+            self.result = self.session.execute(text(self.query), params, execution_options={'stream_results': True})
+        links = []
+        link, latest = None, None
+        for row in self.result.fetchmany(self.batch_size):
+            (challengee, witness, day, time, ts, snr, signal, frequency, datarate, location, is_valid) = row[:11]
+            if link is None or (challengee, witness) != latest.pair:
+                link = {'days': {}}
+                links.append(link)
+            # rows are in day order, so the last one of a link carries its latest observation
+            latest = WitnessObservation.from_columns(challengee, witness, time, ts, snr, signal, frequency, datarate, location, is_valid)
+            link.update(latest.to_document())
+            link['days'][str(day)] = dict(zip(_WITNESS_DAY_STATS, row[11:]))
+        HOTSPOT_COORDINATES.annotate_links(links)
+        if len(links) == 0:
             self.query_complete = True
+            self.result.close()
         else:
             self._update_slice()
-        return witnesses
+        return links
 
 
 def get_balances_by_day(engine: Engine,  min_time: int, max_time: int):
@@ -55,7 +55,8 @@ class TransactionActors(Base):
 
     actor = Column('actor', Text(), primary_key=True, nullable=False)
     actor_role = Column('actor_role', Enum(TransactionActorRole), primary_key=True, nullable=False)
-    transaction_hash = Column('transaction_hash', Text(), nullable=False)
+    # an actor has the same role in many transactions, so the hash is part of the key
+    transaction_hash = Column('transaction_hash', Text(), primary_key=True, nullable=False)
     block = Column('block', BigInteger(), nullable=False)
 
     def as_dict(self) -> Dict:
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import random
+import time
+from typing import Callable, List, Optional, Tuple
+
+import requests
+from pyArango.theExceptions import pyArangoException
+
+import metrics
+
+# HTTP status codes and ArangoDB error numbers that are worth retrying: service unavailable / timeouts, lock timeouts,
+# shutdown in progress and write-write conflicts
+TRANSIENT_HTTP_CODES = {408, 429, 502, 503, 504}
+TRANSIENT_ERROR_NUMS = {18, 21, 1200}
+# failures after which the request may still have been applied: the connection dropped or a proxy gave up waiting
+AMBIGUOUS_HTTP_CODES = {408, 502, 504}
+
+OUTCOMES = ('created', 'updated', 'ignored', 'errors', 'empty')
+
+
+def is_transient(error: Exception) -> bool:
+    """True if error is likely to go away on retry (network trouble, overload, conflicts) rather than caused by the documents."""
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    details = getattr(error, 'errors', None)
+    if isinstance(details, dict):
+        return details.get('code') in TRANSIENT_HTTP_CODES or details.get('errorNum') in TRANSIENT_ERROR_NUMS
+    return False
+
+
+def is_ambiguous(error: Exception) -> bool:
+    """True if the failed request may nonetheless have been applied, i.e. repeating it could apply it twice."""
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    details = getattr(error, 'errors', None)
+    return isinstance(details, dict) and details.get('code') in AMBIGUOUS_HTTP_CODES and details.get('errorNum') not in TRANSIENT_ERROR_NUMS
+
+
+class ResilientBulkWriter(object):
+    """
+    Wraps a bulk write so that one bad document costs one batch instead of one sync. Transient errors are retried with
+    exponential backoff; a batch that is rejected is split in half until the offending documents are isolated, which are
+    appended to a dead-letter file while the rest of the batch is written.
+
+    write must be all-or-nothing for bisection to be exact (importBulk with complete=True, or a single AQL query), and
+    should be idempotent (onDuplicate='update'/'ignore', UPSERT) since a retried request may have been applied. A write
+    that is not (e.g. one adding to stored counters) is only retried when the error shows it was not applied, such as
+    a write-write conflict; after a timeout or a dropped connection the error is raised so that the caller can rebuild.
+    :param name: The collection (or stage) the writes belong to, used for metrics and the dead-letter records.
+    :param write: Called with a list of documents, returns an importBulk-style response dict.
+    :param max_retries: Retries of a transient error before giving up on the batch.
+    :param backoff_seconds: The delay before the first retry; it doubles with each attempt (with jitter).
+    :param dead_letter_path: The JSON-lines file that receives rejected documents.
+    :param idempotent: False if repeating an applied write changes the result.
+    """
+    def __init__(self, name: str, write: Callable[[List[dict]], dict], max_retries: int = None, backoff_seconds: float = None, dead_letter_path: str = None,
+                 idempotent: bool = True):
+        self.name = name
+        self._write = write
+        self.idempotent = idempotent
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('ETL_IMPORT_RETRIES', '5'))
+        self.backoff_seconds = backoff_seconds if backoff_seconds is not None else float(os.getenv('ETL_IMPORT_BACKOFF_SEC', '1'))
+        self.dead_letter_path = dead_letter_path or os.getenv('ETL_DEAD_LETTER_PATH', '../logs/dead_letter.jsonl')
+
+    def write(self, batch: List[dict]) -> dict:
+        """
+        Write batch, isolating rejected documents.
+        :param batch: The documents.
+        :return: The summed responses, where errors counts the dead-lettered documents.
+        """
+        total = dict.fromkeys(OUTCOMES, 0)
+        if batch:
+            self._write_part(batch, total)
+        return total
+
+    def _write_part(self, batch: List[dict], total: dict):
+        response, error = self._write_with_retries(batch)
+        if error is None:
+            for outcome in OUTCOMES:
+                total[outcome] += response.get(outcome, 0) if isinstance(response, dict) else 0
+            return
+        if len(batch) == 1:
+            self._dead_letter(batch[0], error)
+            total['errors'] += 1
+            return
+        middle = len(batch) // 2
+        logging.debug(f'{self.name}: batch of {len(batch)} rejected ({error}), retrying halves.')
+        self._write_part(batch[:middle], total)
+        self._write_part(batch[middle:], total)
+
+    def _write_with_retries(self, batch: List[dict]) -> Tuple[Optional[dict], Optional[Exception]]:
+        """Returns (response, None) on success or (None, error) if the documents were rejected. Raises once retries are exhausted."""
+        attempt = 0
+        while True:
+            try:
+                return self._write(batch), None
+            except (pyArangoException, requests.exceptions.RequestException) as error:
+                if not is_transient(error):
+                    if isinstance(error, pyArangoException):
+                        return None, error
+                    raise
+                if not self.idempotent and is_ambiguous(error):
+                    logging.error(f'{self.name}: a batch of {len(batch)} may or may not have been written, not retrying: {error!r}')
+                    raise
+                if attempt >= self.max_retries:
+                    logging.error(f'{self.name}: giving up on a batch of {len(batch)} after {attempt} retries: {error!r}')
+                    raise
+                delay = min(self.backoff_seconds * 2 ** attempt, 60) * random.uniform(0.5, 1.5)
+                attempt += 1
+                metrics.IMPORT_RETRIES.inc(collection=self.name)
+                logging.warning(f'{self.name}: transient error on a batch of {len(batch)} ({error!r}), retry {attempt} in {round(delay, 1)} s.')
+                time.sleep(delay)
+
+    def _dead_letter(self, document: dict, error: Exception):
+        details = getattr(error, 'errors', None)
+        record = {
+            'collection': self.name,
+            'time': int(time.time()),
+            'error': str(error),
+            'details': details if isinstance(details, dict) else None,
+            'document': document
+        }
+        logging.warning(f'{self.name}: document {document.get("_key")} rejected ({error}), written to {self.dead_letter_path}.')
+        os.makedirs(os.path.dirname(self.dead_letter_path) or '.', exist_ok=True)
+        # one write per record so that concurrent workers appending to the same file do not interleave lines
+        with open(self.dead_letter_path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
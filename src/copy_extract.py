@@ -0,0 +1,148 @@
+import csv
+import io
+import itertools
+import json
+import os
+import re
+import threading
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from sqlalchemy import Boolean, DateTime, Enum
+from sqlalchemy.orm import Query
+from sqlalchemy.types import JSON
+
+# COPY writes NULL as this (unquoted) marker, so that NULL can be told apart from the empty string
+NULL_MARKER = '\\N'
+
+_TIMESTAMP = re.compile(r'^(?P<base>[^.]*?\d\d:\d\d:\d\d)(?P<fraction>\.\d+)?(?P<tz>[+-]\d\d(?::\d\d)?)?$')
+
+
+def extract_mode() -> str:
+    """How batched queries pull rows from Postgres: 'orm' (cursor + ORM rows, the default) or 'copy' (see CopyStream)."""
+    mode = os.getenv('ETL_EXTRACT_MODE', 'orm').lower()
+    if mode not in ('orm', 'copy'):
+        raise ValueError(f'Unexpected ETL_EXTRACT_MODE: {mode}')
+    return mode
+
+
+def parse_timestamp(value: str) -> datetime:
+    """Parse Postgres' text output for timestamp(tz), e.g. '2021-10-01 12:00:00.5+00'."""
+    match = _TIMESTAMP.match(value)
+    if match is None:
+        raise ValueError(f'Unexpected timestamp: {value}')
+    # datetime.fromisoformat (before 3.11) wants a 6-digit fraction and a +HH:MM offset
+    fraction = (match['fraction'] or '.0')[1:].ljust(6, '0')[:6]
+    tz = match['tz'] or ''
+    if len(tz) == 3:
+        tz += ':00'
+    return datetime.fromisoformat(f"{match['base']}.{fraction}{tz}")
+
+
+def column_converter(sql_type) -> Callable[[str], object]:
+    """Converts the COPY text of a column to the Python value the ORM would have returned for its SQLAlchemy type."""
+    if isinstance(sql_type, JSON):
+        return json.loads
+    if isinstance(sql_type, Enum) and sql_type.enum_class is not None:
+        # SQLAlchemy stores enum names
+        return lambda value: sql_type.enum_class[value]
+    if isinstance(sql_type, Boolean):
+        return lambda value: value == 't'
+    if isinstance(sql_type, DateTime):
+        return parse_timestamp
+    try:
+        python_type = sql_type.python_type
+    except NotImplementedError:
+        return str
+    # numeric results (e.g. sum over bigint) are read as int for integer columns rather than Decimal
+    return python_type if python_type in (int, float) else str
+
+
+class CopyStream(object):
+    """
+    Streams the result of an ORM query with COPY (SELECT ...) TO STDOUT in CSV format instead of fetching DB-API rows.
+    COPY writes into a pipe from a background thread while read() parses the other end with the csv module, so memory
+    stays bounded by the batch size. Rows are shaped like the query's ORM rows, except that mapped entities come back as
+    dicts of their columns (as from as_dict()).
+
+    The stream runs on the session's connection, so it reads within the session's transaction (e.g. a shared snapshot).
+    Rows must be read until read() returns fewer than requested, or close() called, otherwise the COPY blocks on the pipe.
+    :param query: The ORM query. Bound values are rendered inline.
+    """
+    def __init__(self, query: Query):
+        statement = query.statement
+        dialect = query.session.bind.dialect
+        sql = str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+        self.sql = f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, NULL '{NULL_MARKER}')"
+        self._converters = [column_converter(column.type) for column in statement.selected_columns]
+        self._shapes = []
+        for description in query.column_descriptions:
+            entity = description['expr']
+            if isinstance(entity, type) and hasattr(entity, '__table__'):
+                self._shapes.append([column.name for column in entity.__table__.columns])
+            else:
+                self._shapes.append(None)
+        width = sum(len(shape) if shape else 1 for shape in self._shapes)
+        if width != len(self._converters):
+            raise ValueError(f'Cannot map {len(self._converters)} COPY columns onto the query entities')
+
+        read_fd, write_fd = os.pipe()
+        self._source = io.TextIOWrapper(os.fdopen(read_fd, 'rb', buffering=2 ** 20), encoding='utf-8', newline='')
+        self._sink = os.fdopen(write_fd, 'wb', buffering=2 ** 20)
+        self._reader = csv.reader(self._source)
+        self._error: Optional[BaseException] = None
+        cursor = query.session.connection().connection.cursor()
+        self._thread = threading.Thread(target=self._copy, args=(cursor,), name='copy-stream', daemon=True)
+        self._thread.start()
+
+    def _copy(self, cursor):
+        try:
+            cursor.copy_expert(self.sql, self._sink)
+        except BaseException as error:
+            self._error = error
+        finally:
+            try:
+                self._sink.close()
+            except OSError:
+                # the reader went away (close()), nothing left to flush to
+                pass
+            cursor.close()
+
+    def _convert(self, values: List[str]):
+        converted = [None if value == NULL_MARKER else convert(value) for convert, value in zip(self._converters, values)]
+        row, i = [], 0
+        for shape in self._shapes:
+            if shape is None:
+                row.append(converted[i])
+                i += 1
+            else:
+                row.append(dict(zip(shape, converted[i:i + len(shape)])))
+                i += len(shape)
+        # like Query, a single mapped entity is returned bare rather than in a 1-tuple
+        return row[0] if len(row) == 1 and self._shapes[0] is not None else tuple(row)
+
+    def read(self, num_rows: int) -> list:
+        """
+        The next num_rows rows. Fewer (possibly none) are returned once the result is exhausted.
+        :param num_rows: The number of rows wanted.
+        """
+        if self._thread is None:
+            # exhausted (a batched query asks again after its last, short batch) or closed
+            return []
+        rows = [self._convert(values) for values in itertools.islice(self._reader, num_rows)]
+        if len(rows) < num_rows:
+            self._finish()
+            if self._error is not None:
+                raise self._error
+        return rows
+
+    def close(self):
+        """Abandon the rest of the result. The COPY fails on the closed pipe, so the session's transaction must be rolled back."""
+        self._finish()
+
+    def _finish(self):
+        if self._thread is None:
+            return
+        self._source.close()
+        self._thread.join()
+        self._thread = None
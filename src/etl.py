@@ -1,15 +1,32 @@
+import argparse
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 import os
 from arango_queries import *
-from pyArango.connection import *
+from pyArango.connection import Connection
+from pyArango.database import Database
 import time
+import select
+import threading
 import logging
+import metrics
+from profiling import profile_stage
+from scheduler import Stage, StageScheduler
+from leases import LeaseHeartbeat, LeaseStore, ArangoLeaseStore, lease_owner, open_lease_store
+from contextlib import contextmanager
 
 
-load_dotenv('../.env')
-logging.basicConfig(filename='../logs/etl.log', encoding='utf-8', level=logging.INFO)
+@contextmanager
+def etl_stage(name: str, database: Database = None):
+    """
+    Wraps a named sync stage with timing metrics and, when ETL_PROFILE is set, a profiler. If the stage runs in 'barrier'
+    durability mode, its writes are made durable with a single WAL flush once it completes, before any watermark moves on.
+    """
+    with metrics.timed_stage(name), profile_stage(name):
+        yield
+        if database is not None and durability_mode(name) == 'barrier':
+            flush_wal(database)
 
 
 class HeliumArangoETL(object):
@@ -22,7 +39,9 @@ class HeliumArangoETL(object):
 
     Example usage:
     etl = HeliumArangoETL() # initializes the connections
-    elt.start()             # starts the sync & follower
+    etl.start()             # starts the sync & follower
+
+    From the command line, see `python etl.py --help`.
 
     """
     def __init__(self):
@@ -31,30 +50,109 @@ class HeliumArangoETL(object):
         self.min_block_diff_for_update = int(os.getenv('ETL_MIN_BLOCK_DIFF_FOR_UPDATE'))
         self.recent_witness_days_cutoff = int(os.getenv('ETL_RECENT_WITNESS_DAYS_CUTOFF'))
         self.batch_size = int(os.getenv('ETL_IMPORT_BATCH_SIZE'))
+        self.stage_concurrency = int(os.getenv('ETL_STAGE_CONCURRENCY', '4'))
+        # processes scanning key ranges of each inventory table (accounts, hotspots, locations); 1 scans serially. Forking
+        # stages run alone, so by default the inventories only fork when stages do not run concurrently anyway
+        self.inventory_workers = int(os.getenv('ETL_INVENTORY_WORKERS') or (1 if self.stage_concurrency > 1 else cpu_count()))
 
-        arango_connection = Connection(
-            arangoURL=os.getenv('ARANGO_URL'),
-            username=os.getenv('ARANGO_USERNAME'),
-            password=os.getenv('ARANGO_PASSWORD')
-        )
-        self.db = init_database(arango_connection, 'helium')
+        # scheduled stages swap in a connection of their own (see on_own_connection)
+        self._stage_arango = threading.local()
+        self._db = init_database(self.connect_arango(), 'helium')
 
         self.postgres_engine = create_engine(os.getenv('POSTGRES_URL'))
         self.sessionmaker = sessionmaker(bind=self.postgres_engine)
         self.postgres_session = self.sessionmaker()
 
-        self.hotspots = init_collection(self.db, name='hotspots', class_name='HotspotCollection', geo_index=True)
-        self.accounts = init_collection(self.db, name='accounts', class_name='AccountCollection', geo_index=False)
-        self.payments = init_edges(self.db, name='payments', class_name='PaymentEdges')
-        self.balances = init_collection(self.db, name='balances', class_name='BalancesCollection', geo_index=False)
-        self.witnesses = init_edges(self.db, name='witnesses', class_name='WitnessEdges')
-        self.cities = init_collection(self.db, name='cities', class_name='CitiesCollection', geo_index=False)
+        init_collection(self.db, name='hotspots', class_name='HotspotCollection', geo_index=True)
+        init_collection(self.db, name='accounts', class_name='AccountCollection', geo_index=False)
+        init_edges(self.db, name='payments', class_name='PaymentEdges')
+        init_collection(self.db, name='balances', class_name='BalancesCollection', geo_index=False)
+        init_edges(self.db, name='witnesses', class_name='WitnessEdges')
+        self.witnesses.ensurePersistentIndex(['stats_dirty'])
+        self.witnesses.ensurePersistentIndex(['first_seen'])
+        init_collection(self.db, name='cities', class_name='CitiesCollection', geo_index=False)
+        # one document per city with its witness graph as index pairs, rebuilt for cities whose links changed
+        init_collection(self.db, name='city_graphs', class_name='CityGraphsCollection', geo_index=False)
+        self.witnesses.ensurePersistentIndex(['updated_at'])
+        self.hotspots.ensurePersistentIndex(['location_details.city_key'])
+        self.payments.ensurePersistentIndex(['time'])
+
+        # per-gateway, per-day reward sums from which the rewards_<N>d horizons of hotspots are derived
+        self.reward_horizons = [int(days) for days in os.getenv('ETL_REWARD_HORIZONS_DAYS', '1,5,30').split(',')]
+        register_patch_fields('hotspots', 'rewards', {f'rewards_{days}d': True for days in self.reward_horizons})
+        init_collection(self.db, name='reward_buckets', class_name='RewardBucketsCollection', geo_index=False)
+        self.reward_buckets.ensurePersistentIndex(['day'])
+        self.reward_buckets.ensurePersistentIndex(['gateway'])
+
+        # optional monthly payments_YYYYMM partitions instead of the single payments collection
+        self.partition_payments = os.getenv('ETL_PARTITION_PAYMENTS', 'false').lower() in ('1', 'true', 'yes')
+        self.payment_retention_days = int(os.getenv('ETL_PAYMENT_RETENTION_DAYS') or 0)
+
+        # optional aggregated token-flow edges, one per (payer, payee, day or week)
+        self.token_flow_bucket = os.getenv('ETL_TOKEN_FLOW_BUCKET') or None
+        if self.token_flow_bucket:
+            init_edges(self.db, name='token_flows', class_name='TokenFlowEdges')
+            self.token_flows.ensurePersistentIndex(['bucket_start'])
 
         self.current_height = get_current_height(self.postgres_session)
         self.current_time = get_timestamp_by_block(self.postgres_session, self.current_height)
 
         self.sync_height = int(self.current_height - int(os.getenv('ETL_NUM_HISTORICAL_BLOCKS')))
+        # receipts up to this time are already folded into the witness link statistics (None until the first witness sync)
+        self.witness_sync_time = None
+        # set while receipts are merged into the witness link statistics, so that a merge that failed part-way is rebuilt rather than repeated
+        self.witness_merge_incomplete = False
+        # rewards up to this block are already in the reward buckets (None until the first reward sync)
+        self.reward_sync_height = None
+        # Arango server time of the last city graph refresh (None until the first, which rebuilds every city)
+        self.city_graph_sync_time = None
         self.initial_sync_chunk_size = int(os.getenv('ETL_INITIAL_SYNC_CHUNK_SIZE'))
+        # optional memory-mappable CSR exports of the witness and token-flow graphs
+        self.snapshot_dir = os.getenv('ETL_SNAPSHOT_DIR') or None
+        self.snapshot_keep = int(os.getenv('ETL_SNAPSHOT_KEEP', '3'))
+        # identifies this instance in the lease store when several instances share a backfill
+        self.instance_id = os.getenv('ETL_INSTANCE_ID') or lease_owner()
+        self.lease_seconds = float(os.getenv('ETL_LEASE_SEC', '300'))
+        metrics.set_sync_position(self.current_height, self.sync_height)
+
+        if os.getenv('ETL_METRICS_PORT'):
+            metrics.start_metrics_server(int(os.getenv('ETL_METRICS_PORT')))
+
+    # Arango collections used as attributes, e.g. self.hotspots; they are looked up in self.db
+    COLLECTIONS = ('hotspots', 'accounts', 'payments', 'balances', 'witnesses', 'cities', 'city_graphs', 'reward_buckets', 'token_flows')
+
+    def __getattr__(self, name: str):
+        if name in HeliumArangoETL.COLLECTIONS:
+            return self.db[name]
+        raise AttributeError(f'{type(self).__name__} object has no attribute {name}')
+
+    @property
+    def db(self) -> Database:
+        """The Arango database, over the calling stage's own connection while a scheduled stage runs."""
+        return getattr(self._stage_arango, 'db', self._db)
+
+    @staticmethod
+    def connect_arango() -> Connection:
+        return Connection(
+            arangoURL=os.getenv('ARANGO_URL'),
+            username=os.getenv('ARANGO_USERNAME'),
+            password=os.getenv('ARANGO_PASSWORD')
+        )
+
+    def on_own_connection(self, func: Callable) -> Callable:
+        """
+        Wrap func to run with a new Arango connection in the calling thread, which self.db and the collections use until
+        func returns. A pyArango connection is one requests session, which the scheduler's threads must not share.
+        """
+        def run():
+            connection = self.connect_arango()
+            self._stage_arango.db = connection['helium']
+            try:
+                return func()
+            finally:
+                del self._stage_arango.db
+                connection.disconnectSession()
+        return run
 
     def start(self):
         """Start the ETL daemon."""
@@ -69,44 +167,316 @@ class HeliumArangoETL(object):
         self.follow()
 
     def sync_chunk(self, min_time: int, max_time: int):
-        import_payments_mp(self.sessionmaker, self.batch_size, min_time, max_time)
+        with etl_stage('payments', self.db):
+            if self.partition_payments:
+                init_partitions(self.db, 'payments', 'PaymentEdges', PAYMENTS_GRAPH, min_time, max_time)
+            import_payments_mp(self.sessionmaker, self.batch_size, min_time, max_time, partitioned=self.partition_payments)
+            if self.partition_payments and self.payment_retention_days:
+                drop_partitions_before(self.db, 'payments', PAYMENTS_GRAPH, self.current_time - 3600*24*self.payment_retention_days)
+        if self.token_flow_bucket:
+            with etl_stage('token_flows', self.db):
+                num_flows = update_token_flows(self.db, min_time, max_time, self.token_flow_bucket, self.payment_collections(min_time, max_time))
+            logging.info(f'{num_flows} token-flow edges refreshed ({self.token_flow_bucket} buckets).')
 
         # daily balances is not an efficient query yet
         # import_daily_balances_batched(self.sessionmaker, self.batch_size, min_time, max_time)
 
+    def payment_collections(self, min_time: int, max_time: int) -> List[str]:
+        """The payment edge collections that can hold payments from the token-flow buckets overlapping min_time..max_time."""
+        if not self.partition_payments:
+            return ['payments']
+        bucket_size = TOKEN_FLOW_BUCKETS[self.token_flow_bucket or 'day'][0]
+        start = token_flow_bucket_start(min_time, self.token_flow_bucket or 'day')
+        end = token_flow_bucket_start(max_time, self.token_flow_bucket or 'day') + bucket_size
+        return [name for name in partitions_for_range('payments', start, end) if self.db.hasCollection(name)]
+
     def sync_inventories(self):
-        """Inventories include collections/edges that we only want the most recent snapshot of, like hotspots, accounts, and witness lists."""
+        """Inventories include collections/edges that we only want the most recent snapshot of, like hotspots, accounts, and witness lists.
 
-        logging.info('Beginning import of account inventory.')
-        now = time.time()
-        num_accounts_imported = import_accounts_batched(self.postgres_session, self.batch_size, self.accounts)
-        logging.info(f'{num_accounts_imported} accounts imported from inventory ({round(time.time() - now, 1)} s). Beginning import of hotspots...')
+        Stages run on a small DAG scheduler: each declares the stages whose output it reads, and independent stages run concurrently
+        within ETL_STAGE_CONCURRENCY. Every stage uses its own Postgres session and Arango connection.
 
+        Stages that fork worker processes take the whole budget and so run alone: their workers already use every core, and
+        a fork while other threads hold locks (in the clients, logging, ...) can leave the children deadlocked.
+        """
+        min_witness_time = self.current_time - 3600*24*self.recent_witness_days_cutoff
+        forks = self.stage_concurrency
+        inventory_cost = forks if self.inventory_workers > 1 else 1
+        stages = [
+            Stage('accounts', self.sync_accounts, cost=inventory_cost),
+            Stage('hotspots', self.sync_hotspots, cost=inventory_cost),
+            Stage('cities', self.sync_cities, cost=inventory_cost),
+            Stage('witnesses', lambda: self.sync_witnesses(min_witness_time), cost=forks),
+            # derived writers only patch existing hotspots, so they wait for the import
+            Stage('rewards', self.sync_rewards, requires=['hotspots']),
+            Stage('city_graphs', self.sync_city_graphs, requires=['hotspots', 'cities', 'witnesses']),
+            Stage('city_metrics', self.sync_city_metrics, requires=['city_graphs'], cost=forks),
+            Stage('graph_features', self.sync_graph_features, requires=['hotspots', 'witnesses'])
+        ]
+        if self.snapshot_dir:
+            stages.append(Stage('snapshot', self.write_snapshot, requires=['witnesses']))
+        for stage in stages:
+            stage.func = self.on_own_connection(stage.func)
+        scheduler = StageScheduler(stages, self.stage_concurrency)
+        scheduler.run()
+        logging.info(scheduler.report())
+
+    def sync_accounts(self):
         now = time.time()
-        num_hotspots_imported = import_hotspots_batched(self.postgres_session, self.batch_size, self.hotspots)
-        logging.info(f'{num_hotspots_imported} hotspots imported from inventory ({round(time.time() - now, 1)} s). Beginning import of cities...')
-
+        with etl_stage('accounts', self.db):
+            if self.inventory_workers > 1:
+                num_accounts_imported = import_inventory_mp(self.sessionmaker, self.batch_size, 'accounts', self.inventory_workers)
+            else:
+                session = self.sessionmaker()
+                try:
+                    num_accounts_imported = import_accounts_batched(session, self.batch_size, self.accounts)
+                finally:
+                    session.close()
+        logging.info(f'{num_accounts_imported} accounts imported from inventory ({round(time.time() - now, 1)} s).')
+
+    def sync_hotspots(self):
         now = time.time()
-        num_cities_imported = import_cities_batched(self.postgres_session, self.batch_size, self.cities)
-        logging.info(f'{num_cities_imported} unique cities imported from inventory ({round(time.time() - now, 1)} s). Beginning import of witness lists...')
-
+        with etl_stage('hotspots', self.db):
+            if self.inventory_workers > 1:
+                num_hotspots_imported = import_inventory_mp(self.sessionmaker, self.batch_size, 'hotspots', self.inventory_workers)
+            else:
+                session = self.sessionmaker()
+                try:
+                    num_hotspots_imported = import_hotspots_batched(session, self.batch_size, self.hotspots)
+                finally:
+                    session.close()
+        logging.info(f'{num_hotspots_imported} hotspots imported from inventory ({round(time.time() - now, 1)} s).')
+
+    def sync_cities(self):
         now = time.time()
-        min_witness_time = self.current_time - 3600*24*self.recent_witness_days_cutoff
-        num_witnesses_imported = import_witnesses_mp(self.sessionmaker, 1000, min_witness_time, self.current_time)
-        # after importing new witnesses, remove old ones (this may be an interesting diff operation later on?)
-        remove_witnesses_before_time(self.db, min_witness_time)
-        logging.info(f'{num_witnesses_imported} witness paths reported over last {self.recent_witness_days_cutoff} days ({round(time.time() - now, 1)} s). Beginning import of rewards data...')
-
+        with etl_stage('cities', self.db):
+            if self.inventory_workers > 1:
+                num_cities_imported = import_inventory_mp(self.sessionmaker, self.batch_size, 'cities', self.inventory_workers)
+            else:
+                session = self.sessionmaker()
+                try:
+                    num_cities_imported = import_cities_batched(session, self.batch_size, self.cities)
+                finally:
+                    session.close()
+        logging.info(f'{num_cities_imported} unique cities imported from inventory ({round(time.time() - now, 1)} s).')
+
+    def load_hotspot_coordinates(self):
+        """Refresh the hotspot coordinate table that witness links take their distance_m and bearing from."""
+        session = self.sessionmaker()
+        try:
+            HOTSPOT_COORDINATES.load(get_hotspot_locations(session))
+        finally:
+            session.close()
+
+    def witness_resume_time(self, start_time: int, min_witness_time: int) -> int:
+        """
+        The (exclusive) time to merge receipts into the witness link statistics from, given the watermark start_time. The
+        per-day statistics are additive, so if the last merge failed part-way, the days it may have added to are dropped
+        and read again from their start.
+        :param start_time: The watermark: receipts up to it are merged.
+        :param min_witness_time: The start of the window.
+        """
+        if not self.witness_merge_incomplete:
+            return start_time
+        day = (start_time + 1) // 86400
+        logging.warning(f'The last witness merge failed, rebuilding the link statistics from UTC day {day}.')
+        reset_witness_link_stats(self.db, day)
+        return max(min_witness_time, day * 86400 - 1)
+
+    def sync_witnesses(self, min_witness_time: int):
+        now = time.time()
+        with etl_stage('witnesses', self.db):
+            # before the workers fork, so that they inherit it
+            self.load_hotspot_coordinates()
+            if self.witness_sync_time is None:
+                # the per-day link statistics are additive, so a fresh process rebuilds them from the whole window
+                reset_witness_link_stats(self.db)
+                witness_start_time = min_witness_time
+            else:
+                witness_start_time = self.witness_resume_time(max(min_witness_time, self.witness_sync_time), min_witness_time)
+            self.witness_merge_incomplete = True
+            num_witnesses_imported = import_witnesses_mp(self.sessionmaker, self.batch_size, witness_start_time, self.current_time + 1)
+            # fold the new receipts into the rolling statistics and drop days (and links) that fell out of the window
+            refresh_witness_link_stats(self.db, min_witness_time)
+        # advance the watermark only once the stage (and its durability barrier, if any) has completed
+        self.witness_sync_time = self.current_time
+        self.witness_merge_incomplete = False
+        metrics.record_peak_rss('main')
+        logging.info(f'{num_witnesses_imported} witness paths reported over last {self.recent_witness_days_cutoff} days ({round(time.time() - now, 1)} s).')
+
+    def sync_rewards(self):
+        """Add the rewards of the blocks since the last cycle to the per-day buckets, then derive the reward horizons of hotspots."""
         now = time.time()
-        # get rewards over same range as witnesses
-        num_rewards_updated = import_rewards_batched(self.postgres_session, self.batch_size, self.hotspots, min_witness_time, self.current_time)
-        logging.info(f'Rewards data imported for {num_rewards_updated} hotspots ({round(time.time() - now, 1)} s). Beginning extraction of global graph metrics...')
+        session = self.sessionmaker()
+        try:
+            with etl_stage('rewards', self.db):
+                current_day = self.current_time // 86400
+                if self.reward_sync_height is None:
+                    # a fresh process rebuilds the buckets over the longest horizon
+                    self.reward_buckets.truncate()
+                    min_height = get_block_by_timestamp(session, (current_day - max(self.reward_horizons) + 1) * 86400 - 1) - 1
+                else:
+                    min_height = self.reward_sync_height
+                num_buckets = import_reward_buckets_batched(session, self.batch_size, self.reward_buckets, min_height, self.current_height)
+                num_rewards_updated = rollup_rewards(self.db, current_day, self.reward_horizons, batch_size=self.batch_size)
+        finally:
+            session.close()
+        # advance the watermark only once the stage (and its durability barrier, if any) has completed
+        self.reward_sync_height = self.current_height
+        logging.info(f'{num_buckets} reward buckets updated from blocks {min_height + 1} to {self.current_height}, '
+                     f'rewards over {self.reward_horizons} days set for {num_rewards_updated} hotspots ({round(time.time() - now, 1)} s).')
+
+    def sync_city_graphs(self):
+        """Rebuild the materialized witness graphs of the cities whose links changed since the last refresh."""
+        now = time.time()
+        with etl_stage('city_graphs', self.db):
+            num_city_graphs, refresh_time = refresh_city_graphs(self.db, self.city_graph_sync_time, self.batch_size)
+        # advance the watermark only once the stage (and its durability barrier, if any) has completed
+        self.city_graph_sync_time = refresh_time
+        logging.info(f'{num_city_graphs} city graphs rebuilt ({round(time.time() - now, 1)} s).')
 
+    def sync_city_metrics(self):
         # run city graph analyses and update hotspots where applicable
         logging.info(f"Only considering cities with more than {os.getenv('MIN_CITY_SIZE')}")
         now = time.time()
-        num_city_graphs_processed, num_hotspots_analyzed = parallel_city_graph_processing(self.db, int(os.getenv('MIN_CITY_SIZE')))
-        logging.info(f'City graph metrics applied for {num_city_graphs_processed} cities encompassing {num_hotspots_analyzed} hotspots ({round(time.time() - now, 1)} s). Beginning import of payments and balances...')
+        with etl_stage('city_metrics', self.db):
+            num_city_graphs_processed, num_hotspots_analyzed = parallel_city_graph_processing(self.db, int(os.getenv('MIN_CITY_SIZE')))
+        logging.info(f'City graph metrics applied for {num_city_graphs_processed} cities encompassing {num_hotspots_analyzed} hotspots ({round(time.time() - now, 1)} s).')
+
+    def sync_graph_features(self):
+        """Compute degree, reciprocity, validity, link distance and HITS features of every hotspot over the whole witness graph."""
+        # only this stage needs scipy, so keep it out of the import of this module (and of the forked workers)
+        import graph_features
+        now = time.time()
+        with etl_stage('graph_features', self.db):
+            num_hotspots_updated = graph_features.sync_graph_features(self.db, self.batch_size)
+        metrics.record_peak_rss('main')
+        logging.info(f'Witness graph features set for {num_hotspots_updated} hotspots ({round(time.time() - now, 1)} s).')
+
+    def write_snapshot(self):
+        """Export the witness (and token-flow) graphs as a new CSR snapshot version in ETL_SNAPSHOT_DIR."""
+        import snapshot
+        now = time.time()
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        with etl_stage('snapshot'):
+            version = snapshot.write_snapshot(self.db, self.snapshot_dir, self.current_height, self.current_time, self.batch_size, self.snapshot_keep)
+        metrics.record_peak_rss('main')
+        logging.info(f'Graph snapshot {version} written to {self.snapshot_dir} ({round(time.time() - now, 1)} s).')
+
+    def sync_payments(self):
+        """Sync the dynamic collections from sync_height up to the current height, as during the initial sync."""
+        min_time = get_timestamp_by_block(self.postgres_session, self.sync_height)
+        max_time = get_timestamp_by_block(self.postgres_session, min(self.sync_height + self.initial_sync_chunk_size, self.current_height))
+        self.sync_dynamic_collections(min_time, max_time)
+
+    def backfill(self, from_block: int, to_block: int):
+        """
+        Re-import the dynamic collections for blocks from_block..to_block in chunks of ETL_INITIAL_SYNC_CHUNK_SIZE blocks, e.g.
+        to repair a range. Writes are idempotent, so overlapping what is already synced is safe.
+
+        With ETL_LEASE_STORE set, the chunks are shared out between all instances running the same backfill (see
+        coordinated_backfill()).
+        :param from_block: The first block height.
+        :param to_block: The last block height.
+        """
+        store = open_lease_store(self.db)
+        if store is not None:
+            return self.coordinated_backfill(store, from_block, to_block)
+        height = from_block
+        while height < to_block:
+            end_height = min(height + self.initial_sync_chunk_size, to_block)
+            self.backfill_chunk(height, end_height)
+            logging.info(f'..backfilled blocks {height} to {end_height} / {to_block}')
+            height = end_height
+
+    def backfill_chunk(self, from_block: int, to_block: int):
+        min_time = get_timestamp_by_block(self.postgres_session, from_block) - 1
+        max_time = get_timestamp_by_block(self.postgres_session, to_block) + 1
+        self.sync_chunk(min_time, max_time)
+
+    @contextmanager
+    def heartbeat_store(self, store: LeaseStore):
+        """
+        The lease store for a LeaseHeartbeat: an ArangoLeaseStore gets a connection of its own, since the heartbeat thread
+        would otherwise share the requests session of the thread doing the work.
+        """
+        if not isinstance(store, ArangoLeaseStore):
+            yield store
+            return
+        connection = self.connect_arango()
+        try:
+            yield ArangoLeaseStore(connection['helium'], store.collection_name)
+        finally:
+            connection.disconnectSession()
+
+    def coordinated_backfill(self, store: LeaseStore, from_block: int, to_block: int):
+        """
+        Backfill as one of several instances. The range is registered as work units of ETL_INITIAL_SYNC_CHUNK_SIZE blocks
+        (once: instances started with the same range and chunk size share the units), then each instance claims units one
+        at a time, renews its lease while it works and marks the unit done. A unit whose lease runs out, because its
+        instance died or stalled, is claimed again by another, so the backfill finishes as long as one instance is left.
+        :param store: The lease store shared by the instances.
+        :param from_block: The first block height.
+        :param to_block: The last block height.
+        """
+        if isinstance(store, ArangoLeaseStore):
+            work_units = init_collection(self.db, name=store.collection_name, class_name='WorkUnitsCollection', geo_index=False)
+            work_units.ensurePersistentIndex(['job', 'state', 'from_block'])
+        job = f'backfill-{from_block}-{to_block}'
+        store.add_units(job, [(height, min(height + self.initial_sync_chunk_size, to_block))
+                              for height in range(from_block, to_block, self.initial_sync_chunk_size)])
+        heartbeat_seconds = self.lease_seconds / 3
+        logging.info(f'Joining {job} as {self.instance_id}.')
+        with self.heartbeat_store(store) as heartbeat_store:
+            while True:
+                unit = store.claim(job, self.instance_id, self.lease_seconds)
+                if unit is None:
+                    progress = store.progress(job)
+                    if not progress.get('pending') and not progress.get('leased'):
+                        break
+                    # other instances hold the remaining units; wait in case one of them dies and its lease expires
+                    logging.info(f'{job}: {progress.get("leased", 0)} units leased by other instances, waiting.')
+                    time.sleep(heartbeat_seconds)
+                    continue
+                with LeaseHeartbeat(heartbeat_store, unit['_key'], self.instance_id, self.lease_seconds, heartbeat_seconds) as heartbeat:
+                    try:
+                        self.backfill_chunk(unit['from_block'], unit['to_block'])
+                    except Exception:
+                        store.release(unit['_key'], self.instance_id)
+                        raise
+                if heartbeat.lost.is_set() or not store.complete(unit['_key'], self.instance_id):
+                    # the lease expired and the unit was handed to another instance, which will complete it
+                    logging.warning(f'{job}: lost blocks {unit["from_block"]} to {unit["to_block"]} to another instance.')
+                    continue
+                logging.info(f'..backfilled blocks {unit["from_block"]} to {unit["to_block"]} / {to_block} (attempt {unit["attempts"]})')
+        logging.info(f'{job} complete.')
+
+    def benchmark_payment_extraction(self, from_block: int, to_block: int) -> dict:
+        """
+        Time both payment extractions (see payments_batched_query) over blocks from_block..to_block without writing anything,
+        e.g. to decide on ETL_PAYMENT_EXTRACT for a database.
+        :return: {mode: (edges, seconds)}
+        """
+        block_range = (from_block - 1, to_block)
+        min_time = get_timestamp_by_block(self.postgres_session, from_block) - 1
+        max_time = get_timestamp_by_block(self.postgres_session, to_block) + 1
+        results = {}
+        for mode, query_class in (('scan', RecentPaymentsBatchedQuery), ('actors', ActorPaymentsBatchedQuery)):
+            session = self.sessionmaker()
+            try:
+                now = time.time()
+                if mode == 'scan':
+                    batched_query = query_class(session, self.batch_size, min_time, max_time)
+                else:
+                    batched_query = query_class(session, self.batch_size, block_range)
+                num_edges = 0
+                while not batched_query.query_complete:
+                    num_edges += len(batched_query.get_next_batch())
+                results[mode] = (num_edges, time.time() - now)
+            finally:
+                session.close()
+            logging.info(f'{mode}: {results[mode][0]} payment edges from blocks {from_block} to {to_block} in {round(results[mode][1], 2)} s.')
+        return results
 
     def sync_dynamic_collections(self, min_time, max_time):
         """Dynamic collections include values/edges that we want to track over time, like payments and changes in balances."""
@@ -115,6 +485,7 @@ class HeliumArangoETL(object):
             self.sync_chunk(min_time, max_time)
 
             self.sync_height = get_block_by_timestamp(self.postgres_session, max_time)
+            metrics.set_sync_position(self.current_height, self.sync_height)
             logging.info(f'..payments synced to block {self.sync_height} / {self.current_height}')
 
             min_time = max_time
@@ -123,6 +494,7 @@ class HeliumArangoETL(object):
                 max_time = get_timestamp_by_block(self.postgres_session, self.current_height)
                 self.sync_chunk(min_time, max_time)
                 self.sync_height = self.current_height
+                metrics.set_sync_position(self.current_height, self.sync_height)
                 logging.info(f'..payments synced to block {self.sync_height} / {self.current_height}')
                 logging.info(f"Synced dynamic collections for last {os.getenv('ETL_NUM_HISTORICAL_BLOCKS')} blocks according to ETL_NUM_HISTORICAL_BLOCKS environment variable.")
                 break
@@ -130,16 +502,25 @@ class HeliumArangoETL(object):
                 max_time = get_timestamp_by_block(self.postgres_session, self.sync_height + self.initial_sync_chunk_size)
 
     def follow(self):
-        """After initial sync, run this continuously. Change ETL_UPDATE_INTERVAL environment variable to check for updates more or less often."""
+        """After initial sync, run this continuously. Change ETL_UPDATE_INTERVAL environment variable to check for updates more or less often.
+
+        With ETL_FOLLOW_MODE=stream, new blocks are instead processed as they arrive (see stream()).
+        """
+        if os.getenv('ETL_FOLLOW_MODE', 'periodic').lower() == 'stream':
+            return self.stream()
 
         update_interval_seconds = int(os.getenv('ETL_UPDATE_INTERVAL_SEC'))
         logging.info(f'Beginning periodic sync of token flow every {update_interval_seconds} seconds, according to TOKEN_FLOW_UPDATE_INTERVAL_SEC environment variable.')
         while True:
             time.sleep(update_interval_seconds)
-            n_discovered_blocks = get_current_height(self.postgres_session) - self.current_height
+            chain_height = get_current_height(self.postgres_session)
+            metrics.set_sync_position(chain_height, self.sync_height)
+            n_discovered_blocks = chain_height - self.current_height
 
             if n_discovered_blocks > self.min_block_diff_for_update:
                 logging.info(f'{n_discovered_blocks} new blocks discovered. Re-syncing database.')
+                self.current_height = chain_height
+                self.current_time = get_timestamp_by_block(self.postgres_session, self.current_height)
                 min_time = get_timestamp_by_block(self.postgres_session, self.sync_height)
                 max_time = get_timestamp_by_block(self.postgres_session, self.current_height)
 
@@ -150,7 +531,163 @@ class HeliumArangoETL(object):
 
 
 
-etl = HeliumArangoETL()
-etl.start()
-
-
+    def stream(self):
+        """
+        Follow the chain block by block: poll the blocks table every ETL_FOLLOW_POLL_SEC (or wake up on a NOTIFY to
+        ETL_FOLLOW_NOTIFY_CHANNEL, if the database sends one) and write each run of new blocks' payments, PoC receipts
+        and rewards as a micro-batch. Inventories, city metrics and token flows are still refreshed every
+        ETL_UPDATE_INTERVAL_SEC.
+        """
+        poll_seconds = float(os.getenv('ETL_FOLLOW_POLL_SEC', '2'))
+        max_blocks = int(os.getenv('ETL_FOLLOW_MAX_BLOCKS', '10'))
+        update_interval_seconds = int(os.getenv('ETL_UPDATE_INTERVAL_SEC'))
+        listener = self.listen(os.getenv('ETL_FOLLOW_NOTIFY_CHANNEL'))
+        logging.info(f'Following new blocks every {poll_seconds} s, with a full inventory refresh every {update_interval_seconds} s.')
+        last_refresh, last_refresh_time = time.time(), self.current_time
+        while True:
+            session = self.sessionmaker()
+            try:
+                blocks = get_blocks_after(session, self.sync_height, max_blocks)
+                chain_height = get_current_height(session)
+            finally:
+                session.close()
+            metrics.set_sync_position(chain_height, self.sync_height)
+            if blocks:
+                self.sync_blocks(blocks)
+            if time.time() - last_refresh > update_interval_seconds:
+                self.sync_inventories()
+                if self.token_flow_bucket:
+                    with etl_stage('token_flows', self.db):
+                        update_token_flows(self.db, last_refresh_time, self.current_time, self.token_flow_bucket, self.payment_collections(last_refresh_time, self.current_time))
+                last_refresh, last_refresh_time = time.time(), self.current_time
+            # keep going without waiting while we are behind
+            if len(blocks) < max_blocks:
+                self.wait_for_blocks(listener, poll_seconds)
+
+    def listen(self, channel: str):
+        """A raw Postgres connection LISTENing on channel, or None to poll. It stays checked out of the pool while referenced."""
+        if not channel:
+            return None
+        connection = self.postgres_engine.raw_connection()
+        connection.set_isolation_level(0)  # autocommit, so that notifications are delivered
+        connection.cursor().execute(f'LISTEN "{channel}"')
+        logging.info(f'Listening for new blocks on channel {channel}.')
+        return connection
+
+    @staticmethod
+    def wait_for_blocks(listener, timeout: float):
+        """Sleep for timeout seconds, or until a notification arrives on listener."""
+        if listener is None:
+            time.sleep(timeout)
+            return
+        if select.select([listener], [], [], timeout) != ([], [], []):
+            listener.poll()
+            listener.notifies.clear()
+
+    def sync_blocks(self, blocks: List[Tuple[int, int]]):
+        """
+        Write the payments, PoC receipts and rewards of a run of consecutive new blocks as one micro-batch, then advance the
+        watermarks to the last block.
+        :param blocks: The (height, time) of the blocks, in order, starting right after sync_height.
+        """
+        now = time.time()
+        block_range = (blocks[0][0] - 1, blocks[-1][0])
+        min_time, max_time = blocks[0][1] - 1, blocks[-1][1] + 1
+        current_day = blocks[-1][1] // 86400
+        session = self.sessionmaker()
+        try:
+            with etl_stage('payments', self.db):
+                if self.partition_payments:
+                    init_partitions(self.db, 'payments', 'PaymentEdges', PAYMENTS_GRAPH, min_time, max_time)
+                num_payments = import_payments_batched(session, self.batch_size, self.payments, min_time, max_time, block_range, self.partition_payments)
+            with etl_stage('witnesses', self.db):
+                if len(HOTSPOT_COORDINATES) == 0:
+                    self.load_hotspot_coordinates()
+                min_witness_time = blocks[-1][1] - 3600*24*self.recent_witness_days_cutoff
+                witness_start_time = self.witness_resume_time(min_time, min_witness_time)
+                self.witness_merge_incomplete = True
+                # a rebuilt day is read from its start, before the first block of the run
+                witness_block_range = block_range if witness_start_time == min_time else (-1, block_range[1])
+                num_witnesses = import_witnesses_batched(session, self.batch_size, self.witnesses, witness_start_time, max_time, witness_block_range)
+                refresh_witness_link_stats(self.db, min_witness_time)
+            with etl_stage('rewards', self.db):
+                gateways = set()
+                import_reward_buckets_batched(session, self.batch_size, self.reward_buckets, block_range[0], block_range[1], gateways)
+                # horizons only shift for every hotspot when the day changes
+                rollup_day = self.current_time // 86400
+                rollup_rewards(self.db, current_day, self.reward_horizons, None if current_day != rollup_day else list(gateways), self.batch_size)
+        finally:
+            session.close()
+        # advance the watermarks only once every stage (and its durability barrier, if any) has completed
+        self.sync_height = self.reward_sync_height = self.current_height = blocks[-1][0]
+        self.current_time = self.witness_sync_time = blocks[-1][1]
+        self.witness_merge_incomplete = False
+        done = time.time()
+        for height, block_time in blocks:
+            metrics.BLOCK_TO_GRAPH_SECONDS.observe(done - block_time)
+        logging.info(f'Blocks {blocks[0][0]}..{blocks[-1][0]}: {num_payments} payments, {num_witnesses} witness links, '
+                     f'{len(gateways)} rewarded hotspots ({round(done - now, 2)} s, {round(done - blocks[-1][1], 1)} s behind the chain).')
+
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Sync Helium blockchain data from a blockchain-etl Postgres database into ArangoDB.')
+    parser.add_argument('--env-file', default='../.env', help='dotenv file with the database credentials and ETL settings (default: %(default)s)')
+    parser.add_argument('--log-file', default='../logs/etl.log', help="log file, or '-' for stderr (default: %(default)s)")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.add_parser('start', help='initial sync of inventories and payments, then follow the chain (default)')
+    commands.add_parser('sync-inventories', help='sync accounts, hotspots, cities, witnesses, rewards, city graphs and metrics, and graph features once')
+    commands.add_parser('sync-payments', help='sync payments (and token flows) over the last ETL_NUM_HISTORICAL_BLOCKS blocks once')
+    commands.add_parser('city-metrics', help='rebuild the city graphs and recompute the city graph metrics once')
+    commands.add_parser('graph-features', help='recompute the global witness graph features of hotspots once')
+    commands.add_parser('snapshot', help='export the witness and token-flow graphs as CSR arrays to ETL_SNAPSHOT_DIR once')
+    commands.add_parser('follow', help='follow the chain without an initial sync (see ETL_FOLLOW_MODE)')
+    backfill = commands.add_parser('backfill', help='re-import payments (and token flows) for a range of blocks, shared between instances with ETL_LEASE_STORE')
+    backfill.add_argument('--from-block', type=int, required=True, help='first block height')
+    backfill.add_argument('--to-block', type=int, required=True, help='last block height')
+    benchmark = commands.add_parser('benchmark-payments', help='time the scan and actors payment extractions over a range of blocks (nothing is written)')
+    benchmark.add_argument('--from-block', type=int, required=True, help='first block height')
+    benchmark.add_argument('--to-block', type=int, required=True, help='last block height')
+    args = parser.parse_args(argv)
+    if args.command in ('backfill', 'benchmark-payments') and args.to_block <= args.from_block:
+        parser.error('--to-block must be greater than --from-block')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    load_dotenv(args.env_file)
+    if args.log_file == '-':
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(filename=args.log_file, encoding='utf-8', level=logging.INFO)
+
+    etl = HeliumArangoETL()
+    command = args.command or 'start'
+    if command == 'start':
+        etl.start()
+    elif command == 'sync-inventories':
+        etl.sync_inventories()
+    elif command == 'sync-payments':
+        etl.sync_payments()
+    elif command == 'city-metrics':
+        etl.sync_city_graphs()
+        etl.sync_city_metrics()
+    elif command == 'graph-features':
+        etl.sync_graph_features()
+    elif command == 'snapshot':
+        if not etl.snapshot_dir:
+            raise SystemExit('ETL_SNAPSHOT_DIR is not set')
+        etl.write_snapshot()
+    elif command == 'follow':
+        etl.sync_height = etl.current_height
+        etl.follow()
+    elif command == 'backfill':
+        etl.backfill(args.from_block, args.to_block)
+    elif command == 'benchmark-payments':
+        for mode, (num_edges, seconds) in etl.benchmark_payment_extraction(args.from_block, args.to_block).items():
+            print(f'{mode}: {num_edges} edges in {round(seconds, 2)} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import json
+import os
+import sqlite3
+from hashlib import blake2b
+from typing import Dict, List, Optional, Tuple
+
+
+# SQLite's default limit on bound parameters is 999
+_LOOKUP_CHUNK_SIZE = 900
+
+
+def fingerprint(doc: dict) -> int:
+    """64-bit content hash of a document, independent of key order. Fits in a signed SQLite INTEGER."""
+    payload = json.dumps(doc, sort_keys=True, default=str).encode('utf-8')
+    return int.from_bytes(blake2b(payload, digest_size=8).digest(), 'big', signed=True)
+
+
+class FingerprintStore(object):
+    """
+    Local SQLite map of _key -> content hash for documents already written to a collection. Used to drop unchanged
+    documents before they reach Arango, so that steady-state writes follow the true change rate.
+
+    Fingerprints must only be committed after Arango has accepted the batch they came from.
+    """
+    def __init__(self, path: str, namespace: str):
+        self.namespace = namespace
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS fingerprints (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            hash INTEGER NOT NULL,
+            PRIMARY KEY (namespace, key)) WITHOUT ROWID""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS sources (
+            namespace TEXT PRIMARY KEY,
+            source TEXT NOT NULL)""")
+        self.connection.commit()
+
+    def bind(self, source: str, num_documents: int):
+        """
+        Tie the fingerprints to the collection they were taken from. They are cleared if source is a different collection
+        (e.g. dropped and recreated, or restored from a backup), or if it holds fewer documents than there are fingerprints
+        (e.g. truncated), since documents skipped as unchanged would then be missing from it.
+        :param source: The identity of the collection.
+        :param num_documents: The number of documents it holds.
+        """
+        row = self.connection.execute('SELECT source FROM sources WHERE namespace = ?', (self.namespace,)).fetchone()
+        num_fingerprints = self.connection.execute('SELECT count(*) FROM fingerprints WHERE namespace = ?', (self.namespace,)).fetchone()[0]
+        if (row is not None and row[0] != source) or num_fingerprints > num_documents:
+            self.clear()
+        self.connection.execute('INSERT OR REPLACE INTO sources (namespace, source) VALUES (?, ?)', (self.namespace, source))
+        self.connection.commit()
+
+    def _lookup(self, keys: List[str]) -> Dict[str, int]:
+        known = {}
+        for i in range(0, len(keys), _LOOKUP_CHUNK_SIZE):
+            chunk = keys[i:i + _LOOKUP_CHUNK_SIZE]
+            sql = f"SELECT key, hash FROM fingerprints WHERE namespace = ? AND key IN ({','.join('?' * len(chunk))})"
+            known.update(self.connection.execute(sql, [self.namespace, *chunk]).fetchall())
+        return known
+
+    def filter_changed(self, docs: List[dict]) -> Tuple[List[dict], Dict[str, int]]:
+        """
+        Drop documents whose content hash matches the stored one.
+        :param docs: The transformed batch, each with a _key.
+        :return: (changed documents, {_key: hash} to pass to commit() once the changed documents are imported)
+        """
+        hashes = {doc['_key']: fingerprint(doc) for doc in docs}
+        known = self._lookup(list(hashes.keys()))
+        changed = [doc for doc in docs if known.get(doc['_key']) != hashes[doc['_key']]]
+        return changed, {doc['_key']: hashes[doc['_key']] for doc in changed}
+
+    def commit(self, pending: Dict[str, int]):
+        self.connection.executemany('INSERT OR REPLACE INTO fingerprints (namespace, key, hash) VALUES (?, ?, ?)',
+                                    [(self.namespace, key, value) for key, value in pending.items()])
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute('DELETE FROM fingerprints WHERE namespace = ?', (self.namespace,))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def open_fingerprint_store(namespace: str) -> Optional[FingerprintStore]:
+    """Returns the store for namespace if ETL_FINGERPRINT_DB is set, otherwise None (every document is written)."""
+    path = os.getenv('ETL_FINGERPRINT_DB')
+    if not path:
+        return None
+    return FingerprintStore(path, namespace)
+
+
+def reset_fingerprints(namespace: str):
+    """Forget every fingerprint in namespace, e.g. when its Arango collection has just been (re)created."""
+    store = open_fingerprint_store(namespace)
+    if store is not None:
+        store.clear()
+        store.close()
@@ -0,0 +1,124 @@
+import h3
+import numpy as np
+from functools import lru_cache
+from hashlib import md5
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+# there are far fewer distinct res-12 hexes and cities than hotspots, so these caches stay small in practice
+H3_CACHE_SIZE = 2 ** 20
+CITY_KEY_CACHE_SIZE = 2 ** 16
+
+_NULL_POINT = {'coordinates': None, 'type': 'Point'}
+
+# the earth radius ArangoDB's GEO_DISTANCE uses, so that stored distances match what it used to compute
+EARTH_RADIUS_M = 6371000
+
+
+@lru_cache(maxsize=H3_CACHE_SIZE)
+def h3_to_lon_lat(location_hex: str) -> Tuple[float, float]:
+    """(lon, lat) of the center of an h3 cell, i.e. GeoJSON coordinate order."""
+    lat, lon = h3.h3_to_geo(location_hex)
+    return lon, lat
+
+
+@lru_cache(maxsize=CITY_KEY_CACHE_SIZE)
+def _city_key(city_id: str) -> str:
+    return md5(city_id.encode('utf-8')).hexdigest()
+
+
+def city_key(city_id: Optional[str]) -> Optional[str]:
+    """The cities collection key for a locations.city_id (md5 gets rid of illegal characters in some city id's)."""
+    if not city_id:
+        return None
+    return _city_key(city_id)
+
+
+def h3_to_geo_location(location_hex: Optional[str]) -> dict:
+    """GeoJSON point for an h3 cell. Hotspots without an asserted location get null coordinates."""
+    if location_hex is None:
+        return dict(_NULL_POINT)
+    return {'coordinates': h3_to_lon_lat(location_hex), 'type': 'Point'}
+
+
+def h3_to_geo_locations(location_hexes: Iterable[Optional[str]]) -> List[dict]:
+    """
+    Batch version of h3_to_geo_location. Each distinct hex in the column is converted once, and nulls never reach h3.
+    :param location_hexes: A column of h3 cells, possibly containing None.
+    :return: The GeoJSON points, in the same order as location_hexes.
+    """
+    location_hexes = list(location_hexes)
+    points = {location_hex: {'coordinates': h3_to_lon_lat(location_hex), 'type': 'Point'}
+              for location_hex in set(location_hexes) if location_hex is not None}
+    return [points[location_hex] if location_hex is not None else dict(_NULL_POINT) for location_hex in location_hexes]
+
+
+def haversine_m(lon1: np.ndarray, lat1: np.ndarray, lon2: np.ndarray, lat2: np.ndarray) -> np.ndarray:
+    """Great-circle distances in meters between arrays of points given in degrees."""
+    lon1, lat1, lon2, lat2 = (np.radians(a) for a in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def initial_bearing_deg(lon1: np.ndarray, lat1: np.ndarray, lon2: np.ndarray, lat2: np.ndarray) -> np.ndarray:
+    """Initial bearings in degrees clockwise from north (0..360) from the first to the second points."""
+    lon1, lat1, lon2, lat2 = (np.radians(a) for a in (lon1, lat1, lon2, lat2))
+    y = np.sin(lon2 - lon1) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lon2 - lon1)
+    return np.degrees(np.arctan2(y, x)) % 360
+
+
+class HotspotCoordinates(object):
+    """
+    In-memory table of hotspot coordinates, so that witness links can be given their length while they are extracted
+    instead of by looking up both hotspots in Arango whenever the length is needed.
+    """
+    def __init__(self):
+        self.index: Dict[str, int] = {}
+        self.lon = np.empty(0)
+        self.lat = np.empty(0)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def load(self, locations: Iterable[Tuple[str, Optional[str]]]):
+        """
+        Replace the table.
+        :param locations: (address, location_hex) pairs. Hotspots without a location are left out.
+        """
+        addresses, lon, lat = [], [], []
+        for address, location_hex in locations:
+            if location_hex is None:
+                continue
+            point = h3_to_lon_lat(location_hex)
+            addresses.append(address)
+            lon.append(point[0])
+            lat.append(point[1])
+        self.index = {address: i for i, address in enumerate(addresses)}
+        self.lon = np.array(lon, dtype=np.float64)
+        self.lat = np.array(lat, dtype=np.float64)
+
+    def annotate_links(self, links: List[dict]):
+        """
+        Set distance_m and bearing (from challengee to witness) on witness link documents whose hotspots both have known
+        coordinates. Other links are left without them, so that merging them keeps whatever the stored link has.
+        :param links: Link documents with _from and _to ids of the hotspots collection.
+        """
+        if not links or not self.index:
+            return
+        prefix = len('hotspots/')
+        src = np.fromiter((self.index.get(link['_from'][prefix:], -1) for link in links), dtype=np.int64, count=len(links))
+        dst = np.fromiter((self.index.get(link['_to'][prefix:], -1) for link in links), dtype=np.int64, count=len(links))
+        known = np.flatnonzero((src >= 0) & (dst >= 0))
+        if len(known) == 0:
+            return
+        src, dst = src[known], dst[known]
+        distances = haversine_m(self.lon[src], self.lat[src], self.lon[dst], self.lat[dst])
+        bearings = initial_bearing_deg(self.lon[src], self.lat[src], self.lon[dst], self.lat[dst])
+        for i, distance, bearing in zip(known.tolist(), distances.tolist(), bearings.tolist()):
+            links[i]['distance_m'] = distance
+            links[i]['bearing'] = bearing
+
+
+# loaded by the witness stage before it forks its workers, which inherit it
+HOTSPOT_COORDINATES = HotspotCoordinates()
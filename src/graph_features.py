@@ -0,0 +1,191 @@
+import logging
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+from scipy import sparse
+from pyArango.database import Database
+
+import metrics
+from arango_queries import PATCH_FIELDS, patch_documents, register_patch_fields
+from bulk_writer import ResilientBulkWriter
+
+# distance percentiles of each hotspot's witness links
+DISTANCE_PERCENTILES = (10, 50, 90)
+
+# undefined ratios and percentiles (e.g. a hotspot without outgoing links) are removed rather than stored as null
+register_patch_fields('hotspots', 'graph_features', {
+    'in_degree': True, 'out_degree': True, 'hub_score': True, 'authority_score': True,
+    'reciprocal_ratio': False, 'valid_ratio': False, **{f'distance_p{q}': False for q in DISTANCE_PERCENTILES}})
+
+
+class WitnessGraph(object):
+    """
+    The whole witness graph as arrays: link i goes from hotspot src[i] to hotspot dst[i], where hotspots are numbered by
+    their position in keys. Per link, valid and observations are the valid/total receipt counts over the witness window
+    and distance is the distance between the two hotspots in meters (NaN if either has no location).
+    """
+    def __init__(self, keys: np.ndarray, src: np.ndarray, dst: np.ndarray, valid: np.ndarray, observations: np.ndarray, distance: np.ndarray):
+        self.keys = keys
+        self.src = src
+        self.dst = dst
+        self.valid = valid
+        self.observations = observations
+        self.distance = distance
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.keys)
+
+    @property
+    def num_links(self) -> int:
+        return len(self.src)
+
+
+def load_witness_graph(database: Database, batch_size: int) -> WitnessGraph:
+    """
+    Read every witness link once, as compact rows streamed with a cursor, into a WitnessGraph.
+    :param database: The PyArango Database object.
+    :param batch_size: The cursor batch size.
+    """
+    aql = """FOR e IN witnesses
+    RETURN [e._from, e._to, e.valid_count, e.observations, e.distance_m]"""
+    now = time.time()
+    froms, tos, valid, observations, distance = [], [], [], [], []
+    for row in database.AQLQuery(aql, rawResults=True, batchSize=batch_size):
+        froms.append(row[0][len('hotspots/'):])
+        tos.append(row[1][len('hotspots/'):])
+        valid.append(row[2] or 0)
+        observations.append(row[3] or 0)
+        distance.append(np.nan if row[4] is None else row[4])
+    metrics.record_fetch('witness_graph', len(froms), time.time() - now)
+    keys, ids = np.unique(np.array(froms + tos, dtype=object), return_inverse=True)
+    return WitnessGraph(keys, ids[:len(froms)], ids[len(froms):], np.array(valid, dtype=np.float64),
+                        np.array(observations, dtype=np.float64), np.array(distance, dtype=np.float64))
+
+
+def reciprocal_links(graph: WitnessGraph) -> np.ndarray:
+    """True for each link whose reverse link (dst to src) also exists."""
+    codes = graph.src.astype(np.int64) * graph.num_nodes + graph.dst
+    reverse = graph.dst.astype(np.int64) * graph.num_nodes + graph.src
+    return np.isin(reverse, codes)
+
+
+def grouped_percentiles(groups: np.ndarray, values: np.ndarray, num_groups: int, percentiles: Tuple[int, ...]) -> np.ndarray:
+    """
+    Percentiles of values per group (linear interpolation, as np.percentile), computed with one sort instead of a loop
+    over groups. NaN values are ignored; groups without values get NaN.
+    :return: An array of shape (num_groups, len(percentiles)).
+    """
+    keep = ~np.isnan(values)
+    groups, values = groups[keep], values[keep]
+    order = np.lexsort((values, groups))
+    values = values[order]
+    counts = np.bincount(groups, minlength=num_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    result = np.full((num_groups, len(percentiles)), np.nan)
+    has_values = counts > 0
+    for j, q in enumerate(percentiles):
+        position = starts[has_values] + (counts[has_values] - 1) * (q / 100)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        result[has_values, j] = values[lower] + (values[upper] - values[lower]) * (position - lower)
+    return result
+
+
+def hits(graph: WitnessGraph, max_iter: int = 100, tol: float = 1e-8) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    HITS hub and authority scores by power iteration on the sparse adjacency matrix. Scores are normalized to sum to 1,
+    like networkx.hits.
+    :return: (hubs, authorities)
+    """
+    n = graph.num_nodes
+    adjacency = sparse.csr_matrix((np.ones(graph.num_links), (graph.src, graph.dst)), shape=(n, n))
+    # parallel links are collapsed to a single one
+    adjacency.data[:] = 1
+    adjacency_t = adjacency.T.tocsr()
+    hubs = np.full(n, 1 / n)
+    for i in range(max_iter):
+        authorities = adjacency_t @ hubs
+        authorities /= authorities.sum() or 1
+        previous = hubs
+        hubs = adjacency @ authorities
+        hubs /= hubs.sum() or 1
+        if np.abs(hubs - previous).sum() < tol:
+            break
+    else:
+        logging.warning(f'HITS did not converge in {max_iter} iterations.')
+    return hubs, authorities
+
+
+def compute_features(graph: WitnessGraph) -> Dict[str, np.ndarray]:
+    """
+    Per-hotspot features of the witness graph, each an array indexed like graph.keys:
+    in_degree / out_degree: the number of links to / from the hotspot;
+    reciprocal_ratio: the fraction of its outgoing links that also exist in the other direction;
+    valid_ratio: valid receipts over all receipts on the links it takes part in;
+    distance_p<q>: percentiles of the lengths of those links, in meters;
+    hub_score / authority_score: HITS scores.
+    """
+    n = graph.num_nodes
+    out_degree = np.bincount(graph.src, minlength=n)
+    in_degree = np.bincount(graph.dst, minlength=n)
+    reciprocal = np.bincount(graph.src, weights=reciprocal_links(graph), minlength=n)
+    ends = np.concatenate((graph.src, graph.dst))
+    valid = np.bincount(ends, weights=np.concatenate((graph.valid, graph.valid)), minlength=n)
+    observations = np.bincount(ends, weights=np.concatenate((graph.observations, graph.observations)), minlength=n)
+    distances = grouped_percentiles(ends, np.concatenate((graph.distance, graph.distance)), n, DISTANCE_PERCENTILES)
+    hubs, authorities = hits(graph)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        features = {
+            'in_degree': in_degree,
+            'out_degree': out_degree,
+            'reciprocal_ratio': np.where(out_degree > 0, reciprocal / out_degree, np.nan),
+            'valid_ratio': np.where(observations > 0, valid / observations, np.nan),
+            'hub_score': hubs,
+            'authority_score': authorities
+        }
+    for j, q in enumerate(DISTANCE_PERCENTILES):
+        features[f'distance_p{q}'] = distances[:, j]
+    return features
+
+
+def feature_documents(graph: WitnessGraph, features: Dict[str, np.ndarray]) -> List[dict]:
+    """Hotspot update documents, with NaN written as null."""
+    columns = {name: [None if value != value else value for value in values.tolist()] for name, values in features.items()}
+    return [{'_key': key, **{name: column[i] for name, column in columns.items()}} for i, key in enumerate(graph.keys.tolist())]
+
+
+def unlinked_feature_documents(database: Database, graph: WitnessGraph, batch_size: int) -> List[dict]:
+    """Hotspot update documents clearing the features of hotspots that have some but are no longer in the witness graph."""
+    fields = PATCH_FIELDS['hotspots']['graph_features']
+    has_features = ' OR '.join(f'hotspot.{field} != null' for field in fields)
+    aql = f"""FOR hotspot IN hotspots
+    FILTER {has_features}
+    RETURN hotspot._key"""
+    linked = set(graph.keys.tolist())
+    return [{'_key': key, **dict.fromkeys(fields)} for key in database.AQLQuery(aql, rawResults=True, batchSize=batch_size) if key not in linked]
+
+
+def sync_graph_features(database: Database, batch_size: int) -> int:
+    """
+    Compute the global witness graph features (see compute_features) for every hotspot with witness links and write them
+    to the hotspots collection in one pass of batched patches. Hotspots that lost all their links have their features
+    cleared (null, or removed for the ratios and percentiles).
+    :param database: The PyArango Database object.
+    :param batch_size: The cursor and write batch size.
+    :return: The number of hotspots updated.
+    """
+    graph = load_witness_graph(database, batch_size)
+    now = time.time()
+    documents = feature_documents(graph, compute_features(graph)) if graph.num_links > 0 else []
+    logging.info(f'Witness graph features computed for {graph.num_nodes} hotspots over {graph.num_links} links ({round(time.time() - now, 1)} s).')
+    documents += unlinked_feature_documents(database, graph, batch_size)
+    writer = ResilientBulkWriter('hotspots', lambda batch: patch_documents(database, 'hotspots', 'graph_features', batch))
+    num_updated = 0
+    for i in range(0, len(documents), batch_size):
+        now = time.time()
+        response = writer.write(documents[i:i + batch_size])
+        metrics.record_import('hotspots', response, time.time() - now)
+        num_updated += response['updated']
+    return num_updated
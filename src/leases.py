@@ -0,0 +1,231 @@
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+
+def lease_owner() -> str:
+    """A name for this process that is unique across hosts and restarts."""
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+def unit_key(job: str, from_block: int, to_block: int) -> str:
+    return f'{job}-{from_block}-{to_block}'
+
+
+class LeaseStore(object):
+    """
+    Shared table of work units: block ranges of a job that ETL instances claim for a limited time (a lease), renew while
+    they work on them, and mark done. A unit whose lease expires, e.g. because its owner crashed, can be claimed again.
+    Units are dicts with _key, job, from_block, to_block, state ('pending', 'leased' or 'done'), owner, lease_expires
+    and attempts.
+    """
+    def add_units(self, job: str, ranges: List[Tuple[int, int]]):
+        """Register the (from_block, to_block) units of a job. Units that already exist are left as they are."""
+        raise NotImplementedError
+
+    def claim(self, job: str, owner: str, lease_seconds: float) -> Optional[dict]:
+        """Lease the lowest pending (or expired) unit of job to owner, or return None if there is none."""
+        raise NotImplementedError
+
+    def heartbeat(self, key: str, owner: str, lease_seconds: float) -> bool:
+        """Extend owner's lease on a unit. False if owner no longer holds it."""
+        raise NotImplementedError
+
+    def complete(self, key: str, owner: str) -> bool:
+        """Mark a unit done. False if owner no longer holds it (someone else re-leased it after it expired)."""
+        raise NotImplementedError
+
+    def release(self, key: str, owner: str):
+        """Give a unit back without completing it, e.g. after an error."""
+        raise NotImplementedError
+
+    def progress(self, job: str) -> dict:
+        """Number of units of job per state."""
+        raise NotImplementedError
+
+
+class ArangoLeaseStore(LeaseStore):
+    """
+    Work units in an Arango collection. Claims run as one AQL query with an exclusive collection lock, so two instances
+    can never lease the same unit. Lease times use the server clock.
+    :param database: The PyArango Database object.
+    :param collection_name: The work units collection (see WorkUnitsCollection).
+    """
+    def __init__(self, database, collection_name: str = 'work_units'):
+        self.database = database
+        self.collection_name = collection_name
+
+    def add_units(self, job: str, ranges: List[Tuple[int, int]]):
+        units = [{'_key': unit_key(job, from_block, to_block), 'job': job, 'from_block': from_block, 'to_block': to_block,
+                  'state': 'pending', 'owner': None, 'lease_expires': None, 'attempts': 0} for from_block, to_block in ranges]
+        self.database[self.collection_name].importBulk(units, onDuplicate='ignore', waitForSync=True)
+
+    def claim(self, job: str, owner: str, lease_seconds: float) -> Optional[dict]:
+        aql = f"""
+        LET now = DATE_NOW() / 1000
+        FOR unit IN {self.collection_name}
+            FILTER unit.job == @job AND (unit.state == 'pending' OR (unit.state == 'leased' AND unit.lease_expires < now))
+            SORT unit.from_block
+            LIMIT 1
+            UPDATE unit WITH {{state: 'leased', owner: @owner, lease_expires: now + @lease_seconds, attempts: unit.attempts + 1}}
+            IN {self.collection_name} OPTIONS {{exclusive: true, waitForSync: true}}
+            RETURN NEW"""
+        result = self.database.AQLQuery(aql, bindVars={'job': job, 'owner': owner, 'lease_seconds': lease_seconds}, rawResults=True)
+        return result[0] if len(result) > 0 else None
+
+    def _update_owned(self, key: str, owner: str, changes: dict) -> bool:
+        aql = f"""
+        FOR unit IN {self.collection_name}
+            FILTER unit._key == @key AND unit.owner == @owner AND unit.state == 'leased'
+            UPDATE unit WITH @changes IN {self.collection_name} OPTIONS {{exclusive: true, waitForSync: true}}
+            RETURN 1"""
+        return len(self.database.AQLQuery(aql, bindVars={'key': key, 'owner': owner, 'changes': changes}, rawResults=True)) > 0
+
+    def heartbeat(self, key: str, owner: str, lease_seconds: float) -> bool:
+        # the server clock decides expiry, so extend relative to it
+        aql = f"""
+        FOR unit IN {self.collection_name}
+            FILTER unit._key == @key AND unit.owner == @owner AND unit.state == 'leased'
+            UPDATE unit WITH {{lease_expires: DATE_NOW() / 1000 + @lease_seconds}} IN {self.collection_name} OPTIONS {{exclusive: true}}
+            RETURN 1"""
+        return len(self.database.AQLQuery(aql, bindVars={'key': key, 'owner': owner, 'lease_seconds': lease_seconds}, rawResults=True)) > 0
+
+    def complete(self, key: str, owner: str) -> bool:
+        return self._update_owned(key, owner, {'state': 'done', 'lease_expires': None})
+
+    def release(self, key: str, owner: str):
+        self._update_owned(key, owner, {'state': 'pending', 'owner': None, 'lease_expires': None})
+
+    def progress(self, job: str) -> dict:
+        aql = f"""
+        FOR unit IN {self.collection_name}
+            FILTER unit.job == @job
+            COLLECT state = unit.state WITH COUNT INTO n
+            RETURN {{state: state, n: n}}"""
+        return {row['state']: row['n'] for row in self.database.fetch_list(aql, bind_vars={'job': job}, dont_raise_error_if_empty=True)}
+
+
+class SQLiteLeaseStore(LeaseStore):
+    """
+    Work units in a local SQLite file, for several ETL processes on one host (or for trying out coordination without
+    Arango). Claims run in an IMMEDIATE transaction, which takes the database write lock.
+    :param path: The SQLite file.
+    """
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        # the heartbeat thread shares the connection
+        self._lock = threading.Lock()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS work_units (
+            key TEXT PRIMARY KEY,
+            job TEXT NOT NULL,
+            from_block INTEGER NOT NULL,
+            to_block INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            owner TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0)""")
+        self.connection.execute('CREATE INDEX IF NOT EXISTS work_units_job_state ON work_units (job, state, from_block)')
+
+    def _unit(self, row) -> dict:
+        keys = ('_key', 'job', 'from_block', 'to_block', 'state', 'owner', 'lease_expires', 'attempts')
+        return dict(zip(keys, row))
+
+    def add_units(self, job: str, ranges: List[Tuple[int, int]]):
+        with self._lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.executemany("INSERT OR IGNORE INTO work_units (key, job, from_block, to_block, state) VALUES (?, ?, ?, ?, 'pending')",
+                                        [(unit_key(job, from_block, to_block), job, from_block, to_block) for from_block, to_block in ranges])
+            self.connection.execute('COMMIT')
+
+    def claim(self, job: str, owner: str, lease_seconds: float) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.connection.execute("""SELECT key FROM work_units
+                    WHERE job = ? AND (state = 'pending' OR (state = 'leased' AND lease_expires < ?))
+                    ORDER BY from_block LIMIT 1""", (job, now)).fetchone()
+                if row is not None:
+                    self.connection.execute("UPDATE work_units SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE key = ?",
+                                            (owner, now + lease_seconds, row[0]))
+                    row = self.connection.execute('SELECT * FROM work_units WHERE key = ?', (row[0],)).fetchone()
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+        return self._unit(row) if row is not None else None
+
+    def _update_owned(self, key: str, owner: str, assignments: str, params: tuple) -> bool:
+        with self._lock:
+            cursor = self.connection.execute(f"UPDATE work_units SET {assignments} WHERE key = ? AND owner = ? AND state = 'leased'", params + (key, owner))
+            return cursor.rowcount > 0
+
+    def heartbeat(self, key: str, owner: str, lease_seconds: float) -> bool:
+        return self._update_owned(key, owner, 'lease_expires = ?', (time.time() + lease_seconds,))
+
+    def complete(self, key: str, owner: str) -> bool:
+        return self._update_owned(key, owner, "state = 'done', lease_expires = NULL", ())
+
+    def release(self, key: str, owner: str):
+        self._update_owned(key, owner, "state = 'pending', owner = NULL, lease_expires = NULL", ())
+
+    def progress(self, job: str) -> dict:
+        with self._lock:
+            return dict(self.connection.execute('SELECT state, count(*) FROM work_units WHERE job = ? GROUP BY state', (job,)).fetchall())
+
+
+class LeaseHeartbeat(object):
+    """
+    Renews a lease from a background thread while the enclosed work runs. If a renewal finds the lease gone (it expired
+    and another instance claimed the unit), lost is set; the work is still safe to finish since writes are idempotent,
+    but the unit must not be completed by this owner.
+    """
+    def __init__(self, store: LeaseStore, key: str, owner: str, lease_seconds: float, interval: float):
+        self.store = store
+        self.key = key
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.interval = interval
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='lease-heartbeat', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not self.store.heartbeat(self.key, self.owner, self.lease_seconds):
+                    logging.warning(f'Lost the lease on work unit {self.key}.')
+                    self.lost.set()
+                    return
+            except Exception as error:
+                # keep trying: the lease only lapses if renewals keep failing until it expires
+                logging.warning(f'Could not renew the lease on work unit {self.key}: {error!r}')
+
+    def __enter__(self) -> 'LeaseHeartbeat':
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+
+def open_lease_store(database) -> Optional[LeaseStore]:
+    """
+    The lease store selected by ETL_LEASE_STORE: 'arango' (the work_units collection of database) or 'sqlite:<path>'.
+    None if unset, in which case work is not coordinated between instances.
+    """
+    spec = os.getenv('ETL_LEASE_STORE')
+    if not spec:
+        return None
+    if spec == 'arango':
+        return ArangoLeaseStore(database)
+    if spec.startswith('sqlite:'):
+        return SQLiteLeaseStore(spec[len('sqlite:'):])
+    raise ValueError(f'Unexpected ETL_LEASE_STORE: {spec}')
@@ -0,0 +1,274 @@
+import threading
+import time
+import logging
+import resource
+import sys
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Optional, Tuple
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra: Optional[Dict[str, str]] = None) -> str:
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.extend(extra.items())
+    if not pairs:
+        return ''
+    escaped = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metric(object):
+    """
+    Base class for a labelled metric. Values are keyed by the tuple of label values, in the order of label_names.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels.keys()) != set(self.label_names):
+            raise ValueError(f'{self.name} expects labels {self.label_names}, got {tuple(labels.keys())}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {key: self._copy_value(value) for key, value in self._values.items()}
+
+    def merge(self, values: dict):
+        with self._lock:
+            for key, value in values.items():
+                self._merge_value(key, value)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def _copy_value(self, value):
+        return value
+
+    def _merge_value(self, key, value):
+        self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, value in sorted(self.snapshot().items()):
+            lines.append(f'{self.name}{_format_labels(self.label_names, key)} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def _merge_value(self, key, value):
+        # gauges are point-in-time readings, so the most recent report wins
+        self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = list(counts)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def _copy_value(self, value):
+        return list(value[0]), value[1], value[2]
+
+    def _merge_value(self, key, value):
+        counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+        self._values[key] = ([a + b for a, b in zip(counts, value[0])], total + value[1], count + value[2])
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, (counts, total, count) in sorted(self.snapshot().items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, {"le": repr(float(bound))})} {bucket_count}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, {"le": "+Inf"})} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, key)} {count}')
+        return '\n'.join(lines)
+
+
+class MetricsRegistry(object):
+    """
+    Process-local collection of metrics. Worker processes report their values back to the parent with snapshot() and merge().
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: Iterable[str] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def snapshot(self) -> dict:
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def merge(self, snapshot: dict):
+        for name, values in snapshot.items():
+            if name in self._metrics:
+                self._metrics[name].merge(values)
+
+    def reset(self):
+        for metric in self._metrics.values():
+            metric.reset()
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+ROWS_FETCHED = REGISTRY.counter('etl_rows_fetched_total', 'Documents produced by Postgres extraction.', ['collection'])
+DOCUMENTS = REGISTRY.counter('etl_documents_total', 'Arango import outcomes per document.', ['collection', 'outcome'])
+POSTGRES_BATCH_SECONDS = REGISTRY.histogram('etl_postgres_batch_seconds', 'Time to fetch and transform one batch from Postgres.', ['collection'])
+ARANGO_BATCH_SECONDS = REGISTRY.histogram('etl_arango_batch_seconds', 'Time to import one batch into Arango.', ['collection'])
+QUEUE_DEPTH = REGISTRY.gauge('etl_import_queue_depth', 'Import work partitions that have not finished yet.', ['collection'])
+STAGE_SECONDS = REGISTRY.histogram('etl_stage_seconds', 'Wall time of each ETL stage.', ['stage'])
+STAGE_LAST_SUCCESS = REGISTRY.gauge('etl_stage_last_success_timestamp_seconds', 'Unix time at which each stage last completed.', ['stage'])
+CHAIN_HEIGHT = REGISTRY.gauge('etl_chain_height', 'Latest block height seen in Postgres.')
+SYNC_HEIGHT = REGISTRY.gauge('etl_sync_height', 'Block height the dynamic collections are synced to.')
+SYNC_LAG_BLOCKS = REGISTRY.gauge('etl_sync_lag_blocks', 'Blocks between the chain head and the sync height.')
+BATCH_SIZE = REGISTRY.gauge('etl_batch_size', 'Current adaptive batch size (source rows per batch) per collection.', ['collection'])
+IMPORT_RETRIES = REGISTRY.counter('etl_import_retries_total', 'Bulk writes retried after a transient Arango error.', ['collection'])
+BLOCK_TO_GRAPH_SECONDS = REGISTRY.histogram('etl_block_to_graph_seconds', 'Time from a block being produced to its payments, receipts and rewards being written in follow mode.',
+                                            buckets=(1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0, 3600.0))
+PEAK_RSS_BYTES = REGISTRY.gauge('etl_peak_rss_bytes', 'Peak resident set size of the main process and import workers.', ['process'])
+
+
+def record_import(collection: str, response: dict, elapsed: float):
+    """
+    Record the outcome of a single importBulk call.
+    :param collection: The collection name.
+    :param response: The importBulk response (created, updated, ignored, errors, empty).
+    :param elapsed: Seconds spent in the Arango request.
+    """
+    ARANGO_BATCH_SECONDS.observe(elapsed, collection=collection)
+    for outcome in ('created', 'updated', 'ignored', 'errors', 'empty'):
+        if response.get(outcome):
+            DOCUMENTS.inc(response[outcome], collection=collection, outcome=outcome)
+
+
+def record_fetch(collection: str, num_rows: int, elapsed: float):
+    """
+    Record a single batch pulled from Postgres.
+    :param collection: The destination collection name.
+    :param num_rows: The number of documents in the batch.
+    :param elapsed: Seconds spent fetching and transforming the batch.
+    """
+    POSTGRES_BATCH_SECONDS.observe(elapsed, collection=collection)
+    ROWS_FETCHED.inc(num_rows, collection=collection)
+
+
+def record_peak_rss(process: str) -> int:
+    """
+    Record the peak RSS of the calling process so far.
+    :param process: The label to report it under, e.g. 'main' or 'witnesses_worker3'.
+    :return: The peak RSS in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_bytes = peak if sys.platform == 'darwin' else peak * 1024
+    PEAK_RSS_BYTES.set(peak_bytes, process=process)
+    return peak_bytes
+
+
+def set_sync_position(chain_height: int, sync_height: int):
+    CHAIN_HEIGHT.set(chain_height)
+    SYNC_HEIGHT.set(sync_height)
+    SYNC_LAG_BLOCKS.set(max(chain_height - sync_height, 0))
+
+
+@contextmanager
+def timed_stage(stage: str):
+    """Times a named stage and records its completion. Failed stages are timed but do not update the last-success gauge."""
+    now = time.time()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.time() - now, stage=stage)
+    STAGE_LAST_SUCCESS.set(time.time(), stage=stage)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # keep scrapes out of the ETL log
+        pass
+
+
+def start_metrics_server(port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """
+    Serve the registry in Prometheus text format on http://host:port/metrics from a daemon thread.
+    :param port: The TCP port to listen on.
+    :param host: The interface to bind.
+    :return: The running server.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return server
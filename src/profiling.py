@@ -0,0 +1,101 @@
+import cProfile
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional
+
+
+def _profile_modes() -> set:
+    """ETL_PROFILE is a comma-separated list of 'cprofile' (deterministic) and/or 'sample' (statistical)."""
+    return {mode.strip().lower() for mode in os.getenv('ETL_PROFILE', '').split(',') if mode.strip()}
+
+
+def _profile_path(stage: str, extension: str) -> str:
+    profile_dir = os.getenv('ETL_PROFILE_DIR', '../logs/profiles')
+    os.makedirs(profile_dir, exist_ok=True)
+    return os.path.join(profile_dir, f'{stage}-{os.getpid()}-{int(time.time())}.{extension}')
+
+
+class StackSampler(object):
+    """
+    Samples the call stack of a single thread at a fixed interval from a background thread and aggregates the stacks
+    in the collapsed format used by flamegraph.pl / speedscope ("outer;inner;leaf count").
+    """
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write_collapsed(self, path: str):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+# (pid, profiler) of the deterministic profiler running on this thread, if any. cProfile hooks are per thread, so
+# concurrently scheduled stages each get their own.
+_active = threading.local()
+
+
+@contextmanager
+def profile_stage(stage: str):
+    """
+    Profiles the enclosed block when ETL_PROFILE is set, writing <stage>-<pid>-<time>.prof (cProfile/pstats) and/or
+    <stage>-<pid>-<time>.collapsed (sampled stacks) to ETL_PROFILE_DIR. A no-op otherwise.
+    :param stage: The stage name used in the output file names.
+    """
+    modes = _profile_modes()
+    profiler: Optional[cProfile.Profile] = None
+    sampler: Optional[StackSampler] = None
+
+    if 'cprofile' in modes:
+        active = getattr(_active, 'profiler', None)
+        if active is not None and active[0] != os.getpid():
+            # forked from a profiled parent: the inherited profiler would never be dumped, so replace it
+            active[1].disable()
+            active = _active.profiler = None
+        if active is None:
+            profiler = cProfile.Profile()
+            _active.profiler = (os.getpid(), profiler)
+            profiler.enable()
+    if 'sample' in modes:
+        sampler = StackSampler(threading.get_ident(), float(os.getenv('ETL_PROFILE_SAMPLE_INTERVAL_SEC', '0.005')))
+        sampler.start()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _active.profiler = None
+            path = _profile_path(stage, 'prof')
+            profiler.dump_stats(path)
+            logging.info(f'Wrote {stage} profile to {path}')
+        if sampler is not None:
+            sampler.stop()
+            path = _profile_path(stage, 'collapsed')
+            sampler.write_collapsed(path)
+            logging.info(f'Wrote {stage} stack samples to {path}')
@@ -0,0 +1,119 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Tuple
+
+
+class Stage(object):
+    """
+    A named unit of work for the StageScheduler. A stage starts once every stage in requires has finished.
+    :param name: The stage name.
+    :param func: Called with no arguments to run the stage.
+    :param requires: Names of the stages whose output this stage reads.
+    :param cost: How much of the scheduler's budget the stage occupies while running. A stage costing the whole budget runs
+        alone, e.g. one that forks worker processes.
+    """
+    def __init__(self, name: str, func: Callable, requires: Iterable[str] = (), cost: int = 1):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.cost = cost
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start if self.end is not None else 0.0
+
+
+class StageScheduler(object):
+    """
+    Runs a DAG of stages on a thread pool, starting each stage as soon as its inputs are ready and the running stages leave
+    enough of the budget. A stage whose cost exceeds the whole budget still runs, but alone.
+    """
+    def __init__(self, stages: List[Stage], budget: int):
+        self.stages = {stage.name: stage for stage in stages}
+        self.budget = max(budget, 1)
+        for stage in stages:
+            missing = [name for name in stage.requires if name not in self.stages]
+            if missing:
+                raise ValueError(f'Stage {stage.name} requires unknown stages {missing}')
+        self._check_acyclic()
+        self._t0 = None
+
+    def _check_acyclic(self):
+        visiting, done = set(), set()
+
+        def visit(name: str):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f'Stage dependency cycle through {name}')
+            visiting.add(name)
+            for required in self.stages[name].requires:
+                visit(required)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def run(self):
+        """Run every stage. If a stage raises, no new stages are started and the first error is re-raised once the running ones finish."""
+        self._t0 = time.time()
+        pending = dict(self.stages)
+        finished = set()
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=len(self.stages)) as pool:
+            while pending or running:
+                if error is None:
+                    used = sum(self.stages[name].cost for name in running.values())
+                    # keep declaration order among ready stages so that runs are reproducible
+                    for name, stage in list(pending.items()):
+                        if not all(required in finished for required in stage.requires):
+                            continue
+                        if running and used + stage.cost > self.budget:
+                            continue
+                        stage.start = time.time() - self._t0
+                        running[pool.submit(stage.func)] = name
+                        used += stage.cost
+                        del pending[name]
+                if not running:
+                    break
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    self.stages[name].end = time.time() - self._t0
+                    if future.exception() is not None:
+                        logging.error(f'Stage {name} failed: {future.exception()!r}')
+                        error = error or future.exception()
+                    else:
+                        finished.add(name)
+        if error is not None:
+            raise error
+
+    def critical_path(self) -> Tuple[List[str], float]:
+        """The dependency chain with the largest total stage duration, and that duration."""
+        longest: Dict[str, Tuple[float, List[str]]] = {}
+
+        def path_to(name: str) -> Tuple[float, List[str]]:
+            if name not in longest:
+                stage = self.stages[name]
+                best = max((path_to(required) for required in stage.requires), default=(0.0, []), key=lambda p: p[0])
+                longest[name] = (best[0] + stage.duration, best[1] + [name])
+            return longest[name]
+
+        length, path = max((path_to(name) for name in self.stages), key=lambda p: p[0])
+        return path, length
+
+    def report(self) -> str:
+        wall = max((stage.end for stage in self.stages.values() if stage.end is not None), default=0.0)
+        path, length = self.critical_path()
+        lines = [f'Stage schedule (budget {self.budget}): {round(wall, 1)} s wall, critical path {" -> ".join(path)} = {round(length, 1)} s']
+        for stage in sorted(self.stages.values(), key=lambda s: (s.start is None, s.start)):
+            if stage.start is None:
+                lines.append(f'  {stage.name}: not run')
+            else:
+                lines.append(f'  {stage.name}: {round(stage.start, 1)} -> {round(stage.end, 1)} s ({round(stage.duration, 1)} s)')
+        return '\n'.join(lines)
@@ -0,0 +1,147 @@
+import json
+import os
+import shutil
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from pyArango.database import Database
+
+import metrics
+
+# edge collections exported by a snapshot: (node collection, edge attributes stored as float64 arrays)
+SNAPSHOT_GRAPHS = {
+    'witnesses': ('hotspots', ['valid_count', 'observations', 'snr_mean', 'signal_mean', 'distance_m']),
+    'token_flows': ('accounts', ['count', 'total_amount', 'bucket_start'])
+}
+
+MANIFEST = 'manifest.json'
+LATEST = 'latest.json'
+
+
+def csr_arrays(src: np.ndarray, dst: np.ndarray, num_nodes: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Compressed sparse row layout of the edges src[i] -> dst[i]: the out-neighbors of node n are
+    indices[indptr[n]:indptr[n + 1]].
+    :return: (indptr, indices, order), where order sorts per-edge attribute arrays into CSR order.
+    """
+    order = np.argsort(src, kind='stable')
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=num_nodes), out=indptr[1:])
+    return indptr, dst[order].astype(np.int32 if num_nodes < 2 ** 31 else np.int64), order
+
+
+def fetch_edge_columns(database: Database, collection_name: str, attributes: List[str], batch_size: int) -> Tuple[List[str], List[str], Dict[str, np.ndarray]]:
+    """
+    Stream _from, _to and the given attributes of every edge of a collection through a cursor.
+    :return: (from keys, to keys, attribute arrays with NaN for missing values)
+    """
+    fields = ', '.join(f'e.{attribute}' for attribute in attributes)
+    aql = f"FOR e IN {collection_name} RETURN [PARSE_IDENTIFIER(e._from).key, PARSE_IDENTIFIER(e._to).key, {fields}]"
+    now = time.time()
+    froms, tos, columns = [], [], [[] for _ in attributes]
+    for row in database.AQLQuery(aql, rawResults=True, batchSize=batch_size):
+        froms.append(row[0])
+        tos.append(row[1])
+        for column, value in zip(columns, row[2:]):
+            column.append(np.nan if value is None else value)
+    metrics.record_fetch(f'snapshot_{collection_name}', len(froms), time.time() - now)
+    return froms, tos, {attribute: np.array(column, dtype=np.float64) for attribute, column in zip(attributes, columns)}
+
+
+def write_graph(database: Database, collection_name: str, directory: str, batch_size: int) -> dict:
+    """
+    Export one edge collection as CSR arrays into directory/collection_name:
+    nodes.npy (fixed-width byte strings, index = node id), indptr.npy, indices.npy and one <attribute>.npy per edge
+    attribute, all in CSR order.
+    :return: The graph's manifest entry.
+    """
+    node_collection, attributes = SNAPSHOT_GRAPHS[collection_name]
+    froms, tos, columns = fetch_edge_columns(database, collection_name, attributes, batch_size)
+    keys, ids = np.unique(np.array(froms + tos, dtype=object), return_inverse=True)
+    nodes = keys.astype(bytes) if len(keys) else np.empty(0, dtype='S1')
+    indptr, indices, order = csr_arrays(ids[:len(froms)], ids[len(froms):], len(keys))
+    arrays = {'nodes': nodes, 'indptr': indptr, 'indices': indices}
+    arrays.update({attribute: column[order] for attribute, column in columns.items()})
+    graph_directory = os.path.join(directory, collection_name)
+    os.makedirs(graph_directory)
+    files = {}
+    for name, array in arrays.items():
+        np.save(os.path.join(graph_directory, f'{name}.npy'), array)
+        files[name] = {'path': f'{collection_name}/{name}.npy', 'dtype': array.dtype.str, 'shape': list(array.shape)}
+    return {'node_collection': node_collection, 'num_nodes': len(keys), 'num_edges': len(froms), 'files': files}
+
+
+def write_snapshot(database: Database, root: str, sync_height: int, sync_time: int, batch_size: int, keep: int = 3) -> str:
+    """
+    Write a new snapshot version of the graphs in SNAPSHOT_GRAPHS that exist in the database, then point latest.json at it.
+    A version is a directory named after the sync watermark it reflects, holding the arrays and a manifest.json; it is
+    complete before latest.json (replaced atomically) refers to it, so readers never see a partial snapshot.
+    :param database: The PyArango Database object.
+    :param root: The snapshot directory.
+    :param sync_height: The block height the graphs are synced to.
+    :param sync_time: The time of that block.
+    :param batch_size: The cursor batch size.
+    :param keep: The number of versions to keep; older ones are deleted.
+    :return: The version written.
+    """
+    version = f'{sync_height}-{int(time.time())}'
+    staging = os.path.join(root, f'.{version}.tmp')
+    os.makedirs(staging)
+    manifest = {'version': version, 'sync_height': sync_height, 'sync_time': sync_time, 'created_at': int(time.time()), 'graphs': {}}
+    try:
+        for collection_name in SNAPSHOT_GRAPHS:
+            if database.hasCollection(collection_name):
+                manifest['graphs'][collection_name] = write_graph(database, collection_name, staging, batch_size)
+        with open(os.path.join(staging, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(staging, os.path.join(root, version))
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    pointer = os.path.join(root, f'.{LATEST}.tmp')
+    with open(pointer, 'w') as f:
+        json.dump({'version': version, 'sync_height': sync_height}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer, os.path.join(root, LATEST))
+    prune_snapshots(root, keep)
+    return version
+
+
+def list_snapshots(root: str) -> List[str]:
+    """The complete versions in root, oldest first."""
+    versions = [name for name in os.listdir(root) if os.path.isfile(os.path.join(root, name, MANIFEST))]
+    return sorted(versions, key=lambda name: tuple(int(part) for part in name.split('-')))
+
+
+def prune_snapshots(root: str, keep: int):
+    """Delete all but the newest keep versions (and never the one latest.json points at)."""
+    latest = read_manifest(root)['version']
+    for version in list_snapshots(root)[:-keep or None]:
+        if version != latest:
+            shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+
+
+def read_manifest(root: str, version: Optional[str] = None) -> dict:
+    """The manifest of a snapshot version, by default the latest."""
+    if version is None:
+        with open(os.path.join(root, LATEST)) as f:
+            version = json.load(f)['version']
+    with open(os.path.join(root, version, MANIFEST)) as f:
+        return json.load(f)
+
+
+def open_graph(root: str, collection_name: str, version: Optional[str] = None) -> Dict[str, np.ndarray]:
+    """
+    Open an exported graph without reading it: every array is memory-mapped read-only, e.g.
+    scipy.sparse.csr_matrix((np.ones(len(g['indices'])), g['indices'], g['indptr'])).
+    :param root: The snapshot directory.
+    :param collection_name: The edge collection, e.g. 'witnesses'.
+    :param version: The snapshot version, by default the latest.
+    :return: nodes, indptr, indices and the edge attribute arrays by name.
+    """
+    manifest = read_manifest(root, version)
+    files = manifest['graphs'][collection_name]['files']
+    directory = os.path.join(root, manifest['version'])
+    return {name: np.load(os.path.join(directory, file['path']), mmap_mode='r') for name, file in files.items()}
@@ -0,0 +1,52 @@
+import os
+import sys
+
+from pyArango.database import Database
+
+# the ETL modules import each other by name from src (see the README)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+
+class FakeQuery(object):
+    """A single-batch stand-in for pyArango's AQLQuery cursor (rawResults=True)."""
+    def __init__(self, result: list):
+        self.result = list(result)
+        self.response = {'result': self.result, 'hasMore': False}
+
+    def nextBatch(self):
+        raise StopIteration('That was the last batch')
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def __getitem__(self, i):
+        return self.result[i]
+
+    def __len__(self):
+        return len(self.result)
+
+
+class FakeDatabase(Database):
+    """
+    A pyArango Database without a server: AQLQuery answers with respond(aql, bind_vars), which returns the result rows or
+    raises, and every query is recorded. Helpers such as fetch_list are pyArango's own, so they behave as in production
+    (e.g. fetch_list raising AQLFetchError on an empty result).
+    :param respond: Called with (aql, bind_vars) for every query.
+    :param collections: Objects returned by database[name].
+    """
+    def __init__(self, respond=lambda aql, bind_vars: [], collections: dict = None):
+        # Database.__init__ connects to the server
+        self.respond = respond
+        self.collections = collections or {}
+        self.queries = []
+
+    def AQLQuery(self, query, batchSize=100, rawResults=False, bindVars=None, options=None, count=False, fullCount=False, json_encoder=None, **moreArgs):
+        bind_vars = bindVars or {}
+        self.queries.append((query, bind_vars))
+        return FakeQuery(self.respond(query, bind_vars))
+
+    def hasCollection(self, name: str) -> bool:
+        return name in self.collections
+
+    def __getitem__(self, name: str):
+        return self.collections[name]
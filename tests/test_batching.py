@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from batching import AdaptiveBatchSizer, batch_sizer, estimate_payload_bytes
+
+
+def sizer(initial_size=1000, **kwargs):
+    options = {'min_size': 100, 'max_size': 20000, 'target_seconds': 2.0, 'max_bytes': 16 * 2 ** 20}
+    options.update(kwargs)
+    return AdaptiveBatchSizer('test', initial_size, **options)
+
+
+def test_initial_size_is_clamped():
+    assert sizer(10).size == 100
+    assert sizer(10 ** 6).size == 20000
+
+
+def test_converges_on_target_time():
+    s = sizer(1000, smoothing=1.0)
+    # 1 ms per row: a 2 s batch is 2000 rows
+    assert s.observe(1000, 0.5, 0.5, 1000) == 2000
+    assert s.observe(2000, 1.0, 1.0, 2000) == 2000
+
+
+def test_steps_at_most_halve_or_double():
+    s = sizer(1000, smoothing=1.0)
+    assert s.observe(1000, 0.001, 0.001, 1000) == 2000
+    assert s.observe(2000, 50, 50, 2000) == 1000
+
+
+def test_payload_limit():
+    s = sizer(1000, smoothing=1.0, max_bytes=100000)
+    # fast enough for a larger batch, but 100 bytes per row only fits 1000 rows
+    assert s.observe(1000, 0.1, 0.1, 100000) == 1000
+
+
+def test_bounds():
+    s = sizer(150, smoothing=1.0)
+    assert s.observe(150, 30, 30, 150) == 100
+    s = sizer(15000, smoothing=1.0)
+    assert s.observe(15000, 0.01, 0.01, 15000) == 20000
+
+
+def test_moving_average():
+    s = sizer(1000, smoothing=0.5)
+    s.observe(1000, 1, 0, 1000)
+    s.observe(1000, 3, 0, 1000)
+    assert s.seconds_per_row == pytest.approx(0.002)
+
+
+def test_empty_batch_keeps_size():
+    s = sizer(1000)
+    assert s.observe(0, 1, 1, 0) == 1000 and s.seconds_per_row is None
+
+
+def test_estimate_payload_bytes():
+    batch = [{'_key': str(i), 'value': 'x' * 10} for i in range(10)]
+    assert estimate_payload_bytes([]) == 0
+    assert estimate_payload_bytes(batch) == len(json.dumps(batch))
+    assert estimate_payload_bytes(batch * 100) == pytest.approx(len(json.dumps(batch * 100)), rel=0.05)
+
+
+def test_batch_sizer_can_be_disabled(monkeypatch):
+    monkeypatch.setenv('ETL_ADAPTIVE_BATCH_SIZE', 'false')
+    assert batch_sizer('test_disabled', 1000) is None
+    monkeypatch.setenv('ETL_ADAPTIVE_BATCH_SIZE', 'true')
+    assert batch_sizer('test_enabled', 1000) is batch_sizer('test_enabled', 5000)
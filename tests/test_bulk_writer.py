@@ -0,0 +1,94 @@
+import json
+
+import pytest
+import requests
+from pyArango.theExceptions import AQLQueryError
+
+from bulk_writer import ResilientBulkWriter, is_ambiguous, is_transient
+
+
+def rejecting(*bad_keys, calls=None):
+    """An all-or-nothing write that rejects any batch containing one of bad_keys."""
+    def write(batch):
+        if calls is not None:
+            calls.append([doc['_key'] for doc in batch])
+        if any(doc['_key'] in bad_keys for doc in batch):
+            raise AQLQueryError('unique constraint violated', '', {'error': True, 'code': 409, 'errorNum': 1210})
+        return {'created': len(batch), 'updated': 0}
+    return write
+
+
+def documents(n):
+    return [{'_key': str(i)} for i in range(n)]
+
+
+def test_bisection_isolates_rejected_documents(tmp_path):
+    calls = []
+    dead_letter_path = str(tmp_path / 'logs' / 'dead_letter.jsonl')
+    writer = ResilientBulkWriter('hotspots', rejecting('2', '5', calls=calls), backoff_seconds=0, dead_letter_path=dead_letter_path)
+    response = writer.write(documents(8))
+    assert response['created'] == 6 and response['errors'] == 2
+    # every good document is written exactly once
+    written = [key for batch in calls for key in batch if '2' not in batch and '5' not in batch]
+    assert sorted(written) == ['0', '1', '3', '4', '6', '7']
+    with open(dead_letter_path) as f:
+        records = [json.loads(line) for line in f]
+    assert [record['document'] for record in records] == [{'_key': '2'}, {'_key': '5'}]
+    assert records[0]['collection'] == 'hotspots' and records[0]['details']['errorNum'] == 1210
+
+
+def test_empty_batch_is_not_written():
+    writer = ResilientBulkWriter('hotspots', rejecting(calls=[]), backoff_seconds=0)
+    assert writer.write([]) == {'created': 0, 'updated': 0, 'ignored': 0, 'errors': 0, 'empty': 0}
+
+
+def test_transient_errors_are_retried_then_raised(tmp_path):
+    attempts = []
+
+    def write(batch):
+        attempts.append(batch)
+        raise requests.exceptions.ConnectionError('connection reset')
+
+    writer = ResilientBulkWriter('hotspots', write, max_retries=2, backoff_seconds=0, dead_letter_path=str(tmp_path / 'dead_letter.jsonl'))
+    with pytest.raises(requests.exceptions.ConnectionError):
+        writer.write(documents(4))
+    assert len(attempts) == 3
+    # nothing is dead-lettered for a batch that was never rejected
+    assert not (tmp_path / 'dead_letter.jsonl').exists()
+
+
+def test_additive_writes_are_not_repeated_after_a_timeout():
+    attempts = []
+
+    def write(batch):
+        attempts.append(batch)
+        raise requests.exceptions.ReadTimeout('no response')
+
+    writer = ResilientBulkWriter('reward_buckets', write, backoff_seconds=0, idempotent=False)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        writer.write(documents(2))
+    assert len(attempts) == 1
+
+
+def test_additive_writes_are_retried_after_a_conflict():
+    attempts = []
+
+    def write(batch):
+        attempts.append(batch)
+        if len(attempts) == 1:
+            raise AQLQueryError('write-write conflict', '', {'error': True, 'code': 409, 'errorNum': 1200})
+        return {'created': 0, 'updated': len(batch)}
+
+    writer = ResilientBulkWriter('witnesses', write, backoff_seconds=0, idempotent=False)
+    assert writer.write(documents(3))['updated'] == 3
+    assert len(attempts) == 2
+
+
+def test_error_classification():
+    gateway_timeout = AQLQueryError('gateway timeout', '', {'error': True, 'code': 504, 'errorNum': 504})
+    conflict = AQLQueryError('conflict', '', {'error': True, 'code': 409, 'errorNum': 1200})
+    unavailable = AQLQueryError('unavailable', '', {'error': True, 'code': 503, 'errorNum': 503})
+    assert is_transient(gateway_timeout) and is_ambiguous(gateway_timeout)
+    assert is_transient(conflict) and not is_ambiguous(conflict)
+    assert is_transient(unavailable) and not is_ambiguous(unavailable)
+    assert not is_transient(AQLQueryError('bad document', '', {'error': True, 'code': 400, 'errorNum': 600}))
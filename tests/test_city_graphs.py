@@ -0,0 +1,46 @@
+from conftest import FakeDatabase
+
+from arango_queries import build_city_graphs, get_changed_cities, refresh_city_graphs, refresh_witness_link_stats
+
+
+class FakeCollection(object):
+    def __init__(self):
+        self.imported = []
+
+    def importBulk(self, documents, **kwargs):
+        self.imported.extend(documents)
+        return {'created': len(documents), 'updated': 0}
+
+
+def respond_empty(aql, bind_vars):
+    # the only query with a row however empty the database is
+    return [1650000000.0] if aql.startswith('RETURN DATE_NOW()') else []
+
+
+def test_refresh_witness_link_stats_without_links():
+    database = FakeDatabase(lambda aql, bind_vars: [0] if 'COLLECT WITH COUNT' in aql else [])
+    assert refresh_witness_link_stats(database, 1650000000) == 0
+
+
+def test_get_changed_cities_without_changes():
+    assert get_changed_cities(FakeDatabase(), 1650000000.0) == []
+
+
+def test_build_city_graphs_without_links():
+    graphs = build_city_graphs(FakeDatabase(), ['a', 'b'])
+    assert [(graph['_key'], graph['num_nodes'], graph['num_edges']) for graph in graphs] == [('a', 0, 0), ('b', 0, 0)]
+
+
+def test_refresh_city_graphs_without_cities():
+    city_graphs = FakeCollection()
+    database = FakeDatabase(respond_empty, {'city_graphs': city_graphs})
+    assert refresh_city_graphs(database, None, 1000) == (0, 1650000000.0)
+    assert refresh_city_graphs(database, 1640000000.0, 1000) == (0, 1650000000.0)
+    assert city_graphs.imported == []
+
+
+def test_build_city_graphs_indexes_nodes():
+    links = [['a', 'h1', 'h2', 10.0], ['a', 'h2', 'h1', 10.0], ['a', 'h1', 'h3', 25.0]]
+    graph, = build_city_graphs(FakeDatabase(lambda aql, bind_vars: links), ['a'])
+    assert graph['nodes'] == ['h1', 'h2', 'h3']
+    assert graph['edges'] == [[0, 1, 10.0], [1, 0, 10.0], [0, 2, 25.0]]
@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import Boolean, DateTime, Float, Text, create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.types import JSON
+
+from blockchain_queries import RewardDaysBatchedQuery
+from blockchain_tables import AccountInventory, Transactions
+from blockchain_types import TransactionType
+from copy_extract import NULL_MARKER, CopyStream, column_converter, parse_timestamp
+
+
+class FakeCursor(object):
+    """psycopg2's copy_expert, writing a canned COPY output (or failing)."""
+    def __init__(self, output: bytes, error: Exception = None):
+        self.output = output
+        self.error = error
+        self.sql = None
+        self.closed = False
+
+    def copy_expert(self, sql, file):
+        self.sql = sql
+        file.write(self.output)
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+def session_with(cursor: FakeCursor) -> Session:
+    """An ORM session that compiles queries for Postgres and hands out cursor, without a server."""
+    session = Session(bind=create_engine('postgresql://'))
+
+    class Connection(object):
+        connection = type('DBAPIConnection', (), {'cursor': lambda self: cursor})()
+
+    session.connection = lambda: Connection()
+    return session
+
+
+def test_parse_timestamp():
+    assert parse_timestamp('2021-10-01 12:00:00') == datetime(2021, 10, 1, 12)
+    assert parse_timestamp('2021-10-01 12:00:00.5+00') == datetime(2021, 10, 1, 12, 0, 0, 500000, tzinfo=timezone.utc)
+    assert parse_timestamp('2021-10-01 12:00:00.1234567-05:30') == datetime(2021, 10, 1, 12, 0, 0, 123456, tzinfo=timezone(-timedelta(hours=5, minutes=30)))
+    with pytest.raises(ValueError):
+        parse_timestamp('yesterday')
+
+
+def test_column_converters():
+    assert column_converter(JSON())('{"a": [1, 2]}') == {'a': [1, 2]}
+    assert column_converter(Transactions.type.type)('payment_v1') is TransactionType.payment_v1
+    assert column_converter(Boolean())('t') is True and column_converter(Boolean())('f') is False
+    assert column_converter(DateTime(timezone=True))('2021-10-01 12:00:00+00').tzinfo == timezone.utc
+    assert column_converter(Transactions.time.type)('1633089600') == 1633089600
+    assert column_converter(Float())('0.25') == 0.25
+    assert column_converter(Text())('0.25') == '0.25'
+
+
+def test_columns_are_converted():
+    cursor = FakeCursor(b'abc,payment_v1,"{""payer"": ""p"", ""amount"": 5}",1633089600\n'
+                        b'def,poc_receipts_v1,' + NULL_MARKER.encode() + b',1633089601\n')
+    session = session_with(cursor)
+    stream = CopyStream(session.query(Transactions.hash, Transactions.type, Transactions.fields, Transactions.time).order_by(Transactions.hash))
+    assert stream.read(1) == [('abc', TransactionType.payment_v1, {'payer': 'p', 'amount': 5}, 1633089600)]
+    assert stream.read(5) == [('def', TransactionType.poc_receipts_v1, None, 1633089601)]
+    assert stream.read(5) == []
+    assert cursor.sql.startswith('COPY (SELECT') and cursor.sql.endswith("TO STDOUT WITH (FORMAT csv, NULL '\\N')")
+    assert 'ORDER BY transactions.hash' in cursor.sql and cursor.closed
+
+
+def test_mapped_entities_come_back_as_dicts():
+    cursor = FakeCursor(b'addr,1,2,3,4,5,10,\\N,6\n')
+    stream = CopyStream(session_with(cursor).query(AccountInventory))
+    row, = stream.read(10)
+    assert row == {'address': 'addr', 'dc_balance': 1, 'dc_nonce': 2, 'security_balance': 3, 'balance': 4, 'nonce': 5,
+                   'first_block': 10, 'last_block': None, 'staked_balance': 6}
+
+
+def test_mixed_entities_and_columns():
+    cursor = FakeCursor(b'addr,1,2,3,4,5,10,11,6,7\n')
+    stream = CopyStream(session_with(cursor).query(AccountInventory, Transactions.time))
+    (account, time), = stream.read(10)
+    assert account['address'] == 'addr' and account['last_block'] == 11 and time == 7
+
+
+def test_copy_errors_surface_at_the_end_of_the_stream():
+    cursor = FakeCursor(b'abc,1633089600\n', error=RuntimeError('canceling statement due to statement timeout'))
+    stream = CopyStream(session_with(cursor).query(Transactions.hash, Transactions.time))
+    with pytest.raises(RuntimeError):
+        stream.read(10)
+
+
+def test_close_abandons_a_large_result():
+    # far more than the pipe and its buffers hold, so the COPY thread is blocked writing when the stream is closed
+    cursor = FakeCursor(b''.join(b'%d,%d\n' % (i, i) for i in range(500000)))
+    stream = CopyStream(session_with(cursor).query(Transactions.hash, Transactions.time))
+    assert stream.read(2) == [('0', 0), ('1', 1)]
+    stream.close()
+    assert cursor.closed
+
+
+def test_reward_days_copy(monkeypatch):
+    monkeypatch.setenv('ETL_EXTRACT_MODE', 'copy')
+    cursor = FakeCursor(b'g1,19000,5\ng1,19001,7\ng2,19000,11\n')
+    batched_query = RewardDaysBatchedQuery(session_with(cursor), 2, 100, 200)
+    batches = []
+    while not batched_query.query_complete:
+        batches.append(batched_query.get_next_batch())
+    assert [[(bucket['_key'], bucket['amount']) for bucket in batch] for batch in batches] == [[('g1-19000', 5), ('g1-19001', 7)], [('g2-19000', 11)], []]
+    assert batches[0][0] == {'_key': 'g1-19000', 'gateway': 'g1', 'day': 19000, 'amount': 5, 'min_block': 100, 'max_block': 200}
+    assert 'GROUP BY' in cursor.sql
@@ -0,0 +1,61 @@
+import pytest
+
+from fingerprints import FingerprintStore, fingerprint
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = FingerprintStore(str(tmp_path / 'fingerprints.db'), 'hotspots')
+    yield store
+    store.close()
+
+
+def test_fingerprint_ignores_key_order():
+    assert fingerprint({'_key': 'a', 'x': 1, 'y': [1, 2]}) == fingerprint({'y': [1, 2], 'x': 1, '_key': 'a'})
+    assert fingerprint({'_key': 'a', 'x': 1}) != fingerprint({'_key': 'a', 'x': 2})
+
+
+def test_unchanged_documents_are_dropped_after_commit(store):
+    docs = [{'_key': 'a', 'x': 1}, {'_key': 'b', 'x': 2}]
+    changed, pending = store.filter_changed(docs)
+    assert changed == docs
+    # nothing is remembered until the import is committed
+    assert store.filter_changed(docs)[0] == docs
+    store.commit(pending)
+    changed, pending = store.filter_changed([{'_key': 'a', 'x': 1}, {'_key': 'b', 'x': 3}, {'_key': 'c', 'x': 1}])
+    assert [doc['_key'] for doc in changed] == ['b', 'c'] and set(pending) == {'b', 'c'}
+
+
+def test_many_keys(store):
+    docs = [{'_key': str(i), 'x': i} for i in range(2500)]
+    store.commit(store.filter_changed(docs)[1])
+    assert store.filter_changed(docs)[0] == []
+
+
+def test_namespaces_are_separate(store, tmp_path):
+    store.commit(store.filter_changed([{'_key': 'a'}])[1])
+    accounts = FingerprintStore(str(tmp_path / 'fingerprints.db'), 'accounts')
+    try:
+        assert accounts.filter_changed([{'_key': 'a'}])[0] == [{'_key': 'a'}]
+        accounts.clear()
+    finally:
+        accounts.close()
+    assert store.filter_changed([{'_key': 'a'}])[0] == []
+
+
+def test_bind_clears_for_another_collection(store):
+    store.bind('helium/c1', 0)
+    store.commit(store.filter_changed([{'_key': 'a'}, {'_key': 'b'}])[1])
+    store.bind('helium/c1', 2)
+    assert store.filter_changed([{'_key': 'a'}])[0] == []
+    # recreated or restored collection
+    store.bind('helium/c2', 2)
+    assert store.filter_changed([{'_key': 'a'}])[0] == [{'_key': 'a'}]
+
+
+def test_bind_clears_when_documents_are_missing(store):
+    store.bind('helium/c1', 0)
+    store.commit(store.filter_changed([{'_key': 'a'}, {'_key': 'b'}])[1])
+    # truncated
+    store.bind('helium/c1', 1)
+    assert len(store.filter_changed([{'_key': 'a'}, {'_key': 'b'}])[0]) == 2
@@ -0,0 +1,61 @@
+import h3
+import numpy as np
+import pytest
+
+from geo import EARTH_RADIUS_M, HotspotCoordinates, city_key, h3_to_geo_locations, haversine_m, initial_bearing_deg
+
+
+def test_haversine_known_distances():
+    # a degree of longitude along the equator, and a quarter meridian
+    assert haversine_m(np.array([0.0]), np.array([0.0]), np.array([1.0]), np.array([0.0]))[0] == pytest.approx(EARTH_RADIUS_M * np.pi / 180)
+    assert haversine_m(np.array([10.0]), np.array([0.0]), np.array([10.0]), np.array([90.0]))[0] == pytest.approx(EARTH_RADIUS_M * np.pi / 2)
+    # Paris -> London, about 344 km
+    assert haversine_m(np.array([2.3522]), np.array([48.8566]), np.array([-0.1276]), np.array([51.5072]))[0] == pytest.approx(343.5e3, rel=0.01)
+
+
+def test_haversine_symmetric_and_zero():
+    rng = np.random.default_rng(1)
+    lon1, lon2 = rng.uniform(-180, 180, (2, 100))
+    lat1, lat2 = rng.uniform(-90, 90, (2, 100))
+    assert np.allclose(haversine_m(lon1, lat1, lon2, lat2), haversine_m(lon2, lat2, lon1, lat1))
+    assert np.allclose(haversine_m(lon1, lat1, lon1, lat1), 0)
+    # antipodes stay finite despite rounding
+    assert haversine_m(np.array([0.0]), np.array([0.0]), np.array([180.0]), np.array([0.0]))[0] == pytest.approx(EARTH_RADIUS_M * np.pi)
+
+
+def test_initial_bearing_cardinal_directions():
+    lon2 = np.array([0.0, 1.0, 0.0, -1.0])
+    lat2 = np.array([1.0, 0.0, -1.0, 0.0])
+    bearings = initial_bearing_deg(np.zeros(4), np.zeros(4), lon2, lat2)
+    assert np.allclose(bearings, [0, 90, 180, 270])
+
+
+def test_initial_bearing_range():
+    rng = np.random.default_rng(2)
+    bearings = initial_bearing_deg(*rng.uniform(-80, 80, (4, 1000)))
+    assert ((bearings >= 0) & (bearings < 360)).all()
+
+
+def test_h3_to_geo_locations():
+    location_hex = h3.geo_to_h3(37.77, -122.42, 12)
+    lat, lon = h3.h3_to_geo(location_hex)
+    points = h3_to_geo_locations([location_hex, None, location_hex])
+    assert points[0] == {'coordinates': (lon, lat), 'type': 'Point'} and points[2] == points[0]
+    assert points[1] == {'coordinates': None, 'type': 'Point'}
+
+
+def test_city_key():
+    assert city_key(None) is None and city_key('') is None
+    assert city_key('san franciscocaliforniaunited states') == city_key('san franciscocaliforniaunited states')
+    assert len(city_key('x')) == 32
+
+
+def test_annotate_links():
+    a, b = h3.geo_to_h3(0.0, 0.0, 12), h3.geo_to_h3(0.0, 0.01, 12)
+    coordinates = HotspotCoordinates()
+    coordinates.load([('a', a), ('b', b), ('c', None)])
+    assert len(coordinates) == 2
+    links = [{'_from': 'hotspots/a', '_to': 'hotspots/b'}, {'_from': 'hotspots/a', '_to': 'hotspots/c'}]
+    coordinates.annotate_links(links)
+    assert links[0]['distance_m'] == pytest.approx(1112, rel=0.01) and links[0]['bearing'] == pytest.approx(90, abs=1)
+    assert 'distance_m' not in links[1] and 'bearing' not in links[1]
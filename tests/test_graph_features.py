@@ -0,0 +1,86 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from conftest import FakeDatabase
+
+from graph_features import WitnessGraph, compute_features, grouped_percentiles, hits, sync_graph_features
+
+
+def graph_of(links, num_nodes=None, distance=None):
+    src, dst = (np.array(ends, dtype=np.int64) for ends in zip(*links))
+    n = num_nodes or int(max(src.max(), dst.max())) + 1
+    keys = np.array([f'h{i}' for i in range(n)], dtype=object)
+    ones = np.ones(len(links))
+    return WitnessGraph(keys, src, dst, ones, ones, ones * np.nan if distance is None else np.array(distance, dtype=np.float64))
+
+
+def test_grouped_percentiles_match_numpy():
+    rng = np.random.default_rng(0)
+    groups = rng.integers(0, 6, 200)
+    values = rng.normal(size=200)
+    values[::7] = np.nan
+    result = grouped_percentiles(groups, values, 7, (10, 50, 90))
+    for group in range(6):
+        expected = np.percentile(values[(groups == group) & ~np.isnan(values)], (10, 50, 90))
+        assert np.allclose(result[group], expected)
+    # a group without values
+    assert np.isnan(result[6]).all()
+
+
+def test_hits_star():
+    # h0 points at everyone else: the only hub, and the others are equal authorities
+    hubs, authorities = hits(graph_of([(0, 1), (0, 2), (0, 3)]))
+    assert np.allclose(hubs, [1, 0, 0, 0])
+    assert np.allclose(authorities, [0, 1 / 3, 1 / 3, 1 / 3])
+
+
+def test_hits_collapses_parallel_links():
+    hubs, authorities = hits(graph_of([(0, 1), (0, 1), (0, 1), (2, 1), (2, 0)]))
+    single, _ = hits(graph_of([(0, 1), (2, 1), (2, 0)]))
+    assert np.allclose(hubs, single)
+    assert np.isclose(hubs.sum(), 1) and np.isclose(authorities.sum(), 1)
+
+
+def test_compute_features():
+    features = compute_features(graph_of([(0, 1), (1, 0), (0, 2)], distance=[100, 100, 300]))
+    assert features['out_degree'].tolist() == [2, 1, 0]
+    assert features['in_degree'].tolist() == [1, 1, 1]
+    assert np.allclose(features['reciprocal_ratio'][:2], [0.5, 1]) and np.isnan(features['reciprocal_ratio'][2])
+    assert np.allclose(features['distance_p50'], [100, 100, 300])
+
+
+def test_sync_clears_hotspots_without_links():
+    patches = []
+
+    def respond(aql, bind_vars):
+        if 'FOR e IN witnesses' in aql:
+            return [['hotspots/a', 'hotspots/b', 1, 2, 500.0]]
+        if 'FOR hotspot IN hotspots' in aql:
+            # hotspots that still have features: a is in the graph, c lost its links
+            return ['a', 'c']
+        patches.extend(bind_vars['patches'])
+        return [patch['_key'] for patch in bind_vars['patches']]
+
+    assert sync_graph_features(FakeDatabase(respond), 100) == 3
+    cleared = [patch['fields'] for patch in patches if patch['_key'] == 'c']
+    assert cleared == [{'in_degree': None, 'out_degree': None, 'hub_score': None, 'authority_score': None},
+                       {'reciprocal_ratio': None, 'valid_ratio': None, 'distance_p10': None, 'distance_p50': None, 'distance_p90': None}]
+
+
+def test_sync_without_links_clears_everything():
+    def respond(aql, bind_vars):
+        if 'FOR hotspot IN hotspots' in aql:
+            return ['a']
+        return [patch['_key'] for patch in bind_vars.get('patches', [])]
+
+    assert sync_graph_features(FakeDatabase(respond), 100) == 1
+
+
+def test_etl_does_not_import_scipy():
+    # the forked import workers inherit whatever etl imports
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+    code = "import sys, etl; assert not {'scipy', 'graph_features', 'snapshot'} & set(sys.modules)"
+    subprocess.run([sys.executable, '-c', code], cwd=src, check=True)
@@ -0,0 +1,56 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from blockchain_queries import filter_key_range, get_key_ranges
+from blockchain_tables import AccountInventory
+
+
+def accounts(addresses) -> list:
+    return [{'address': address, 'dc_balance': 0, 'dc_nonce': 0, 'security_balance': 0, 'balance': 0, 'nonce': 0, 'first_block': 1,
+             'last_block': None, 'staked_balance': 0} for address in addresses]
+
+
+def session_with(addresses) -> Session:
+    """A session over an in-memory SQLite account_inventory holding these addresses (SQLite has ntile too)."""
+    engine = create_engine('sqlite://')
+    AccountInventory.__table__.create(engine)
+    session = Session(bind=engine)
+    if addresses:
+        session.execute(AccountInventory.__table__.insert(), accounts(addresses))
+    session.commit()
+    return session
+
+
+def addresses_in(session: Session, key_range) -> list:
+    query = filter_key_range(session.query(AccountInventory.address), AccountInventory.address, key_range)
+    return [row[0] for row in query.order_by(AccountInventory.address)]
+
+
+def test_empty_table_is_one_unbounded_range():
+    session = session_with([])
+    assert get_key_ranges(session, AccountInventory.address, 4) == [(None, None)]
+    # accounts inserted after the split are still read
+    session.execute(AccountInventory.__table__.insert(), accounts(['a1']))
+    assert addresses_in(session, (None, None)) == ['a1']
+
+
+def test_single_key():
+    session = session_with(['a1'])
+    assert get_key_ranges(session, AccountInventory.address, 4) == [(None, None)]
+
+
+def test_fewer_keys_than_ranges():
+    session = session_with(['a3', 'a1', 'a2'])
+    assert get_key_ranges(session, AccountInventory.address, 8) == [(None, 'a2'), ('a2', 'a3'), ('a3', None)]
+
+
+def test_uneven_split_covers_every_row_once():
+    addresses = [f'a{i:02d}' for i in range(10)]
+    session = session_with(addresses)
+    key_ranges = get_key_ranges(session, AccountInventory.address, 3)
+    # ntile puts the remainder into the first tiles: 4, 3, 3
+    assert key_ranges == [(None, 'a04'), ('a04', 'a07'), ('a07', None)]
+    assert [addresses_in(session, key_range) for key_range in key_ranges] == [addresses[:4], addresses[4:7], addresses[7:]]
+    # keys before the first or after the last one at split time fall into the unbounded ends
+    session.execute(AccountInventory.__table__.insert(), accounts(['a', 'b']))
+    assert addresses_in(session, key_ranges[0])[0] == 'a' and addresses_in(session, key_ranges[-1])[-1] == 'b'
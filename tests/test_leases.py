@@ -0,0 +1,59 @@
+from conftest import FakeDatabase
+
+from etl import HeliumArangoETL
+from leases import ArangoLeaseStore, LeaseHeartbeat, SQLiteLeaseStore
+
+
+def test_sqlite_claims_in_block_order(tmp_path):
+    store = SQLiteLeaseStore(str(tmp_path / 'leases.db'))
+    store.add_units('backfill', [(200, 300), (100, 200)])
+    store.add_units('backfill', [(100, 200)])
+    first = store.claim('backfill', 'one', 60)
+    second = store.claim('backfill', 'two', 60)
+    assert (first['from_block'], first['owner'], first['attempts']) == (100, 'one', 1)
+    assert second['from_block'] == 200
+    assert store.claim('backfill', 'three', 60) is None
+    assert not store.complete(first['_key'], 'two')
+    assert store.complete(first['_key'], 'one')
+    store.release(second['_key'], 'two')
+    assert store.progress('backfill') == {'done': 1, 'pending': 1}
+
+
+def test_sqlite_expired_lease_is_claimed_again(tmp_path):
+    store = SQLiteLeaseStore(str(tmp_path / 'leases.db'))
+    store.add_units('backfill', [(0, 100)])
+    unit = store.claim('backfill', 'crashed', -1)
+    again = store.claim('backfill', 'other', 60)
+    assert again['_key'] == unit['_key'] and again['attempts'] == 2
+    assert not store.heartbeat(unit['_key'], 'crashed', 60)
+    with LeaseHeartbeat(store, unit['_key'], 'crashed', 60, 0.01) as heartbeat:
+        assert heartbeat.lost.wait(1)
+
+
+def test_arango_progress_of_unknown_job():
+    assert ArangoLeaseStore(FakeDatabase()).progress('backfill') == {}
+
+
+def test_heartbeat_gets_its_own_arango_connection(tmp_path, monkeypatch):
+    class FakeConnection(object):
+        def __init__(self):
+            self.database = FakeDatabase()
+            self.disconnected = False
+
+        def __getitem__(self, name):
+            return self.database
+
+        def disconnectSession(self):
+            self.disconnected = True
+
+    connection = FakeConnection()
+    monkeypatch.setattr(HeliumArangoETL, 'connect_arango', staticmethod(lambda: connection))
+    etl = HeliumArangoETL.__new__(HeliumArangoETL)
+    store = ArangoLeaseStore(FakeDatabase(), 'backfill_units')
+    with etl.heartbeat_store(store) as heartbeat_store:
+        assert heartbeat_store.database is connection.database and heartbeat_store.collection_name == 'backfill_units'
+        assert not connection.disconnected
+    assert connection.disconnected
+    sqlite_store = SQLiteLeaseStore(str(tmp_path / 'leases.db'))
+    with etl.heartbeat_store(sqlite_store) as heartbeat_store:
+        assert heartbeat_store is sqlite_store
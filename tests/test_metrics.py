@@ -0,0 +1,109 @@
+import multiprocessing
+
+import pytest
+
+from metrics import MetricsRegistry
+
+
+def registry_with_metrics():
+    registry = MetricsRegistry()
+    documents = registry.counter('etl_documents_total', 'Arango import outcomes per document.', ['collection', 'outcome'])
+    depth = registry.gauge('etl_import_queue_depth', 'Import work partitions that have not finished yet.', ['collection'])
+    seconds = registry.histogram('etl_arango_batch_seconds', 'Time to import one batch into Arango.', ['collection'], buckets=(0.5, 0.1, 1.0))
+    return registry, documents, depth, seconds
+
+
+def test_render_prometheus_text():
+    registry, documents, depth, seconds = registry_with_metrics()
+    documents.inc(3, collection='hotspots', outcome='created')
+    documents.inc(collection='accounts', outcome='updated')
+    depth.set(4, collection='payments')
+    depth.dec(collection='payments')
+    seconds.observe(0.05, collection='hotspots')
+    seconds.observe(0.7, collection='hotspots')
+    seconds.observe(2, collection='hotspots')
+    assert registry.render() == '\n'.join([
+        '# HELP etl_documents_total Arango import outcomes per document.',
+        '# TYPE etl_documents_total counter',
+        'etl_documents_total{collection="accounts",outcome="updated"} 1',
+        'etl_documents_total{collection="hotspots",outcome="created"} 3',
+        '# HELP etl_import_queue_depth Import work partitions that have not finished yet.',
+        '# TYPE etl_import_queue_depth gauge',
+        'etl_import_queue_depth{collection="payments"} 3',
+        '# HELP etl_arango_batch_seconds Time to import one batch into Arango.',
+        '# TYPE etl_arango_batch_seconds histogram',
+        # buckets are sorted and cumulative, +Inf counts every observation
+        'etl_arango_batch_seconds_bucket{collection="hotspots",le="0.1"} 1',
+        'etl_arango_batch_seconds_bucket{collection="hotspots",le="0.5"} 1',
+        'etl_arango_batch_seconds_bucket{collection="hotspots",le="1.0"} 2',
+        'etl_arango_batch_seconds_bucket{collection="hotspots",le="+Inf"} 3',
+        'etl_arango_batch_seconds_sum{collection="hotspots"} 2.75',
+        'etl_arango_batch_seconds_count{collection="hotspots"} 3',
+    ]) + '\n'
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    counter = registry.counter('etl_test_total', 'Test.', ['stage'])
+    counter.inc(stage='a "b"\\c\nd')
+    assert 'etl_test_total{stage="a \\"b\\"\\\\c\\nd"} 1' in registry.render()
+
+
+def test_labels_must_match():
+    registry, documents, depth, seconds = registry_with_metrics()
+    with pytest.raises(ValueError):
+        documents.inc(collection='hotspots')
+    with pytest.raises(ValueError):
+        registry.counter('etl_documents_total', 'Again.')
+
+
+def test_merge_snapshots():
+    parent, documents, depth, seconds = registry_with_metrics()
+    documents.inc(2, collection='hotspots', outcome='created')
+    depth.set(5, collection='payments')
+    seconds.observe(0.05, collection='hotspots')
+    worker, worker_documents, worker_depth, worker_seconds = registry_with_metrics()
+    worker_documents.inc(3, collection='hotspots', outcome='created')
+    worker_documents.inc(collection='hotspots', outcome='errors')
+    worker_depth.set(1, collection='payments')
+    worker_seconds.observe(0.7, collection='hotspots')
+    parent.merge(worker.snapshot())
+    # counters and histograms add up, gauges take the reported reading
+    assert documents.snapshot() == {('hotspots', 'created'): 5, ('hotspots', 'errors'): 1}
+    assert depth.snapshot() == {('payments',): 1}
+    assert seconds.snapshot() == {('hotspots',): ([1, 1, 2], 0.75, 2)}
+    # metrics the parent does not know are ignored
+    parent.merge({'etl_unknown_total': {(): 1}})
+
+
+def test_snapshot_is_a_copy():
+    registry, documents, depth, seconds = registry_with_metrics()
+    seconds.observe(0.05, collection='hotspots')
+    snapshot = registry.snapshot()
+    seconds.observe(0.05, collection='hotspots')
+    assert snapshot['etl_arango_batch_seconds'][('hotspots',)] == ([1, 1, 1], 0.05, 1)
+
+
+def report_from_worker(registry, documents, queue):
+    # as in the import workers: forget what was inherited from the parent, then report only this worker's share
+    registry.reset()
+    documents.inc(7, collection='payments', outcome='created')
+    queue.put(registry.snapshot())
+
+
+def test_merge_across_processes():
+    registry, documents, depth, seconds = registry_with_metrics()
+    documents.inc(2, collection='payments', outcome='created')
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    workers = [context.Process(target=report_from_worker, args=(registry, documents, queue)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    snapshots = [queue.get(timeout=30) for _ in workers]
+    for worker in workers:
+        worker.join()
+    for snapshot in snapshots:
+        registry.merge(snapshot)
+    assert documents.snapshot() == {('payments', 'created'): 16}
+    registry.reset()
+    assert registry.snapshot() == {'etl_documents_total': {}, 'etl_import_queue_depth': {}, 'etl_arango_batch_seconds': {}}
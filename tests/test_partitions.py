@@ -0,0 +1,109 @@
+from datetime import datetime, timezone
+
+from conftest import FakeDatabase
+
+from arango_queries import PAYMENTS_GRAPH, drop_partitions_before, import_payment_partitions, init_partitions, partitions_for_range
+
+
+def utc(*args) -> int:
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp())
+
+
+class FakeEdges(object):
+    def __init__(self, name: str):
+        self.name = name
+        self.indexes = []
+        self.imported = []
+
+    def ensurePersistentIndex(self, fields):
+        self.indexes.append(fields)
+
+    def importBulk(self, documents, **kwargs):
+        self.imported.extend(documents)
+        return {'created': len(documents), 'updated': 0}
+
+
+class FakeResponse(object):
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+
+    def json(self):
+        return {}
+
+
+class FakeGharial(object):
+    """The requests session of the connection, answering the gharial calls of add/remove_edge_definition."""
+    def __init__(self, database: 'PartitionedDatabase'):
+        self.database = database
+        self.calls = []
+
+    def get(self, url):
+        self.calls.append(('get', url))
+        return FakeResponse(200 if self.database.graph_exists else 404)
+
+    def post(self, url, data):
+        self.calls.append(('post', url))
+        self.database.graph_exists = True
+        return FakeResponse(202)
+
+    def delete(self, url, params):
+        self.calls.append(('delete', url))
+        # dropCollections: the collection goes away on the server, pyArango's cache does not know
+        del self.database.server[url.rsplit('/', 1)[1]]
+        return FakeResponse(202)
+
+
+class PartitionedDatabase(FakeDatabase):
+    """A FakeDatabase whose collections live on a 'server' that pyArango's cache (collections) is only synced with on reload."""
+    def __init__(self):
+        super().__init__()
+        self.server = {}
+        self.graph_exists = False
+        self.connection = type('Connection', (), {})()
+        self.connection.session = FakeGharial(self)
+
+    def getURL(self):
+        return 'http://arango/_db/helium/_api'
+
+    def createCollection(self, className, name, waitForSync):
+        self.server[name] = self.collections[name] = FakeEdges(name)
+
+    def reloadCollections(self):
+        self.collections = dict(self.server)
+
+
+def test_partitions_for_range():
+    assert partitions_for_range('payments', utc(2021, 11, 30, 23), utc(2022, 2, 1)) == ['payments_202111', 'payments_202112', 'payments_202201', 'payments_202202']
+    assert partitions_for_range('payments', utc(2021, 11, 1), utc(2021, 11, 30)) == ['payments_202111']
+
+
+def test_init_partitions_creates_missing_ones():
+    database = PartitionedDatabase()
+    assert init_partitions(database, 'payments', 'PaymentEdges', PAYMENTS_GRAPH, utc(2021, 11, 5), utc(2021, 12, 5)) == ['payments_202111', 'payments_202112']
+    assert database['payments_202111'].indexes == [['time']]
+    # the first partition creates the graph, the second is added to it
+    assert [call for call in database.connection.session.calls if call[0] == 'post'] == [
+        ('post', 'http://arango/_db/helium/_api/gharial'), ('post', f'http://arango/_db/helium/_api/gharial/{PAYMENTS_GRAPH}/edge')]
+    init_partitions(database, 'payments', 'PaymentEdges', PAYMENTS_GRAPH, utc(2021, 12, 5), utc(2022, 1, 5))
+    assert database['payments_202112'].indexes == [['time']] and 'payments_202201' in database.collections
+
+
+def test_payments_are_routed_by_month():
+    database = PartitionedDatabase()
+    init_partitions(database, 'payments', 'PaymentEdges', PAYMENTS_GRAPH, utc(2021, 11, 1), utc(2021, 12, 31))
+    payments = [{'_key': 'a', 'time': utc(2021, 11, 30, 23, 59)}, {'_key': 'b', 'time': utc(2021, 12, 1)}, {'_key': 'c', 'time': utc(2021, 11, 1)}]
+    assert import_payment_partitions(database, payments) == {'created': 3, 'updated': 0, 'ignored': 0, 'errors': 0, 'empty': 0}
+    assert [payment['_key'] for payment in database['payments_202111'].imported] == ['a', 'c']
+    assert [payment['_key'] for payment in database['payments_202112'].imported] == ['b']
+
+
+def test_dropped_partitions_leave_the_collection_cache():
+    database = PartitionedDatabase()
+    init_partitions(database, 'payments', 'PaymentEdges', PAYMENTS_GRAPH, utc(2021, 10, 1), utc(2021, 12, 1))
+    database.server['payments_sync'] = database.collections['payments_sync'] = FakeEdges('payments_sync')
+    assert drop_partitions_before(database, 'payments', PAYMENTS_GRAPH, utc(2021, 11, 15)) == ['payments_202110']
+    assert not database.hasCollection('payments_202110')
+    assert sorted(database.collections) == ['payments_202111', 'payments_202112', 'payments_sync']
+    # a partition dropped and needed again (e.g. a backfill of old blocks) is created anew rather than taken from the cache
+    init_partitions(database, 'payments', 'PaymentEdges', PAYMENTS_GRAPH, utc(2021, 10, 1), utc(2021, 10, 2))
+    assert 'payments_202110' in database.server
@@ -0,0 +1,49 @@
+import pytest
+from pyArango.theExceptions import AQLQueryError
+
+from conftest import FakeDatabase
+
+from arango_queries import patch_documents, register_patch_fields
+from bulk_writer import ResilientBulkWriter
+
+register_patch_fields('hotspots', 'test_features', {'score': True, 'ratio': False})
+
+
+def existing(*keys):
+    """Answers the patch query like Arango would: with the keys of the patched documents that exist."""
+    return lambda aql, bind_vars: [patch['_key'] for patch in bind_vars['patches'] if patch['_key'] in keys]
+
+
+def test_patch_missing_documents():
+    response = patch_documents(FakeDatabase(existing()), 'hotspots', 'test_features', [{'_key': 'a', 'score': 1.0}])
+    assert response == {'created': 0, 'updated': 0}
+
+
+def test_patch_groups_by_keep_null():
+    database = FakeDatabase(existing('a', 'b'))
+    patches = [{'_key': 'a', 'score': None, 'ratio': None}, {'_key': 'b', 'score': 2.0}, {'_key': 'c', 'ratio': 0.5}]
+    assert patch_documents(database, 'hotspots', 'test_features', patches) == {'created': 0, 'updated': 2}
+    groups = {bind_vars['keep_null']: bind_vars['patches'] for aql, bind_vars in database.queries}
+    assert groups[True] == [{'_key': 'a', 'fields': {'score': None}}, {'_key': 'b', 'fields': {'score': 2.0}}]
+    assert groups[False] == [{'_key': 'a', 'fields': {'ratio': None}}, {'_key': 'c', 'fields': {'ratio': 0.5}}]
+
+
+def test_patch_rejects_fields_of_other_owners():
+    with pytest.raises(ValueError):
+        patch_documents(FakeDatabase(existing('a')), 'hotspots', 'test_features', [{'_key': 'a', 'pagerank': 0.1}])
+
+
+def test_patch_conflict_is_retried():
+    attempts = []
+
+    def respond(aql, bind_vars):
+        attempts.append(bind_vars['patches'])
+        if len(attempts) == 1:
+            raise AQLQueryError('write-write conflict', aql, {'error': True, 'code': 409, 'errorNum': 1200})
+        return existing('a', 'b')(aql, bind_vars)
+
+    database = FakeDatabase(respond)
+    writer = ResilientBulkWriter('hotspots', lambda batch: patch_documents(database, 'hotspots', 'test_features', batch), backoff_seconds=0)
+    response = writer.write([{'_key': 'a', 'score': 1.0}, {'_key': 'b', 'score': 2.0}])
+    assert response['updated'] == 2 and response['errors'] == 0
+    assert len(attempts) == 2
@@ -0,0 +1,30 @@
+import json
+from hashlib import md5
+
+from blockchain_queries import payment_edges
+
+
+def test_payment_v1():
+    fields = {'payer': 'p', 'payee': 'q', 'amount': 100, 'fee': 35000, 'nonce': 1}
+    edge, = payment_edges(fields, 1650000000)
+    assert edge == {'_key': md5(json.dumps(fields).encode()).hexdigest(), '_from': 'accounts/p', '_to': 'accounts/q', 'amount': 100, 'time': 1650000000}
+
+
+def test_payment_v2_fans_out_payees():
+    fields = {'payer': 'p', 'payments': [{'payee': 'q', 'amount': 1}, {'payee': 'r', 'amount': 2}, {'payee': 'q', 'amount': 3}], 'nonce': 7}
+    edges = payment_edges(fields, 1650000000)
+    payment_hash = md5(json.dumps(fields).encode()).hexdigest()
+    # the first payee keeps the key recorded before payees were fanned out
+    assert [edge['_key'] for edge in edges] == [payment_hash, f'{payment_hash}-1', f'{payment_hash}-2']
+    assert [(edge['_from'], edge['_to'], edge['amount']) for edge in edges] == [('accounts/p', 'accounts/q', 1), ('accounts/p', 'accounts/r', 2), ('accounts/p', 'accounts/q', 3)]
+    assert {edge['time'] for edge in edges} == {1650000000}
+
+
+def test_keys_are_stable_and_distinct():
+    fields = {'payer': 'p', 'payee': 'q', 'amount': 100, 'nonce': 1}
+    assert payment_edges(dict(fields), 1)[0]['_key'] == payment_edges(dict(fields), 2)[0]['_key']
+    assert payment_edges(fields, 1)[0]['_key'] != payment_edges({**fields, 'nonce': 2}, 1)[0]['_key']
+
+
+def test_payment_v2_without_payees():
+    assert payment_edges({'payer': 'p', 'payments': []}, 1) == []
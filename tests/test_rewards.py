@@ -0,0 +1,72 @@
+from conftest import FakeDatabase
+
+from arango_queries import add_reward_buckets, register_patch_fields, rollup_rewards
+
+register_patch_fields('hotspots', 'rewards', {'rewards_1d': True, 'rewards_5d': True, 'rewards_30d': True})
+
+
+def test_full_rollup_without_expired_buckets():
+    database = FakeDatabase(lambda aql, bind_vars: [])
+    assert rollup_rewards(database, 19000, [1, 5, 30]) == 0
+    (expire_aql, expire_vars), (rollup_aql, rollup_vars) = database.queries
+    assert 'REMOVE bucket IN reward_buckets' in expire_aql and expire_vars['min_day'] == 18971
+    # hotspots without buckets are zeroed whether or not a bucket of theirs just expired
+    assert 'FOR hotspot IN hotspots' in rollup_aql and 'hotspot.rewards_30d != 0' in rollup_aql
+    assert rollup_vars['gateways'] is None
+
+
+def test_gateway_rollup_skips_expiry():
+    rolled_up = [{'_key': 'g1', 'rewards_1d': 1, 'rewards_5d': 2, 'rewards_30d': 3},
+                 {'_key': 'g2', 'rewards_1d': 0, 'rewards_5d': 0, 'rewards_30d': 4},
+                 {'_key': 'g3', 'rewards_1d': 0, 'rewards_5d': 0, 'rewards_30d': 5}]
+
+    def respond(aql, bind_vars):
+        if 'FOR bucket IN reward_buckets' in aql:
+            return rolled_up
+        # g3 is not a hotspot (yet)
+        return [patch['_key'] for patch in bind_vars['patches'] if patch['_key'] != 'g3']
+
+    database = FakeDatabase(respond)
+    assert rollup_rewards(database, 19000, [1, 5, 30], ['g1', 'g2', 'g3'], batch_size=2) == 2
+    (rollup_aql, rollup_vars), *patches = database.queries
+    assert rollup_vars['gateways'] == ['g1', 'g2', 'g3']
+    # the horizons are written through patch_documents, in batches
+    assert [[patch['_key'] for patch in bind_vars['patches']] for aql, bind_vars in patches] == [['g1', 'g2'], ['g3']]
+    assert patches[0][1]['patches'][0]['fields'] == {'rewards_1d': 1, 'rewards_5d': 2, 'rewards_30d': 3}
+
+
+def reward_buckets_store(stored: dict):
+    """Answers add_reward_buckets like Arango would, keeping the buckets in stored."""
+    def respond(aql, bind_vars):
+        created = updated = 0
+        for bucket in bind_vars['buckets']:
+            block_range = [bucket['min_block'], bucket['max_block'], bucket['amount']]
+            old = stored.get(bucket['_key'])
+            kept = [] if old is None else [r for r in old['blocks'] if r[1] <= bucket['min_block'] or r[0] >= bucket['max_block']]
+            blocks = kept + [block_range]
+            stored[bucket['_key']] = {'amount': sum(r[2] for r in blocks), 'blocks': blocks}
+            created, updated = created + (old is None), updated + (old is not None)
+        return [{'created': created or None, 'updated': updated or None}]
+    return respond
+
+
+def buckets(min_block, max_block, amount):
+    return [{'_key': 'g1-19000', 'gateway': 'g1', 'day': 19000, 'amount': amount, 'min_block': min_block, 'max_block': max_block}]
+
+
+def test_reward_buckets_count_each_block_once():
+    stored = {}
+    database = FakeDatabase(reward_buckets_store(stored))
+    assert add_reward_buckets(database, buckets(100, 200, 5)) == {'created': 1, 'updated': 0}
+    # a retried batch
+    add_reward_buckets(database, buckets(100, 200, 5))
+    assert stored['g1-19000']['amount'] == 5
+    # the next cycle fails after writing its buckets, and is re-run from the same watermark up to a later block
+    add_reward_buckets(database, buckets(200, 300, 7))
+    add_reward_buckets(database, buckets(200, 350, 9))
+    assert stored['g1-19000']['amount'] == 14
+    # backfill units cover disjoint ranges in any order
+    add_reward_buckets(database, buckets(0, 50, 1))
+    add_reward_buckets(database, buckets(50, 100, 2))
+    assert stored['g1-19000']['amount'] == 17
+    assert 'bucket.min_block' in database.queries[0][0]
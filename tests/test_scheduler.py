@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import Stage, StageScheduler
+
+
+def sleeper(log: list, name: str, seconds: float = 0.05):
+    def run():
+        log.append(('start', name))
+        time.sleep(seconds)
+        log.append(('end', name))
+    return run
+
+
+def overlaps(log: list, name: str) -> set:
+    """The stages running at some point while name ran."""
+    running, result = set(), set()
+    for event, stage in log:
+        if event == 'start':
+            if stage == name:
+                result.update(running)
+            elif name in running:
+                result.add(stage)
+            running.add(stage)
+        else:
+            running.discard(stage)
+    return result
+
+
+def test_dependencies_run_in_order():
+    log = []
+    scheduler = StageScheduler([Stage('b', sleeper(log, 'b'), requires=['a']), Stage('a', sleeper(log, 'a'))], 4)
+    scheduler.run()
+    assert log == [('start', 'a'), ('end', 'a'), ('start', 'b'), ('end', 'b')]
+
+
+def test_stage_costing_the_budget_runs_alone():
+    log = []
+    stages = [Stage('a', sleeper(log, 'a')), Stage('fork', sleeper(log, 'fork'), cost=3), Stage('b', sleeper(log, 'b')),
+              Stage('c', sleeper(log, 'c'))]
+    StageScheduler(stages, 3).run()
+    assert overlaps(log, 'fork') == set()
+    assert overlaps(log, 'b') == {'a', 'c'}
+
+
+def test_failure_stops_new_stages():
+    ran = threading.Event()
+
+    def fail():
+        raise RuntimeError('boom')
+
+    scheduler = StageScheduler([Stage('a', fail), Stage('b', ran.set, requires=['a'])], 2)
+    with pytest.raises(RuntimeError):
+        scheduler.run()
+    assert not ran.is_set()
+
+
+def test_unknown_and_cyclic_requirements():
+    with pytest.raises(ValueError):
+        StageScheduler([Stage('a', print, requires=['missing'])], 1)
+    with pytest.raises(ValueError):
+        StageScheduler([Stage('a', print, requires=['b']), Stage('b', print, requires=['a'])], 1)
+
+
+def test_critical_path():
+    stages = [Stage('a', print), Stage('b', print, requires=['a']), Stage('c', print), Stage('d', print, requires=['b', 'c'])]
+    scheduler = StageScheduler(stages, 2)
+    for name, (start, end) in {'a': (0, 1), 'b': (1, 4), 'c': (0, 5), 'd': (5, 6)}.items():
+        scheduler.stages[name].start, scheduler.stages[name].end = start, end
+    assert scheduler.critical_path() == (['c', 'd'], 6)
+    scheduler.stages['b'].end = 6
+    assert scheduler.critical_path() == (['a', 'b', 'd'], 7)
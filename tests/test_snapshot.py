@@ -0,0 +1,45 @@
+import numpy as np
+
+from conftest import FakeDatabase
+
+from snapshot import csr_arrays, list_snapshots, open_graph, read_manifest, write_snapshot
+
+
+def test_csr_arrays():
+    src = np.array([2, 0, 2, 1, 0])
+    dst = np.array([0, 1, 1, 2, 2])
+    indptr, indices, order = csr_arrays(src, dst, 4)
+    assert indptr.tolist() == [0, 2, 3, 5, 5]
+    # out-neighbors per node, in edge order within a node
+    assert [indices[indptr[n]:indptr[n + 1]].tolist() for n in range(4)] == [[1, 2], [2], [0, 1], []]
+    assert order.tolist() == [1, 4, 3, 0, 2]
+    assert indices.dtype == np.int32
+
+
+def test_csr_arrays_without_edges():
+    indptr, indices, order = csr_arrays(np.array([], dtype=np.int64), np.array([], dtype=np.int64), 0)
+    assert indptr.tolist() == [0] and len(indices) == 0 and len(order) == 0
+
+
+def witness_rows(aql, bind_vars):
+    return [['a', 'b', 3, 4, -5.0, -100.0, 250.0], ['b', 'a', 1, 1, None, None, 250.0], ['a', 'c', 0, 2, 1.0, -90.0, None]]
+
+
+def test_write_and_open_snapshot(tmp_path):
+    database = FakeDatabase(witness_rows, {'witnesses': None})
+    version = write_snapshot(database, str(tmp_path), 1200000, 1650000000, 100)
+    assert list_snapshots(str(tmp_path)) == [version] and read_manifest(str(tmp_path))['sync_height'] == 1200000
+    graph = open_graph(str(tmp_path), 'witnesses')
+    assert graph['nodes'].tolist() == [b'a', b'b', b'c']
+    assert graph['indptr'].tolist() == [0, 2, 3, 3] and graph['indices'].tolist() == [1, 2, 0]
+    # attributes follow the edges into CSR order, with NaN for missing values
+    assert graph['valid_count'].tolist() == [3, 0, 1]
+    assert np.isnan(graph['distance_m'][1]) and graph['distance_m'][0] == 250.0
+    assert isinstance(graph['indices'], np.memmap)
+
+
+def test_old_versions_are_pruned(tmp_path):
+    database = FakeDatabase(witness_rows, {'witnesses': None})
+    versions = [write_snapshot(database, str(tmp_path), height, 1650000000, 100, keep=2) for height in (1, 2, 3)]
+    assert list_snapshots(str(tmp_path)) == versions[1:]
+    assert read_manifest(str(tmp_path))['version'] == versions[-1]
@@ -0,0 +1,96 @@
+import threading
+
+import pytest
+from conftest import FakeDatabase
+
+import etl as etl_module
+from etl import HeliumArangoETL
+
+DAY = 86400
+# three blocks a minute apart, early on UTC day 19100
+BLOCKS = [(1001, 19100 * DAY + 60), (1002, 19100 * DAY + 120), (1003, 19100 * DAY + 180)]
+
+
+class FakeSession(object):
+    def close(self):
+        pass
+
+
+class Recorder(object):
+    """Stands in for the import and rollup functions sync_blocks calls, recording their arguments."""
+    def __init__(self, monkeypatch):
+        self.calls = []
+        self.fail = set()
+        for name in ('import_payments_batched', 'import_witnesses_batched', 'refresh_witness_link_stats', 'import_reward_buckets_batched',
+                     'rollup_rewards', 'reset_witness_link_stats'):
+            monkeypatch.setattr(etl_module, name, self.recording(name))
+
+    def recording(self, name):
+        def record(*args):
+            self.calls.append((name, args))
+            if name in self.fail:
+                raise RuntimeError(f'{name} failed')
+            return 0
+        return record
+
+    def of(self, name):
+        return [args for called, args in self.calls if called == name]
+
+
+def following_etl() -> HeliumArangoETL:
+    """An ETL following the chain at block 1000, without the connections and collections of HeliumArangoETL.__init__."""
+    etl = HeliumArangoETL.__new__(HeliumArangoETL)
+    etl._stage_arango = threading.local()
+    etl._db = FakeDatabase(collections={'payments': 'payments', 'witnesses': 'witnesses', 'reward_buckets': 'reward_buckets'})
+    etl.sessionmaker = FakeSession
+    etl.batch_size = 100
+    etl.partition_payments = False
+    etl.recent_witness_days_cutoff = 30
+    etl.reward_horizons = [1, 5, 30]
+    etl.load_hotspot_coordinates = lambda: None
+    etl.sync_height = etl.reward_sync_height = etl.current_height = 1000
+    etl.current_time = etl.witness_sync_time = 19100 * DAY
+    etl.witness_merge_incomplete = False
+    return etl
+
+
+def test_watermarks_advance_to_the_last_block(monkeypatch):
+    recorder = Recorder(monkeypatch)
+    etl = following_etl()
+    etl.sync_blocks(BLOCKS)
+    assert (etl.sync_height, etl.reward_sync_height, etl.current_height) == (1003, 1003, 1003)
+    assert etl.current_time == etl.witness_sync_time == 19100 * DAY + 180
+    assert not etl.witness_merge_incomplete
+    (payments_args,) = recorder.of('import_payments_batched')
+    assert payments_args[3:6] == (19100 * DAY + 59, 19100 * DAY + 181, (1000, 1003))
+    (witness_args,) = recorder.of('import_witnesses_batched')
+    assert witness_args[3:6] == (19100 * DAY + 59, 19100 * DAY + 181, (1000, 1003))
+    assert recorder.of('import_reward_buckets_batched')[0][3:5] == (1000, 1003)
+    assert recorder.of('reset_witness_link_stats') == []
+
+
+def test_partial_chunk_is_resumed_from_the_same_watermark(monkeypatch):
+    recorder = Recorder(monkeypatch)
+    etl = following_etl()
+    # payments and witnesses of the micro-batch are written, then the rewards fail
+    recorder.fail.add('import_reward_buckets_batched')
+    with pytest.raises(RuntimeError):
+        etl.sync_blocks(BLOCKS)
+    assert (etl.sync_height, etl.reward_sync_height, etl.current_height, etl.witness_sync_time) == (1000, 1000, 1000, 19100 * DAY)
+    assert etl.witness_merge_incomplete
+
+    # the next poll gets the same blocks (and more) after sync_height
+    recorder.fail.clear()
+    recorder.calls.clear()
+    etl.sync_blocks(BLOCKS + [(1004, 19100 * DAY + 240)])
+    assert etl.sync_height == 1004 and etl.witness_sync_time == 19100 * DAY + 240 and not etl.witness_merge_incomplete
+    # payments are keyed by transaction and reward buckets by block range, so both simply write the range again
+    assert recorder.of('import_payments_batched')[0][5] == (1000, 1004)
+    assert recorder.of('import_reward_buckets_batched')[0][3:5] == (1000, 1004)
+    # the witness statistics of the day are rebuilt from its start instead of merging the blocks twice
+    (reset_args,) = recorder.of('reset_witness_link_stats')
+    assert reset_args[1] == 19100
+    (witness_args,) = recorder.of('import_witnesses_batched')
+    assert witness_args[3:6] == (19100 * DAY - 1, 19100 * DAY + 241, (-1, 1004))
+    names = [name for name, args in recorder.calls]
+    assert names.index('reset_witness_link_stats') < names.index('import_witnesses_batched')
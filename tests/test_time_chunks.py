@@ -0,0 +1,19 @@
+import pytest
+
+from arango_queries import time_chunks
+
+
+@pytest.mark.parametrize('min_time, max_time, num_chunks', [(0, 101, 4), (1650000000, 1650003601, 8), (10, 13, 5), (7, 8, 3)])
+def test_time_chunks_cover_every_time_once(min_time, max_time, num_chunks):
+    chunks = time_chunks(min_time, max_time, num_chunks)
+    assert len(chunks) == num_chunks
+    # the queries keep lower < t < upper
+    covered = [t for lower, upper in chunks for t in range(lower + 1, upper)]
+    assert covered == list(range(min_time + 1, max_time))
+
+
+def test_time_chunks_keep_the_outer_bounds():
+    chunks = time_chunks(1650000000, 1650086401, 6)
+    assert chunks[0][0] == 1650000000 and chunks[-1][1] == 1650086401
+    # consecutive chunks meet without a gap at the boundary second
+    assert all(upper - 1 == next_lower for (_, upper), (next_lower, _) in zip(chunks, chunks[1:]))
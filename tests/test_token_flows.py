@@ -0,0 +1,73 @@
+from hashlib import md5
+
+from conftest import FakeDatabase
+
+from arango_queries import token_flow_bucket_start, update_token_flows
+
+
+def test_update_token_flows_runs():
+    database = FakeDatabase(lambda aql, bind_vars: [3])
+    assert update_token_flows(database, 1650000000, 1650003600, 'day') == 3
+    (aql, bind_vars), = database.queries
+    assert 'IN token_flows OPTIONS {waitForSync: @sync}' in aql
+    assert isinstance(bind_vars['sync'], bool)
+
+
+def test_bucket_start():
+    # 2022-04-20 13:00 UTC, a Wednesday
+    timestamp = 1650459600
+    assert token_flow_bucket_start(timestamp, 'day') == 1650412800
+    # weeks start on Monday 2022-04-18 00:00 UTC
+    assert token_flow_bucket_start(timestamp, 'week') == 1650240000
+    assert token_flow_bucket_start(1650240000, 'week') == 1650240000
+    assert token_flow_bucket_start(1650240000 - 1, 'week') == 1650240000 - 7 * 86400
+
+
+def aggregate(payments, flows: dict) -> FakeDatabase:
+    """A database answering the token-flow query as Arango would, writing the flows into flows by _key."""
+    def respond(aql, bind_vars):
+        for p in payments:
+            if bind_vars['start'] <= p['time'] < bind_vars['end']:
+                bucket_start = p['time'] - ((p['time'] - bind_vars['offset']) % bind_vars['size'])
+                key = md5(f"{p['_from']}{p['_to']}{bucket_start}".encode()).hexdigest()
+                flow = flows.setdefault(key, {'_key': key, '_from': p['_from'], '_to': p['_to'], 'bucket_start': bucket_start,
+                                              'count': 0, 'total_amount': 0})
+                flow['count'] += 1
+                flow['total_amount'] += p['amount']
+        return [len(flows)]
+    return FakeDatabase(respond)
+
+
+def test_flows_cover_whole_buckets():
+    day = 1650412800
+    payments = [
+        {'_from': 'accounts/a', '_to': 'accounts/b', 'amount': 5, 'time': day - 1},
+        {'_from': 'accounts/a', '_to': 'accounts/b', 'amount': 1, 'time': day},
+        {'_from': 'accounts/a', '_to': 'accounts/b', 'amount': 2, 'time': day + 86399},
+        {'_from': 'accounts/b', '_to': 'accounts/a', 'amount': 4, 'time': day + 3600},
+        {'_from': 'accounts/a', '_to': 'accounts/b', 'amount': 8, 'time': day + 86400}
+    ]
+    # new payments in the middle of the day re-aggregate the whole day, and only that day
+    written = {}
+    assert update_token_flows(aggregate(payments, written), day + 3600, day + 7200, 'day') == 2
+    flows = {(flow['_from'], flow['_to']): flow for flow in written.values()}
+    assert flows['accounts/a', 'accounts/b']['_key'] == md5(f'accounts/aaccounts/b{day}'.encode()).hexdigest()
+    assert (flows['accounts/a', 'accounts/b']['count'], flows['accounts/a', 'accounts/b']['total_amount']) == (2, 3)
+    assert (flows['accounts/b', 'accounts/a']['count'], flows['accounts/b', 'accounts/a']['total_amount']) == (1, 4)
+
+
+def test_weekly_flows():
+    monday = 1650240000
+    payments = [{'_from': 'accounts/a', '_to': 'accounts/b', 'amount': amount, 'time': monday + i * 86400}
+                for i, amount in enumerate([1, 2, 3, 4, 5, 6, 7, 8])]
+    written = {}
+    assert update_token_flows(aggregate(payments, written), monday + 86400, monday + 2 * 86400, 'week') == 1
+    flow, = written.values()
+    assert (flow['bucket_start'], flow['count'], flow['total_amount']) == (monday, 7, 28)
+
+
+def test_partitions_are_aggregated_together():
+    database = FakeDatabase(lambda aql, bind_vars: [0])
+    update_token_flows(database, 1650412800, 1650412900, 'day', ['payments_202203', 'payments_202204'])
+    (aql, _), = database.queries
+    assert 'FOR p IN payments_202203 ' in aql and 'FOR p IN payments_202204 ' in aql